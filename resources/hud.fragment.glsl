@@ -0,0 +1,7 @@
+#version 130
+in vec4 color;
+out vec4 outputColor;
+
+void main() {
+	outputColor = color;
+}
\ No newline at end of file
@@ -0,0 +1,16 @@
+#version 130
+
+in vec2 v_position;
+in vec4 v_color;
+out vec4 color;
+
+uniform vec2 window_size;
+
+void main() {
+	// Position is in pixels, counted from top left corner of window
+	gl_Position = vec4(
+			v_position.x * 2.0 / window_size.x - 1.0,
+			1.0 - v_position.y * 2.0 / window_size.y,
+			0.0, 1.0);
+	color = v_color;
+}
@@ -285,6 +285,7 @@ class App(Gtk.Application):
 		btQuickSave.set_visible(False)
 		self.wrapper = Wrapper(self, ebMain, core_filename, game_path, opts)
 		self.wrapper.set_vsync(False)
+		self.wrapper.set_hud_visible(self.config["show_hud"])
 		self.select_pads(rom_type, name)
 		for pad in self.pads:
 			pad.on_size_allocate(pad)
@@ -383,6 +384,12 @@ class App(Gtk.Application):
 		btQuickSave = self.builder.get_object("btQuickSave")
 		btQuickSave.set_visible(True)
 	
+	def on_input_latency(self, latency):
+		for name in ("read", "present"):
+			h = latency[name]
+			log.info("Input to %s latency: %s samples, mean %.1fms, p50 %.1fms, p99 %.1fms, max %.1fms",
+				name, h["count"], h["mean"] / 1000.0, h["p50"] / 1000.0, h["p99"] / 1000.0, h["max"] / 1000.0)
+	
 	def on_render_size_changed(self, width, height):
 		ebMain = self.builder.get_object("ebMain")
 		rect = ebMain.get_allocation()
@@ -598,7 +605,19 @@ class App(Gtk.Application):
 			self._set_mouse(event)
 	
 	def on_window_key_press_event(self, window, event):
-		if event.keyval in DEFAULT_MAPPINGS:
+		if event.keyval == Gdk.KEY_F3:
+			# Toggles performance HUD
+			self.config["show_hud"] = not self.config["show_hud"]
+			self.config.save()
+			if self.wrapper:
+				self.wrapper.set_hud_visible(self.config["show_hud"])
+		elif event.keyval == Gdk.KEY_F4:
+			# Writes input latency measured so far
+			if self.wrapper:
+				self.wrapper.dump_input_latency(
+					os.path.join(get_data_path(), "input_latency.json"))
+				self.wrapper.get_input_latency(self.on_input_latency)
+		elif event.keyval in DEFAULT_MAPPINGS:
 			self.wrapper.set_button(DEFAULT_MAPPINGS[event.keyval], True)
 	
 	def on_window_key_release_event(self, window, event):
@@ -23,6 +23,8 @@ class Config(object):
 			"right_outer": 10,
 			"right_bottom": 10,
 		},
+		# Draws fps, frame times and audio buffer fill over game
+		"show_hud": False,
 		"last_saves": [
 			# { "game": "full/path/to/game.gb", "state": "/full/path/to/save.sav" }
 		]
@@ -60,10 +60,12 @@ class CoreConfigDialog:
 	
 	
 	def on_btApply_clicked(self, *a):
-		config = {
+		# Keeps values stored by runner itself, such as audio latency
+		config = load_core_config(self.app.wrapper.core)
+		config.update({
 			key: option.get_value()
 			for (key, option) in self.options.items()
-		}
+		})
 		save_core_config(self.app.wrapper.core, config)
 		self.app.wrapper.config_changed()
 
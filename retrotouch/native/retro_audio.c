@@ -1,38 +1,54 @@
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
+#include <errno.h>
+#include <pthread.h>
 #include <retrotouch.h>
 
 #define LOG(...) rt_log(data, "RSound", __VA_ARGS__)
+#define WAV_HEADER_SIZE 44
+
+/**
+ * Audio backend. Threaded backends get samples resampled to keep their
+ * buffer near fill target and written from audio thread, where write may block.
+ * Other backends get samples written directly after every frame.
+ * Backend with write set to NULL discards everything.
+ */
+struct AudioBackend {
+	const char* name;
+	bool threaded;
+	// Returns 0 on success. May be called again to change frequency
+	int (*open)(LibraryData* data, int frequency);
+	// Writes interleaved stereo frames. Returns frames written or negative number on error
+	ssize_t (*write)(LibraryData* data, const int16_t* frames, size_t count);
+	// Returns 0 on success. NULL if backend has no latency to tune
+	int (*set_latency)(LibraryData* data, unsigned int latency);
+	void (*close)(LibraryData* data);
+};
 
 
-int rt_audio_init(LibraryData* data, int frequency) {
 #if RT_AUDIO_ENABLED
+static int rt_alsa_open(LibraryData* data, int frequency) {
 	int err;
 	snd_pcm_hw_params_t* hw_params;
-
-	if (frequency == data->private->audio.frequency)
-		return 0;
 	
-	if (data->private->audio.frequency == 0) {
+	if (data->private->audio.device == NULL) {
 		err = snd_pcm_open(&data->private->audio.device, "default", SND_PCM_STREAM_PLAYBACK, 0);
 		if (err < 0) {
+			data->private->audio.device = NULL;
 			LOG(RETRO_LOG_ERROR, "Failed to open audio device: %s", snd_strerror(err));
-			rt_set_error(data, "Failed to open audio device");
 			return 1;
 		}
 		
 		err = snd_pcm_hw_params_malloc(&hw_params);
 		if (err < 0) {
 			LOG(RETRO_LOG_ERROR, "Failed to configure audio device: Out of memory");
-			rt_set_error(data, "Failed to configure audio device");
 			return 1;
 		}
 		
 		err = snd_pcm_hw_params_any(data->private->audio.device, hw_params);
 		if (err < 0) {
 			LOG(RETRO_LOG_ERROR, "Failed to configure audio device: snd_pcm_hw_params_any failed");
-			rt_set_error(data, "Failed to configure audio device");
 			return 1;
 		}
 		
@@ -43,22 +59,19 @@ int rt_audio_init(LibraryData* data, int frequency) {
 		err = snd_pcm_hw_params_set_channels(data->private->audio.device, hw_params, 2);
 		if (err < 0) {
 			LOG(RETRO_LOG_ERROR, "Failed to configure audio device: failed to set audio channels");
-			rt_set_error(data, "Failed to configure audio device");
 			return 1;
 		}
 		
-		uint rate = 44100;
+		uint rate = frequency;
 		err = snd_pcm_hw_params_set_rate_near(data->private->audio.device, hw_params, &rate, 0);
 		if (err < 0) {
 			LOG(RETRO_LOG_ERROR, "Failed to configure audio device: failed to set sample rate");
-			rt_set_error(data, "Failed to configure audio device");
 			return 1;
 		}
 		
 		err = snd_pcm_hw_params(data->private->audio.device, hw_params);
 		if (err < 0) {
 			LOG(RETRO_LOG_ERROR, "Failed to configure audio device: snd_pcm_hw_params failed");
-			rt_set_error(data, "Failed to configure audio device");
 			return 1;
 		}
 		
@@ -67,48 +80,483 @@ int rt_audio_init(LibraryData* data, int frequency) {
 		err = snd_pcm_prepare(data->private->audio.device);
 		if (err < 0) {
 			LOG(RETRO_LOG_ERROR, "Failed to configure audio device: snd_pcm_prepare failed");
-			rt_set_error(data, "Failed to configure audio device");
 			return 1;
 		}
 	}
 	
 	err = snd_pcm_set_params(data->private->audio.device, SND_PCM_FORMAT_S16,
-				SND_PCM_ACCESS_RW_INTERLEAVED, 2, frequency, 1, 64 * 1000);
+				SND_PCM_ACCESS_RW_INTERLEAVED, 2, frequency, 1, data->private->audio.tuner.latency);
 	if (err < 0) {
-		data->private->audio.frequency = 1;	// Random number just so device is not opened again in next call
 		LOG(RETRO_LOG_ERROR, "Failed to configure audio device: %s", snd_strerror(err));
-		rt_set_error(data, "Failed to configure audio device");
 		return 1;
 	}
-	data->private->audio.frequency = frequency;
-	
-#else
-	LOG(RETRO_LOG_WARN, "Compiled without audio support; Audio disabled");
-#endif
 	return 0;
 }
 
 
-size_t rt_audio_sample_batch(LibraryData* data, const int16_t* audiodata, size_t frames) {
-#if RT_AUDIO_ENABLED
-	snd_pcm_sframes_t r = snd_pcm_writei(data->private->audio.device, audiodata, frames);
+static ssize_t rt_alsa_write(LibraryData* data, const int16_t* frames, size_t count) {
+	snd_pcm_sframes_t r = snd_pcm_writei(data->private->audio.device, frames, count);
 	if (r < 0) {
 		if (r == -EPIPE)
-			LOG(RETRO_LOG_WARN, "Audio underrun");
-		else
-			LOG(RETRO_LOG_WARN, "Alsa error #%i: ", -r);
-		snd_pcm_recover(data->private->audio.device, r, 0);
+			__atomic_add_fetch(&data->private->audio.underruns, 1, __ATOMIC_RELAXED);
+		snd_pcm_recover(data->private->audio.device, r, 1);
+	}
+	return r;
+}
+
+
+static int rt_alsa_set_latency(LibraryData* data, unsigned int latency) {
+	// Device can be reconfigured only when stopped. Drain waits until
+	// everything already written is played, so nothing is thrown away
+	snd_pcm_drain(data->private->audio.device);
+	int err = snd_pcm_set_params(data->private->audio.device, SND_PCM_FORMAT_S16,
+				SND_PCM_ACCESS_RW_INTERLEAVED, 2, data->private->audio.frequency, 1, latency);
+	if (err < 0) {
+		LOG(RETRO_LOG_WARN, "Failed to change audio latency: %s", snd_strerror(err));
+		snd_pcm_set_params(data->private->audio.device, SND_PCM_FORMAT_S16,
+				SND_PCM_ACCESS_RW_INTERLEAVED, 2, data->private->audio.frequency, 1,
+				data->private->audio.tuner.latency);
+		return 1;
+	}
+	return 0;
+}
+
+
+static void rt_alsa_close(LibraryData* data) {
+	if (data->private->audio.device != NULL) {
+		snd_pcm_drop(data->private->audio.device);
+		snd_pcm_close(data->private->audio.device);
+		data->private->audio.device = NULL;
+	}
+}
+#endif
+
+
+static int rt_null_open(LibraryData* data, int frequency) {
+	LOG(RETRO_LOG_DEBUG, "Audio disabled");
+	return 0;
+}
+
+
+static void rt_wav_put(uint8_t* target, uint32_t value, int size) {
+	for (int i=0; i<size; i++)
+		target[i] = (value >> (8 * i)) & 0xFF;
+}
+
+
+static void rt_wav_write_header(LibraryData* data) {
+	uint8_t header[WAV_HEADER_SIZE];
+	uint32_t size = data->private->audio.wav.frames * 4;
+	memcpy(header, "RIFF", 4);
+	rt_wav_put(header + 4, 36 + size, 4);
+	memcpy(header + 8, "WAVEfmt ", 8);
+	rt_wav_put(header + 16, 16, 4);									// fmt chunk size
+	rt_wav_put(header + 20, 1, 2);									// PCM
+	rt_wav_put(header + 22, 2, 2);									// channels
+	rt_wav_put(header + 24, data->private->audio.wav.frequency, 4);
+	rt_wav_put(header + 28, data->private->audio.wav.frequency * 4, 4);	// bytes per second
+	rt_wav_put(header + 32, 4, 2);									// bytes per frame
+	rt_wav_put(header + 34, 16, 2);									// bits per sample
+	memcpy(header + 36, "data", 4);
+	rt_wav_put(header + 40, size, 4);
+	fseek(data->private->audio.wav.file, 0, SEEK_SET);
+	fwrite(header, WAV_HEADER_SIZE, 1, data->private->audio.wav.file);
+	fseek(data->private->audio.wav.file, 0, SEEK_END);
+}
+
+
+static void rt_wav_close(LibraryData* data) {
+	if (data->private->audio.wav.file != NULL) {
+		rt_wav_write_header(data);
+		if (fclose(data->private->audio.wav.file) != 0)
+			LOG(RETRO_LOG_ERROR, "Failed to write %s: %s", data->private->audio.filename, strerror(errno));
+		data->private->audio.wav.file = NULL;
+	}
+}
+
+
+static int rt_wav_open(LibraryData* data, int frequency) {
+	rt_wav_close(data);
+	if (data->private->audio.filename == NULL) {
+		LOG(RETRO_LOG_ERROR, "Failed to open WAV file: No filename set");
+		return 1;
+	}
+	data->private->audio.wav.file = fopen(data->private->audio.filename, "wb");
+	if (data->private->audio.wav.file == NULL) {
+		LOG(RETRO_LOG_ERROR, "Failed to open %s: %s", data->private->audio.filename, strerror(errno));
+		return 1;
+	}
+	data->private->audio.wav.frequency = frequency;
+	data->private->audio.wav.frames = 0;
+	// Sizes in header are filled in when file is closed
+	rt_wav_write_header(data);
+	LOG(RETRO_LOG_INFO, "Writing audio to %s", data->private->audio.filename);
+	return 0;
+}
+
+
+static ssize_t rt_wav_write(LibraryData* data, const int16_t* frames, size_t count) {
+	// Samples are stored as they are, what is correct only on little-endian machine
+	size_t written = fwrite(frames, 2 * sizeof(int16_t), count, data->private->audio.wav.file);
+	data->private->audio.wav.frames += written;
+	return written;
+}
+
+
+static const struct AudioBackend rt_audio_backends[] = {
+	// First one is default
+#if RT_AUDIO_ENABLED
+	{ "alsa", true, rt_alsa_open, rt_alsa_write, rt_alsa_set_latency, rt_alsa_close },
+#endif
+	{ "null", false, rt_null_open, NULL, NULL, NULL },
+	{ "wav", false, rt_wav_open, rt_wav_write, NULL, rt_wav_close },
+	{ NULL },
+};
+
+
+/**
+ * Called by audio thread before every write. Every second, checks how many
+ * underruns happened and increases latency if there were too many. After
+ * long enough time without any underrun, latency is slowly decreased again.
+ */
+static void rt_audio_tune_latency(LibraryData* data) {
+	uint64_t now = rt_get_time();
+	if (now < data->private->audio.tuner.next_check)
+		return;
+	data->private->audio.tuner.next_check = now + 1000000;
+	
+	uint64_t underruns = __atomic_load_n(&data->private->audio.underruns, __ATOMIC_RELAXED);
+	uint64_t count = underruns - data->private->audio.tuner.underruns;
+	unsigned int latency = data->private->audio.tuner.latency;
+	data->private->audio.tuner.underruns = underruns;
+	
+	if (count >= RT_AUDIO_UNDERRUNS) {
+		latency = latency * 3 / 2;
+		if (latency > RT_AUDIO_MAX_LATENCY) latency = RT_AUDIO_MAX_LATENCY;
+		data->private->audio.tuner.stable = 0;
+	} else if (count > 0) {
+		data->private->audio.tuner.stable = 0;
+		return;
+	} else if (++data->private->audio.tuner.stable >= RT_AUDIO_STABLE_TIME) {
+		latency = latency * 9 / 10;
+		if (latency < RT_AUDIO_MIN_LATENCY) latency = RT_AUDIO_MIN_LATENCY;
+		data->private->audio.tuner.stable = 0;
+	}
+	if (latency == data->private->audio.tuner.latency)
+		return;
+	
+	// Emulation thread keeps pushing into ring buffer while device is
+	// reconfigured. New value is reported by rt_audio_report_latency
+	if (0 == data->private->audio.backend->set_latency(data, latency)) {
+		LOG(RETRO_LOG_DEBUG, "Audio latency changed to %ums", latency / 1000);
+		__atomic_store_n(&data->private->audio.tuner.latency, latency, __ATOMIC_RELAXED);
+		__atomic_store_n(&data->private->audio.tuner.changed, true, __ATOMIC_RELEASE);
+	}
+}
+
+
+/**
+ * Audio thread. Takes whatever is in ring buffer and writes it to audio
+ * device, blocking as needed. Emulation thread is never blocked by this.
+ */
+static void* rt_audio_thread_main(void* arg) {
+	LibraryData* data = (LibraryData*)arg;
+	size_t mask = data->private->audio.ring.size - 1;
+	
+	while (!__atomic_load_n(&data->private->audio.quit, __ATOMIC_ACQUIRE)) {
+		if (data->private->audio.backend->set_latency != NULL)
+			rt_audio_tune_latency(data);
+		size_t head = __atomic_load_n(&data->private->audio.ring.head, __ATOMIC_ACQUIRE);
+		size_t tail = data->private->audio.ring.tail;
+		if (head == tail) {
+			// Woken up by rt_audio_push or rt_audio_thread_stop
+			pthread_mutex_lock(&data->private->audio.lock);
+			while ((__atomic_load_n(&data->private->audio.ring.head, __ATOMIC_ACQUIRE) == tail)
+					&& !__atomic_load_n(&data->private->audio.quit, __ATOMIC_ACQUIRE))
+				pthread_cond_wait(&data->private->audio.cond, &data->private->audio.lock);
+			pthread_mutex_unlock(&data->private->audio.lock);
+			continue;
+		}
+		
+		size_t offset = tail & mask;
+		size_t count = head - tail;
+		if (count > data->private->audio.ring.size - offset)
+			count = data->private->audio.ring.size - offset;
+		if (count > RT_AUDIO_CHUNK)
+			count = RT_AUDIO_CHUNK;
+		
+		uint64_t trace = rt_trace_begin(data);
+		ssize_t r = data->private->audio.backend->write(data,
+				data->private->audio.ring.data + (2 * offset), count);
+		rt_trace_end(data, "audio_write", trace);
+		if (r <= 0)
+			continue;
+		__atomic_store_n(&data->private->audio.ring.tail, tail + r, __ATOMIC_RELEASE);
+	}
+	return NULL;
+}
+
+
+static void rt_audio_thread_stop(LibraryData* data) {
+	if (data->private->audio.thread_running) {
+		pthread_mutex_lock(&data->private->audio.lock);
+		__atomic_store_n(&data->private->audio.quit, true, __ATOMIC_RELEASE);
+		pthread_cond_signal(&data->private->audio.cond);
+		pthread_mutex_unlock(&data->private->audio.lock);
+		pthread_join(data->private->audio.thread, NULL);
+		data->private->audio.thread_running = false;
+		pthread_cond_destroy(&data->private->audio.cond);
+		pthread_mutex_destroy(&data->private->audio.lock);
+	}
+}
+
+
+static int rt_audio_thread_start(LibraryData* data) {
+	data->private->audio.quit = false;
+	pthread_mutex_init(&data->private->audio.lock, NULL);
+	pthread_cond_init(&data->private->audio.cond, NULL);
+	if (0 != pthread_create(&data->private->audio.thread, NULL, rt_audio_thread_main, data)) {
+		pthread_cond_destroy(&data->private->audio.cond);
+		pthread_mutex_destroy(&data->private->audio.lock);
+		return 1;
+	}
+	data->private->audio.thread_running = true;
+	return 0;
+}
+
+
+static const struct AudioBackend* rt_audio_find_backend(const char* name) {
+	for (const struct AudioBackend* b=rt_audio_backends; b->name != NULL; b++)
+		if (strcmp(b->name, name) == 0)
+			return b;
+	return NULL;
+}
+
+
+int rt_audio_init(LibraryData* data, int frequency) {
+	const struct AudioBackend* backend;
+	
+	if (frequency == data->private->audio.frequency)
 		return 0;
+	if (data->private->audio.backend == NULL)
+		data->private->audio.backend = data->headless ? rt_audio_find_backend("null") : &rt_audio_backends[0];
+	backend = data->private->audio.backend;
+	
+	rt_audio_thread_stop(data);
+	data->private->audio.active = false;
+	data->private->audio.ring.head = data->private->audio.ring.tail = 0;
+	data->private->audio.pending.used = 0;
+	data->private->audio.position = 0;
+	data->private->audio.last[0] = data->private->audio.last[1] = 0;
+	data->private->audio.ratio = 1.0;
+	if (data->private->audio.tuner.latency == 0)
+		data->private->audio.tuner.latency = RT_AUDIO_LATENCY;
+	if (data->private->audio.ring.data == NULL) {
+		data->private->audio.ring.data = malloc(2 * sizeof(int16_t) * RT_AUDIO_RING_SIZE);
+		data->private->audio.pending.data = malloc(2 * sizeof(int16_t) * RT_AUDIO_PENDING);
+		if ((data->private->audio.ring.data == NULL) || (data->private->audio.pending.data == NULL)) {
+			LOG(RETRO_LOG_ERROR, "Failed to allocate audio buffer: Out of memory");
+			rt_set_error(data, "Failed to configure audio device");
+			return 1;
+		}
+		data->private->audio.ring.size = RT_AUDIO_RING_SIZE;
+		data->private->audio.pending.size = RT_AUDIO_PENDING;
 	}
 	
-	return r;
-#else
+	if (0 != backend->open(data, frequency)) {
+		rt_set_error(data, "Failed to configure audio device");
+		return 1;
+	}
+	data->private->audio.frequency = frequency;
+	if (backend->threaded && (0 != rt_audio_thread_start(data))) {
+		LOG(RETRO_LOG_ERROR, "Failed to start audio thread");
+		rt_set_error(data, "Failed to configure audio device");
+		return 1;
+	}
+	data->private->audio.active = (backend->write != NULL);
+	LOG(RETRO_LOG_DEBUG, "Audio backend '%s' configured for %iHz", backend->name, frequency);
+	return 0;
+}
+
+
+void rt_audio_close(LibraryData* data) {
+	rt_audio_thread_stop(data);
+	data->private->audio.active = false;
+	data->private->audio.frequency = 0;
+	if ((data->private->audio.backend != NULL) && (data->private->audio.backend->close != NULL))
+		data->private->audio.backend->close(data);
+}
+
+
+int rt_audio_set_backend(LibraryData* data, const char* name, const char* filename) {
+	const struct AudioBackend* backend = rt_audio_find_backend(name);
+	int frequency = data->private->audio.frequency;
+	if (backend == NULL) {
+		LOG(RETRO_LOG_ERROR, "Unknown audio backend '%s'", name);
+		return 1;
+	}
+	
+	rt_audio_close(data);
+	free(data->private->audio.filename);
+	data->private->audio.filename = (filename == NULL) ? NULL : strdup(filename);
+	data->private->audio.backend = backend;
+	LOG(RETRO_LOG_DEBUG, "Audio backend set to '%s'", name);
+	if (frequency != 0)
+		// Already running, reopened right away
+		return rt_audio_init(data, frequency);
+	return 0;
+}
+
+
+void rt_audio_set_latency(LibraryData* data, int latency) {
+	if (latency < RT_AUDIO_MIN_LATENCY) latency = RT_AUDIO_MIN_LATENCY;
+	if (latency > RT_AUDIO_MAX_LATENCY) latency = RT_AUDIO_MAX_LATENCY;
+	__atomic_store_n(&data->private->audio.tuner.latency, latency, __ATOMIC_RELAXED);
+}
+
+
+void rt_audio_report_latency(LibraryData* data) {
+	if (__atomic_exchange_n(&data->private->audio.tuner.changed, false, __ATOMIC_ACQUIRE))
+		data->cb_audio_latency_changed(__atomic_load_n(&data->private->audio.tuner.latency, __ATOMIC_RELAXED));
+}
+
+
+void rt_audio_get_stats(LibraryData* data, AudioStats* stats) {
+	size_t head = __atomic_load_n(&data->private->audio.ring.head, __ATOMIC_ACQUIRE);
+	size_t tail = __atomic_load_n(&data->private->audio.ring.tail, __ATOMIC_ACQUIRE);
+	stats->capacity = data->private->audio.ring.size;
+	stats->fill = head - tail;
+	stats->underruns = __atomic_load_n(&data->private->audio.underruns, __ATOMIC_RELAXED);
+	stats->overruns = data->private->audio.overruns;
+	stats->latency = __atomic_load_n(&data->private->audio.tuner.latency, __ATOMIC_RELAXED);
+	stats->ratio = data->private->audio.ratio;
+	stats->frame_samples_mean = (data->private->audio.flushes == 0) ? 0 :
+		(double)data->private->audio.flushed / data->private->audio.flushes;
+	stats->frame_samples_last = data->private->audio.last_flushed;
+	stats->frame_samples_max = data->private->audio.max_flushed;
+}
+
+
+/**
+ * Returns number of frames rate control keeps in ring buffer. It's same
+ * amount as audio device buffers, as set by tuner, so buffering grows only
+ * when device needs it. Never less than single chunk.
+ */
+static size_t rt_audio_fill_target(LibraryData* data) {
+	uint64_t latency = __atomic_load_n(&data->private->audio.tuner.latency, __ATOMIC_RELAXED);
+	size_t target = latency * data->private->audio.frequency / 1000000;
+	if (target < RT_AUDIO_CHUNK) target = RT_AUDIO_CHUNK;
+	if (target > data->private->audio.ring.size / 2) target = data->private->audio.ring.size / 2;
+	return target;
+}
+
+
+/**
+ * Resamples frames with linear interpolation and stores them into ring buffer.
+ * Resampling ratio is adjusted by up to RT_AUDIO_MAX_SKEW depending on how
+ * far the ring buffer is from fill target, so it slowly drifts back to it no
+ * matter if audio device or core clock is faster.
+ */
+static void rt_audio_push(LibraryData* data, const int16_t* audiodata, size_t frames) {
+	size_t size = data->private->audio.ring.size;
+	size_t mask = size - 1;
+	size_t head = data->private->audio.ring.head;
+	size_t tail = __atomic_load_n(&data->private->audio.ring.tail, __ATOMIC_ACQUIRE);
+	int16_t* ring = data->private->audio.ring.data;
+	double target = rt_audio_fill_target(data);
+	double error = (target - (double)(head - tail)) / target;
+	if (error < -1.0) error = -1.0;
+	double ratio = 1.0 + RT_AUDIO_MAX_SKEW * error;
+	double step = 1.0 / ratio;
+	double position = data->private->audio.position;
+	int16_t* last = data->private->audio.last;
+	
+	for (size_t i=0; i<frames; i++) {
+		const int16_t* frame = audiodata + (2 * i);
+		while (position < 1.0) {
+			if (head - tail >= size) {
+				data->private->audio.overruns ++;
+			} else {
+				int16_t* target = ring + (2 * (head & mask));
+				target[0] = last[0] + (int16_t)((frame[0] - last[0]) * position);
+				target[1] = last[1] + (int16_t)((frame[1] - last[1]) * position);
+				head ++;
+			}
+			position += step;
+		}
+		position -= 1.0;
+		last[0] = frame[0];
+		last[1] = frame[1];
+	}
+	
+	data->private->audio.position = position;
+	data->private->audio.ratio = ratio;
+	pthread_mutex_lock(&data->private->audio.lock);
+	__atomic_store_n(&data->private->audio.ring.head, head, __ATOMIC_RELEASE);
+	pthread_cond_signal(&data->private->audio.cond);
+	pthread_mutex_unlock(&data->private->audio.lock);
+}
+
+
+/**
+ * Sends frames to audio thread or, for backends that don't need one, writes
+ * them directly, without resampling. Such backends never block, so
+ * emulation is then paced only by frame pacer.
+ */
+static void rt_audio_output(LibraryData* data, const int16_t* frames, size_t count) {
+	if (data->private->audio.backend->threaded)
+		rt_audio_push(data, frames, count);
+	else
+		data->private->audio.backend->write(data, frames, count);
+}
+
+
+void rt_audio_flush(LibraryData* data) {
+	size_t used = data->private->audio.pending.used;
+	if (data->private->discard_audio || !data->private->audio.active)
+		return;
+	data->private->audio.flushes ++;
+	data->private->audio.flushed += used;
+	data->private->audio.last_flushed = used;
+	if (used > data->private->audio.max_flushed)
+		data->private->audio.max_flushed = used;
+	if (used > 0) {
+		rt_audio_output(data, data->private->audio.pending.data, used);
+		data->private->audio.pending.used = 0;
+	}
+}
+
+
+size_t rt_audio_sample_batch(LibraryData* data, const int16_t* audiodata, size_t frames) {
+	if (data->private->discard_audio || !data->private->audio.active)
+		return frames;
+	
+	size_t used = data->private->audio.pending.used;
+	if (used + frames > data->private->audio.pending.size) {
+		// Core generates way more than expected. Not enough space to collect
+		// all of it, so it's just sent as it comes
+		if (used > 0)
+			rt_audio_output(data, data->private->audio.pending.data, used);
+		data->private->audio.pending.used = 0;
+		rt_audio_output(data, audiodata, frames);
+		return frames;
+	}
+	memcpy(data->private->audio.pending.data + (2 * used), audiodata, 2 * sizeof(int16_t) * frames);
+	data->private->audio.pending.used = used + frames;
 	return frames;
-#endif
 }
 
 
 void rt_audio_sample(LibraryData* data, int16_t left, int16_t right) {
-	int16_t buf[2] = {left, right};
-	rt_audio_sample_batch(data, buf, 1);
+	size_t used = data->private->audio.pending.used;
+	if (data->private->discard_audio || !data->private->audio.active)
+		return;
+	if (used >= data->private->audio.pending.size) {
+		int16_t buf[2] = {left, right};
+		rt_audio_sample_batch(data, buf, 1);
+		return;
+	}
+	data->private->audio.pending.data[2 * used + 0] = left;
+	data->private->audio.pending.data[2 * used + 1] = right;
+	data->private->audio.pending.used = used + 1;
 }
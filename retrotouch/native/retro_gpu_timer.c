@@ -0,0 +1,132 @@
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#define GL_GLEXT_PROTOTYPES 1
+#include <GL/gl.h>
+#include <GL/glx.h>
+#include <GL/glext.h>
+#include <retrotouch.h>
+
+#define LOG(...) rt_log(data, "RGpuTimer", __VA_ARGS__)
+
+/**
+ * GPU timing. Every measured pass is surrounded by pair of GL_TIMESTAMP
+ * queries. Every pass has its own ring of query pairs and results are
+ * read only once they are available, so waiting for GPU never stalls
+ * rendering. If all pairs are still in flight, pass is simply not
+ * measured. Results are aggregated into one-second windows.
+ *
+ * All of this runs on thread that owns GL context, except for
+ * rt_gpu_timer_get_stats, which reads last window under seqlock.
+ */
+
+typedef void (*glQueryCounter_t)(GLuint id, GLenum target);
+typedef void (*glGetQueryObjectui64v_t)(GLuint id, GLenum pname, GLuint64* params);
+static glQueryCounter_t glQueryCounter_ = NULL;
+static glGetQueryObjectui64v_t glGetQueryObjectui64v_ = NULL;
+
+
+void rt_gpu_timer_enable(LibraryData* data, int enabled) {
+	data->private->gpu_timer.enabled = (enabled != 0);
+	LOG(RETRO_LOG_DEBUG, "GPU timer %s", enabled ? "enabled" : "disabled");
+}
+
+
+/** Checks for ARB_timer_query. Returns false if it's not available */
+static bool rt_gpu_timer_probe(LibraryData* data) {
+	if (!data->private->gpu_timer.probed) {
+		const char* extensions = (const char*)glGetString(GL_EXTENSIONS);
+		data->private->gpu_timer.probed = true;
+		if ((extensions != NULL) && (strstr(extensions, "GL_ARB_timer_query") != NULL)) {
+			glQueryCounter_ = (glQueryCounter_t)glXGetProcAddress((const GLubyte*)"glQueryCounter");
+			glGetQueryObjectui64v_ = (glGetQueryObjectui64v_t)glXGetProcAddress((const GLubyte*)"glGetQueryObjectui64v");
+		}
+		if ((glQueryCounter_ == NULL) || (glGetQueryObjectui64v_ == NULL))
+			LOG(RETRO_LOG_WARN, "GPU timer not available: ARB_timer_query not supported");
+	}
+	return (glQueryCounter_ != NULL) && (glGetQueryObjectui64v_ != NULL);
+}
+
+
+/** Reads results that are already available and closes window when it's time */
+static void rt_gpu_timer_collect(LibraryData* data, enum GpuPass pass) {
+	struct GpuPassTimer* p = &data->private->gpu_timer.passes[pass];
+	while (p->pending[p->oldest]) {
+		GLint available = 0;
+		GLuint64 begin, end;
+		glGetQueryObjectiv(p->queries[p->oldest][1], GL_QUERY_RESULT_AVAILABLE, &available);
+		if (!available)
+			break;
+		glGetQueryObjectui64v_(p->queries[p->oldest][0], GL_QUERY_RESULT, &begin);
+		glGetQueryObjectui64v_(p->queries[p->oldest][1], GL_QUERY_RESULT, &end);
+		p->pending[p->oldest] = false;
+		p->oldest = (p->oldest + 1) % RT_GPU_QUERY_FRAMES;
+	
+		double time = (end > begin) ? (double)(end - begin) / 1000.0 : 0.0;
+		if ((p->samples == 0) || (time < p->min))
+			p->min = time;
+		if ((p->samples == 0) || (time > p->max))
+			p->max = time;
+		p->sum += time;
+		p->samples ++;
+	}
+	
+	uint64_t now = rt_get_time();
+	if (now >= p->since + 1000000) {
+		__atomic_store_n(&p->seq, p->seq + 1, __ATOMIC_RELAXED);
+		// Odd counter has to be visible before 'last' changes
+		__atomic_thread_fence(__ATOMIC_RELEASE);
+		p->last.samples = p->samples;
+		p->last.skipped = p->skipped;
+		p->last.min = p->min;
+		p->last.mean = (p->samples > 0) ? p->sum / p->samples : 0.0;
+		p->last.max = p->max;
+		__atomic_store_n(&p->seq, p->seq + 1, __ATOMIC_RELEASE);
+		p->samples = 0;
+		p->skipped = 0;
+		p->sum = p->min = p->max = 0.0;
+		p->since = now;
+	}
+}
+
+
+void rt_gpu_timer_begin(LibraryData* data, enum GpuPass pass) {
+	struct GpuPassTimer* p = &data->private->gpu_timer.passes[pass];
+	if (!data->private->gpu_timer.enabled || !rt_gpu_timer_probe(data))
+		return;
+	if (p->queries[0][0] == 0)
+		glGenQueries(2 * RT_GPU_QUERY_FRAMES, &p->queries[0][0]);
+	rt_gpu_timer_collect(data, pass);
+	if (p->pending[p->next]) {
+		// Every query is still in flight, waiting for one would stall
+		p->skipped ++;
+		return;
+	}
+	glQueryCounter_(p->queries[p->next][0], GL_TIMESTAMP);
+	p->active = true;
+}
+
+
+void rt_gpu_timer_end(LibraryData* data, enum GpuPass pass) {
+	struct GpuPassTimer* p = &data->private->gpu_timer.passes[pass];
+	if (!p->active)
+		return;
+	glQueryCounter_(p->queries[p->next][1], GL_TIMESTAMP);
+	p->active = false;
+	p->pending[p->next] = true;
+	p->next = (p->next + 1) % RT_GPU_QUERY_FRAMES;
+}
+
+
+void rt_gpu_timer_get_stats(LibraryData* data, GpuTimerStats* stats) {
+	for (int i=0; i<GPU_PASSES; i++) {
+		struct GpuPassTimer* p = &data->private->gpu_timer.passes[i];
+		uint seq;
+		// Window is closed only once per second, so retrying is rare
+		do {
+			seq = __atomic_load_n(&p->seq, __ATOMIC_ACQUIRE);
+			stats[i] = p->last;
+			__atomic_thread_fence(__ATOMIC_ACQUIRE);
+		} while ((seq & 1) || (seq != __atomic_load_n(&p->seq, __ATOMIC_RELAXED)));
+	}
+}
@@ -0,0 +1,264 @@
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#define GL_GLEXT_PROTOTYPES 1
+#include <GL/gl.h>
+#include <GL/glx.h>
+#include <GL/glext.h>
+#include <retrotouch.h>
+#include <gltools.h>
+
+#define LOG(...) rt_log(data, "RHud", __VA_ARGS__)
+
+/**
+ * Performance HUD. Time spent in every phase of frame is collected all
+ * the time, overlay showing it is drawn at end of rt_render only while
+ * 'show_hud' is set in shared data.
+ *
+ * Everything is drawn as colored rectangles in "HUD pixels", text
+ * included. One HUD pixel is RT_HUD_PIXEL_SIZE pixels of window.
+ */
+
+#define HUD_MARGIN			4
+#define HUD_WIDTH			(RT_HUD_HISTORY + 2 * HUD_MARGIN)
+#define HUD_LINE_HEIGHT		7
+#define HUD_GRAPH_HEIGHT	48
+
+// 3x5 font. Every octal digit is one row, top row first
+static const uint16_t font_digits[] = {
+	075557, 026227, 071747, 071717, 055711, 074717, 074757, 071111, 075757, 075717,
+};
+static const uint16_t font_letters[] = {
+	025755, 065656, 034443, 065556, 074647, 074644, 034553, 055755, 072227, 011152,
+	055655, 044447, 057755, 065555, 025552, 065644, 025563, 065655, 034216, 072222,
+	055557, 055552, 055775, 055255, 055222, 071247,
+};
+
+static const GLfloat phase_colors[HUD_PHASES][4] = {
+	{ 0.3, 0.6, 1.0, 1.0 },		// HUD_CORE
+	{ 0.3, 1.0, 0.3, 1.0 },		// HUD_UPLOAD
+	{ 1.0, 0.9, 0.2, 1.0 },		// HUD_RENDER
+	{ 1.0, 0.3, 1.0, 1.0 },		// HUD_SWAP
+};
+static const char* phase_names[HUD_PHASES] = { "CORE", "UPL", "RND", "SWP" };
+static const GLfloat color_text[] = { 1.0, 1.0, 1.0, 1.0 };
+static const GLfloat color_warning[] = { 1.0, 0.3, 0.3, 1.0 };
+static const GLfloat color_background[] = { 0.0, 0.0, 0.0, 0.6 };
+static const GLfloat color_dim[] = { 1.0, 1.0, 1.0, 0.3 };
+
+
+void rt_hud_add_time(LibraryData* data, enum HudPhase phase, uint64_t time) {
+	__atomic_add_fetch(&data->private->hud.current[phase], time, __ATOMIC_RELAXED);
+}
+
+
+void rt_hud_add_frames(LibraryData* data, unsigned int emulated, unsigned int skipped) {
+	data->private->hud.emulated += emulated;
+	data->private->hud.skipped += skipped;
+}
+
+
+void rt_hud_frame_duplicated(LibraryData* data) {
+	data->private->hud.duplicated ++;
+}
+
+
+void rt_hud_end_frame(LibraryData* data) {
+	// History may be read by video thread while it's being written here.
+	// Worst case is one bar of graph drawn wrong
+	uint64_t* frame = data->private->hud.history[data->private->hud.next];
+	for (int i=0; i<HUD_PHASES; i++)
+		frame[i] = __atomic_exchange_n(&data->private->hud.current[i], 0, __ATOMIC_RELAXED);
+	if (!data->private->video_thread.enabled) {
+		// Without video thread, frame is uploaded while core is running
+		frame[HUD_CORE] -= (frame[HUD_UPLOAD] < frame[HUD_CORE]) ? frame[HUD_UPLOAD] : frame[HUD_CORE];
+	}
+	data->private->hud.next = (data->private->hud.next + 1) % RT_HUD_HISTORY;
+	
+	uint64_t now = rt_get_time();
+	if (now >= data->private->hud.since + 1000000) {
+		uint64_t dropped = data->private->video_thread.dropped;
+		if (data->private->hud.since > 0) {
+			double delta = (double)(now - data->private->hud.since) / 1000000.0;
+			data->private->hud.fps = data->private->hud.emulated / delta;
+			data->private->hud.skipped_rate = (data->private->hud.skipped
+					+ dropped - data->private->hud.dropped) / delta;
+			data->private->hud.duplicated_rate = data->private->hud.duplicated / delta;
+		}
+		data->private->hud.since = now;
+		data->private->hud.emulated = 0;
+		data->private->hud.skipped = 0;
+		data->private->hud.duplicated = 0;
+		data->private->hud.dropped = dropped;
+	}
+	
+	if (data->shared_data->show_hud)
+		rt_damage(data);
+}
+
+
+void rt_get_frame_times(LibraryData* data, FrameTimes* times) {
+	uint64_t* frame = data->private->hud.history[
+		(data->private->hud.next + RT_HUD_HISTORY - 1) % RT_HUD_HISTORY];
+	times->core = frame[HUD_CORE];
+	times->upload = frame[HUD_UPLOAD];
+	times->render = frame[HUD_RENDER];
+	times->swap = frame[HUD_SWAP];
+}
+
+
+void rt_hud_setup(LibraryData* data) {
+	static const char* defines[] = { NULL };
+	char* shader_name = malloc(strlen(data->res_path) + 100);
+	if (shader_name == NULL) {
+		LOG(RETRO_LOG_WARN, "Failed to set up HUD: Out of memory");
+		return;
+	}
+	strcpy(shader_name, data->res_path);
+	strcat(shader_name, "/hud");
+	if (0 != load_shader_program(shader_name, defines, &(data->private->gl.prog_hud.id))) {
+		free(shader_name);
+		data->private->gl.prog_hud.id = 0;
+		LOG(RETRO_LOG_WARN, "Failed to set up HUD: Failed to compile shaders");
+		return;
+	}
+	free(shader_name);
+	data->private->gl.prog_hud.u_window_size = glGetUniformLocation(data->private->gl.prog_hud.id, "window_size");
+	GLuint pos = glGetAttribLocation(data->private->gl.prog_hud.id, "v_position");
+	GLuint color = glGetAttribLocation(data->private->gl.prog_hud.id, "v_color");
+	
+	glGenVertexArrays(1, &data->private->hud.vao);
+	glBindVertexArray(data->private->hud.vao);
+	glGenBuffers(1, &data->private->hud.vbo);
+	glBindBuffer(GL_ARRAY_BUFFER, data->private->hud.vbo);
+	glEnableVertexAttribArray(pos);
+	glVertexAttribPointer(pos, 2, GL_FLOAT, GL_FALSE, sizeof(struct HudVertex), 0);
+	glEnableVertexAttribArray(color);
+	glVertexAttribPointer(color, 4, GL_FLOAT, GL_FALSE, sizeof(struct HudVertex),
+							(void*)(sizeof(GLfloat) * 2));
+	glBindBuffer(GL_ARRAY_BUFFER, 0);
+	glBindVertexArray(0);
+	LOG(RETRO_LOG_DEBUG, "HUD set up");
+}
+
+
+static void hud_rect(LibraryData* data, float x, float y, float width, float height, const GLfloat color[4]) {
+	static const float corners[6][2] = { {0, 0}, {0, 1}, {1, 1}, {1, 1}, {1, 0}, {0, 0} };
+	float pixel = RT_HUD_PIXEL_SIZE * data->shared_data->scale_factor;
+	if (data->private->hud.vertex_count + 6 > RT_HUD_MAX_VERTICES)
+		return;
+	for (int i=0; i<6; i++) {
+		struct HudVertex* v = &data->private->hud.vertices[data->private->hud.vertex_count++];
+		v->position[0] = (x + corners[i][0] * width) * pixel;
+		v->position[1] = (y + corners[i][1] * height) * pixel;
+		memcpy(v->color, color, sizeof(v->color));
+	}
+}
+
+
+static uint16_t hud_glyph(char c) {
+	if ((c >= '0') && (c <= '9'))
+		return font_digits[c - '0'];
+	if ((c >= 'A') && (c <= 'Z'))
+		return font_letters[c - 'A'];
+	switch (c) {
+		case '.': return 000002;
+		case '/': return 011244;
+		case ':': return 002020;
+		case '%': return 051245;
+		case '-': return 000700;
+		default:  return 0;
+	}
+}
+
+
+/** Draws text and returns x coordinate where it ended */
+static float hud_text(LibraryData* data, float x, float y, const GLfloat color[4], const char* text) {
+	for (; *text != 0; text++, x += 4) {
+		uint16_t glyph = hud_glyph(*text);
+		for (int row=0; row<5; row++)
+			for (int col=0; col<3; col++)
+				if (glyph & (1 << ((4 - row) * 3 + (2 - col))))
+					hud_rect(data, x + col, y + row, 1, 1, color);
+	}
+	return x;
+}
+
+
+static void hud_graph(LibraryData* data, float x, float y) {
+	// Graph shows up to two target frame times, so line at half height is budget
+	double target = (data->private->gl.target_frame_time > 0) ? data->private->gl.target_frame_time : 16667;
+	double scale = HUD_GRAPH_HEIGHT / (2.0 * target);
+	hud_rect(data, x, y + HUD_GRAPH_HEIGHT / 2, RT_HUD_HISTORY, 0.5, color_dim);
+	for (size_t i=0; i<RT_HUD_HISTORY; i++) {
+		uint64_t* frame = data->private->hud.history[(data->private->hud.next + i) % RT_HUD_HISTORY];
+		float bottom = y + HUD_GRAPH_HEIGHT;
+		for (int p=0; p<HUD_PHASES; p++) {
+			float height = frame[p] * scale;
+			if (height > bottom - y)
+				height = bottom - y;
+			if (height > 0) {
+				bottom -= height;
+				hud_rect(data, x + i, bottom, 1, height, phase_colors[p]);
+			}
+		}
+	}
+}
+
+
+void rt_hud_render(LibraryData* data) {
+	char buffer[64];
+	AudioStats audio;
+	float x = HUD_MARGIN, y = HUD_MARGIN;
+	double target = (data->private->gl.target_frame_time > 0) ? 1000000.0 / data->private->gl.target_frame_time : 0;
+	if (data->private->gl.prog_hud.id == 0)
+		return;
+	
+	data->private->hud.vertex_count = 0;
+	hud_rect(data, 0, 0, HUD_WIDTH,
+		3 * HUD_LINE_HEIGHT + HUD_GRAPH_HEIGHT + HUD_LINE_HEIGHT + 2 * HUD_MARGIN, color_background);
+	
+	// Emulated fps versus target
+	snprintf(buffer, sizeof(buffer), "FPS %.1f/%.1f", data->private->hud.fps, target);
+	hud_text(data, x, y,
+		(!data->private->paused && (data->private->hud.fps < target * 0.95)) ? color_warning : color_text,
+		buffer);
+	y += HUD_LINE_HEIGHT;
+	
+	// Frames emulated but never shown & frames core asked to show again
+	snprintf(buffer, sizeof(buffer), "SKIP %.0f DUP %.0f",
+		data->private->hud.skipped_rate, data->private->hud.duplicated_rate);
+	hud_text(data, x, y, color_text, buffer);
+	y += HUD_LINE_HEIGHT;
+	
+	// Audio buffer fill
+	rt_audio_get_stats(data, &audio);
+	float bar_x = hud_text(data, x, y, color_text, "AUDIO") + 2;
+	float bar_width = HUD_WIDTH - HUD_MARGIN - bar_x;
+	hud_rect(data, bar_x, y, bar_width, 5, color_dim);
+	if (audio.capacity > 0) {
+		float fill = (float)audio.fill / audio.capacity;
+		hud_rect(data, bar_x, y, bar_width * (fill < 1.0 ? fill : 1.0), 5,
+			(fill < 0.125) ? color_warning : phase_colors[HUD_UPLOAD]);
+	}
+	y += HUD_LINE_HEIGHT;
+	
+	// Frame time graph with legend
+	hud_graph(data, x, y);
+	y += HUD_GRAPH_HEIGHT + 2;
+	for (int p=0; p<HUD_PHASES; p++)
+		x = hud_text(data, x, y, phase_colors[p], phase_names[p]) + 4;
+	
+	glEnable(GL_BLEND);
+	glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA);
+	glUseProgram(data->private->gl.prog_hud.id);
+	glUniform2fv(data->private->gl.prog_hud.u_window_size, 1, data->private->gl.window_size);
+	glBindVertexArray(data->private->hud.vao);
+	glBindBuffer(GL_ARRAY_BUFFER, data->private->hud.vbo);
+	glBufferData(GL_ARRAY_BUFFER, data->private->hud.vertex_count * sizeof(struct HudVertex),
+		data->private->hud.vertices, GL_STREAM_DRAW);
+	glDrawArrays(GL_TRIANGLES, 0, data->private->hud.vertex_count);
+	glBindBuffer(GL_ARRAY_BUFFER, 0);
+	glBindVertexArray(0);
+	glUseProgram(0);
+}
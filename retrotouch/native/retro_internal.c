@@ -1,5 +1,6 @@
 #include <stdlib.h>
 #include <stdio.h>
+#include <string.h>
 #include <dlfcn.h>
 #define GL_GLEXT_PROTOTYPES 1
 #include <GL/gl.h>
@@ -13,6 +14,44 @@ struct CoreData {
 	bool initialized;
 	bool game_loaded;
 	char* save_state;
+	uint64_t frames;
+	
+	// Input as seen by core during current frame
+	struct InputState input;
+	bool input_polled;
+	struct {
+		uint dropped;				// Last seen value of input_queue.dropped
+		uint64_t events;
+		uint64_t deferred;
+		uint64_t age_last;
+		uint64_t age_max;
+	} input_queue;
+	
+	struct {
+		unsigned int frames;		// Number of frames to run ahead, 0 if disabled
+		char* state;
+		size_t size;
+	} run_ahead;
+	
+	struct {
+		char* history;				// Ring buffer with delta-compressed snapshots
+		size_t budget;				// Size of 'history'
+		size_t head;				// Where next snapshot is written
+		size_t tail;				// Where oldest snapshot begins
+		size_t used;
+		uint64_t entries;
+		char* state;				// Latest snapshot, uncompressed
+		char* scratch;				// Newly taken snapshot
+		char* delta;				// Encoded delta between two snapshots
+		size_t size;				// Size of single uncompressed snapshot
+		bool has_state;
+		bool rewinding;
+		unsigned int interval;
+		unsigned int steps;			// Frames presented since snapshot was restored
+		uint64_t captures;
+		uint64_t capture_time_total;
+		uint64_t capture_time_max;
+	} rewind;
 	
 	void (*retro_init)(void);
 	void (*retro_deinit)(void);
@@ -55,19 +94,10 @@ static retro_proc_address_t video_driver_get_proc_address(const char *sym) {
 
 
 static void core_log(enum retro_log_level level, const char *fmt, ...) {
-	char buffer[4096] = {0};
 	va_list va;
 	va_start(va, fmt);
-	int len = vsnprintf(buffer, sizeof(buffer), fmt, va);
+	rt_logv(current, "Core", level, fmt, va);
 	va_end(va);
-	buffer[sizeof(buffer) - 1] = 0;
-	// Strip \n that some cores tend to add
-	while ((len > 1) && (buffer[len - 1] == '\n')) {
-		buffer[len - 1] = 0;
-		len --;
-	}
-	
-	current->cb_log("Core", (int)level, buffer);
 }
 
 
@@ -76,8 +106,11 @@ static bool video_set_pixel_format(unsigned format) {
 		if (current->private->gl.prog_normal.id != 0) { \
 			if (strcmp(old_colorspace, current->private->gl.colorspace) != 0) { \
 				LOG(RETRO_LOG_WARN, "Pixel format changed after shaders were generated. Regenerating shaders..."); \
+				bool threaded = current->private->video_thread.enabled; \
+				rt_set_threaded_video(current, 0); \
 				rt_compile_shaders(current); \
 				rt_setup_texture(current); \
+				rt_set_threaded_video(current, threaded); \
 			} \
 		}
 	const char* old_colorspace = current->private->gl.colorspace;
@@ -228,8 +261,92 @@ static void core_video_refresh(const void* frame, unsigned width, unsigned heigh
 }
 
 
+/**
+ * Applies button changes queued by GUI on top of snapshot. Every button
+ * changes at most once per frame, so press that was released before frame
+ * started is still seen as pressed for one frame; release is then applied
+ * on next frame.
+ */
+static void core_input_drain(uint* buttons, uint* mouse_buttons) {
+	struct SharedData* shared = current->shared_data;
+	uint head = __atomic_load_n(&shared->input_queue.head, __ATOMIC_ACQUIRE);
+	uint tail = shared->input_queue.tail;
+	uint dropped = __atomic_load_n(&shared->input_queue.dropped, __ATOMIC_RELAXED);
+	uint changed[2] = { 0, 0 };
+	uint* targets[2] = { buttons, mouse_buttons };
+	
+	if (dropped != current->core->input_queue.dropped) {
+		// Some events were lost, snapshot is used as it is
+		current->core->input_queue.dropped = dropped;
+		__atomic_store_n(&shared->input_queue.tail, head, __ATOMIC_RELEASE);
+		return;
+	}
+	
+	if (tail != head) {
+		uint64_t age = rt_get_time() - shared->input_queue.events[tail % RT_INPUT_QUEUE_SIZE].time;
+		current->core->input_queue.age_last = age;
+		if (age > current->core->input_queue.age_max)
+			current->core->input_queue.age_max = age;
+	}
+	
+	for (; tail != head; tail++) {
+		struct InputEvent* e = &shared->input_queue.events[tail % RT_INPUT_QUEUE_SIZE];
+		if ((e->type > INPUT_EVENT_MOUSE_BUTTON) || (e->index >= 32))
+			continue;
+		uint bit = 1 << e->index;
+		if (changed[e->type] & bit) {
+			current->core->input_queue.deferred ++;
+			break;
+		}
+		changed[e->type] |= bit;
+		if (e->value)
+			*targets[e->type] |= bit;
+		else
+			*targets[e->type] &= ~bit;
+		current->core->input_queue.events ++;
+	}
+	__atomic_store_n(&shared->input_queue.tail, tail, __ATOMIC_RELEASE);
+}
+
+
+/**
+ * Copies consistent snapshot of input state from shared memory.
+ * Done at most once per frame; all retro_run calls done for single frame
+ * (e.g. with run-ahead) see same input.
+ */
 static void core_input_poll(void) {
-	// pass
+	struct SharedData* shared = current->shared_data;
+	struct InputState snapshot;
+	uint seq;
+	
+	if (current->core->input_polled)
+		return;
+	current->core->input_polled = true;
+	for (int i=0; i<RT_INPUT_RETRIES; i++) {
+		seq = __atomic_load_n(&shared->input_seq, __ATOMIC_ACQUIRE);
+		if (seq & 1)
+			// GUI is writing right now
+			continue;
+		memcpy(&snapshot, &shared->input_state, sizeof(struct InputState));
+		__atomic_thread_fence(__ATOMIC_ACQUIRE);
+		if (seq == __atomic_load_n(&shared->input_seq, __ATOMIC_RELAXED)) {
+			core_input_drain(&snapshot.buttons, &snapshot.mouse_buttons);
+			current->core->input = snapshot;
+			rt_latency_input_polled(current, snapshot.time);
+			return;
+		}
+	}
+	// Input from previous frame is kept
+	LOG(RETRO_LOG_WARN, "Failed to read input state");
+}
+
+
+void rt_input_get_stats(LibraryData* data, InputStats* stats) {
+	stats->events = data->core->input_queue.events;
+	stats->deferred = data->core->input_queue.deferred;
+	stats->dropped = data->shared_data->input_queue.dropped;
+	stats->age_last = data->core->input_queue.age_last;
+	stats->age_max = data->core->input_queue.age_max;
 }
 
 static void core_audio_sample(int16_t left, int16_t right) {
@@ -243,17 +360,21 @@ static size_t core_audio_sample_batch(const int16_t* audiodata, size_t frames) {
 
 
 static int16_t core_input_state(unsigned port, unsigned device, unsigned index, unsigned id) {
+	// Some cores are not calling input_poll at all
+	core_input_poll();
+	if (current->private->latency.unread != 0)
+		rt_latency_input_read(current);
 	// TODO: RT_MAX_PORTS
 	if (port == 0) {
 		if (device == RETRO_DEVICE_JOYPAD)
-			return (current->shared_data->input_state.buttons & (1<<id)) ? 1 : 0;
+			return (current->core->input.buttons & (1<<id)) ? 1 : 0;
 		else if ((device == RETRO_DEVICE_ANALOG) && (index < RT_MAX_ANALOGS))
-			return current->shared_data->input_state.analogs[(index * 2) + id];
+			return current->core->input.analogs[(index * 2) + id];
 		else if ((device == RETRO_DEVICE_POINTER) && (index == 0)) {
 			if (id <= RETRO_DEVICE_ID_POINTER_Y)
-				return current->shared_data->input_state.mouse[id];
+				return current->core->input.mouse[id];
 			else if (id == RETRO_DEVICE_ID_POINTER_PRESSED)
-				return (current->shared_data->input_state.mouse_buttons &
+				return (current->core->input.mouse_buttons &
 							(1 << RETRO_DEVICE_ID_MOUSE_LEFT)) == 0 ? 0 : 1;
 		}
 	}
@@ -268,6 +389,8 @@ void rt_core_unload() {
 		if (current->core->handle)
 			dlclose(current->core->handle);
 		
+		free(current->core->run_ahead.state);
+		rt_rewind_setup(current, 0, 0);
 		free(current->core);
 		current->core = NULL;
 	}
@@ -279,18 +402,345 @@ void rt_core_context_reset(LibraryData* data) {
 }
 
 
+int rt_set_run_ahead(LibraryData* data, int frames) {
+	current = data;
+	if (frames < 0) frames = 0;
+	if (frames > RT_MAX_RUN_AHEAD) frames = RT_MAX_RUN_AHEAD;
+	
+	free(data->core->run_ahead.state);
+	data->core->run_ahead.state = NULL;
+	data->core->run_ahead.size = 0;
+	data->core->run_ahead.frames = 0;
+	if (frames == 0) {
+		LOG(RETRO_LOG_DEBUG, "Run-ahead disabled");
+		return 0;
+	}
+	
+	if (!data->core->game_loaded) {
+		LOG(RETRO_LOG_ERROR, "Cannot enable run-ahead: No game loaded");
+		return 1;
+	}
+	// State is never saved between sessions, so SINGLE_SESSION
+	// quirk doesn't matter here
+	if ((data->private->serialization_quirks & RETRO_SERIALIZATION_QUIRK_SINGLE_SESSION) == 0)
+		if (!rt_check_saving_supported(data)) {
+			LOG(RETRO_LOG_WARN, "Cannot enable run-ahead: Saving not supported by core");
+			return 1;
+		}
+	if ((data->private->serialization_quirks & RETRO_SERIALIZATION_QUIRK_MUST_INITIALIZE) != 0)
+		if (data->core->frames == 0) {
+			LOG(RETRO_LOG_WARN, "Cannot enable run-ahead: Core has to run before state can be saved");
+			return 1;
+		}
+	
+	size_t size = data->core->retro_serialize_size();
+	if (size == 0) {
+		LOG(RETRO_LOG_WARN, "Cannot enable run-ahead: Saving not supported by core");
+		return 1;
+	}
+	if ((data->core->run_ahead.state = malloc(size)) == NULL) {
+		LOG(RETRO_LOG_ERROR, "Cannot enable run-ahead: Failed to allocate memory");
+		return 2;
+	}
+	
+	data->core->run_ahead.size = size;
+	data->core->run_ahead.frames = frames;
+	LOG(RETRO_LOG_DEBUG, "Run-ahead enabled, %i frame(s), %lu bytes of state", frames, size);
+	return 0;
+}
+
+
+/**
+ * Runs one frame with audio kept and video thrown away, stores state, then runs
+ * 'run_ahead.frames' more frames with same input, presents last of them and
+ * restores state. Net effect is that core advances by one frame, but what's
+ * presented is what would be visible few frames later.
+ */
+static void rt_core_step_run_ahead(LibraryData* data) {
+	bool discard_audio = data->private->discard_audio;
+	
+	data->private->discard_video = true;
+	data->core->retro_run();
+	if (!data->core->retro_serialize(data->core->run_ahead.state, data->core->run_ahead.size)) {
+		LOG(RETRO_LOG_WARN, "Failed to save state, run-ahead disabled");
+		data->private->discard_video = false;
+		rt_set_run_ahead(data, 0);
+		return;
+	}
+	
+	data->private->discard_audio = true;
+	for (unsigned int i=0; i<data->core->run_ahead.frames; i++) {
+		data->private->discard_video = (i + 1 < data->core->run_ahead.frames);
+		data->core->retro_run();
+	}
+	
+	data->private->discard_audio = discard_audio;
+	if (!data->core->retro_unserialize(data->core->run_ahead.state, data->core->run_ahead.size)) {
+		LOG(RETRO_LOG_WARN, "Failed to load state, run-ahead disabled");
+		rt_set_run_ahead(data, 0);
+	}
+}
+
+
+/**
+ * Encodes XOR of 'a' and 'b' as sequence of chunks, each being 16bit count
+ * of zeroes, 16bit count of literal bytes and literal bytes themselves.
+ * 'target' has to have space for size + (size / 16) + 16 bytes.
+ * Returns size of encoded data.
+ */
+static size_t rewind_delta_encode(const char* a, const char* b, size_t size, char* target) {
+	char* out = target;
+	size_t i = 0;
+	while (i < size) {
+		uint16_t zeroes = 0, literal = 0;
+		while ((i < size) && (zeroes < 0xFFFF) && (a[i] == b[i])) {
+			zeroes ++; i ++;
+		}
+		char* chunk = out;
+		out += 4;
+		while ((i < size) && (literal < 0xFFFF)) {
+			// Short runs of zeroes are cheaper to keep in literal
+			if ((a[i] == b[i]) && (i + 4 <= size) && (memcmp(a + i, b + i, 4) == 0))
+				break;
+			*(out++) = a[i] ^ b[i];
+			literal ++; i ++;
+		}
+		memcpy(chunk, &zeroes, 2);
+		memcpy(chunk + 2, &literal, 2);
+	}
+	return out - target;
+}
+
+
+/** Applies delta encoded by rewind_delta_encode to 'target' */
+static void rewind_delta_apply(const char* delta, size_t delta_size, char* target, size_t size) {
+	const char* end = delta + delta_size;
+	size_t i = 0;
+	while (delta + 4 <= end) {
+		uint16_t zeroes, literal;
+		memcpy(&zeroes, delta, 2);
+		memcpy(&literal, delta + 2, 2);
+		delta += 4;
+		i += zeroes;
+		for (uint16_t j=0; (j < literal) && (i < size); j++)
+			target[i++] ^= *(delta++);
+	}
+}
+
+
+static void rewind_ring_write(LibraryData* data, size_t pos, const void* src, size_t size) {
+	size_t first = data->core->rewind.budget - pos;
+	if (first >= size) {
+		memcpy(data->core->rewind.history + pos, src, size);
+	} else {
+		memcpy(data->core->rewind.history + pos, src, first);
+		memcpy(data->core->rewind.history, (const char*)src + first, size - first);
+	}
+}
+
+
+static void rewind_ring_read(LibraryData* data, size_t pos, void* dst, size_t size) {
+	size_t first = data->core->rewind.budget - pos;
+	if (first >= size) {
+		memcpy(dst, data->core->rewind.history + pos, size);
+	} else {
+		memcpy(dst, data->core->rewind.history + pos, first);
+		memcpy((char*)dst + first, data->core->rewind.history, size - first);
+	}
+}
+
+
+int rt_rewind_setup(LibraryData* data, size_t budget, int interval) {
+	current = data;
+	free(data->core->rewind.history);
+	free(data->core->rewind.state);
+	free(data->core->rewind.scratch);
+	free(data->core->rewind.delta);
+	memset(&data->core->rewind, 0, sizeof(data->core->rewind));
+	if (budget == 0)
+		return 0;
+	
+	if (!rt_check_saving_supported(data)) {
+		LOG(RETRO_LOG_WARN, "Cannot enable rewind: Saving not supported by core");
+		return 1;
+	}
+	size_t size = data->core->retro_serialize_size();
+	data->core->rewind.history = malloc(budget);
+	data->core->rewind.state = malloc(size);
+	data->core->rewind.scratch = malloc(size);
+	data->core->rewind.delta = malloc(size + (size / 16) + 16);
+	if ((data->core->rewind.history == NULL) || (data->core->rewind.state == NULL)
+			|| (data->core->rewind.scratch == NULL) || (data->core->rewind.delta == NULL)) {
+		LOG(RETRO_LOG_ERROR, "Cannot enable rewind: Failed to allocate memory");
+		rt_rewind_setup(data, 0, 0);
+		return 2;
+	}
+	data->core->rewind.budget = budget;
+	data->core->rewind.size = size;
+	data->core->rewind.interval = (interval > 0) ? interval : 1;
+	LOG(RETRO_LOG_DEBUG, "Rewind enabled, %luB of history, snapshot every %u frame(s)",
+			budget, data->core->rewind.interval);
+	return 0;
+}
+
+
+void rt_set_rewinding(LibraryData* data, int rewinding) {
+	data->core->rewind.rewinding = rewinding && (data->core->rewind.budget > 0);
+	// Latest snapshot is shown for whole interval before moving back
+	data->core->rewind.steps = 0;
+}
+
+
+void rt_rewind_get_stats(LibraryData* data, RewindStats* stats) {
+	stats->captures = data->core->rewind.captures;
+	stats->entries = data->core->rewind.entries;
+	stats->used = data->core->rewind.used;
+	stats->budget = data->core->rewind.budget;
+	stats->capture_time_mean = (stats->captures == 0) ? 0 :
+		(double)data->core->rewind.capture_time_total / stats->captures / 1000.0;
+	stats->capture_time_max = (double)data->core->rewind.capture_time_max / 1000.0;
+}
+
+
+/**
+ * Stores delta between current state and latest snapshot into history,
+ * dropping oldest snapshots if there is not enough space.
+ * Nothing is allocated here, all buffers are prepared by rt_rewind_setup.
+ */
+static void rt_rewind_capture(LibraryData* data) {
+	uint64_t start = rt_get_time_ns();
+	char* scratch = data->core->rewind.scratch;
+	size_t size = data->core->rewind.size;
+	
+	if (data->core->retro_serialize_size() != size) {
+		LOG(RETRO_LOG_WARN, "Size of saved state changed, rewind disabled");
+		rt_rewind_setup(data, 0, 0);
+		return;
+	}
+	if (!data->core->retro_serialize(scratch, size))
+		return;
+	if (!data->core->rewind.has_state) {
+		// Very first snapshot has nothing to be compared with
+		memcpy(data->core->rewind.state, scratch, size);
+		data->core->rewind.has_state = true;
+		return;
+	}
+	
+	size_t delta_size = rewind_delta_encode(scratch, data->core->rewind.state, size,
+			data->core->rewind.delta);
+	// Newly taken snapshot becomes latest one
+	data->core->rewind.scratch = data->core->rewind.state;
+	data->core->rewind.state = scratch;
+	
+	// Every entry is stored as delta prefixed and suffixed by its size, so
+	// history can be walked from both ends
+	uint32_t entry_size = (uint32_t)delta_size;
+	size_t needed = delta_size + 2 * sizeof(uint32_t);
+	if (needed > data->core->rewind.budget) {
+		// Won't fit even into empty buffer
+		return;
+	}
+	while (data->core->rewind.budget - data->core->rewind.used < needed) {
+		uint32_t oldest;
+		rewind_ring_read(data, data->core->rewind.tail, &oldest, sizeof(uint32_t));
+		oldest += 2 * sizeof(uint32_t);
+		data->core->rewind.tail = (data->core->rewind.tail + oldest) % data->core->rewind.budget;
+		data->core->rewind.used -= oldest;
+		data->core->rewind.entries --;
+	}
+	size_t pos = data->core->rewind.head;
+	rewind_ring_write(data, pos, &entry_size, sizeof(uint32_t));
+	pos = (pos + sizeof(uint32_t)) % data->core->rewind.budget;
+	rewind_ring_write(data, pos, data->core->rewind.delta, delta_size);
+	pos = (pos + delta_size) % data->core->rewind.budget;
+	rewind_ring_write(data, pos, &entry_size, sizeof(uint32_t));
+	data->core->rewind.head = (pos + sizeof(uint32_t)) % data->core->rewind.budget;
+	data->core->rewind.used += needed;
+	data->core->rewind.entries ++;
+	
+	uint64_t elapsed = rt_get_time_ns() - start;
+	data->core->rewind.captures ++;
+	data->core->rewind.capture_time_total += elapsed;
+	if (elapsed > data->core->rewind.capture_time_max)
+		data->core->rewind.capture_time_max = elapsed;
+}
+
+
+/**
+ * Restores latest snapshot and runs single frame (with audio discarded)
+ * so there is something to present. Snapshot is taken every 'interval'
+ * frames, so it's popped and state moved one snapshot back only every
+ * 'interval' calls, making rewind play at normal speed. When history is
+ * exhausted, game stays at oldest available snapshot.
+ * Called only when there is at least one snapshot.
+ */
+static void rt_rewind_step(LibraryData* data) {
+	bool pop = (++data->core->rewind.steps >= data->core->rewind.interval);
+	if (pop)
+		data->core->rewind.steps = 0;
+	if (pop && (data->core->rewind.entries > 0)) {
+		uint32_t entry_size;
+		size_t budget = data->core->rewind.budget;
+		size_t pos = (data->core->rewind.head + budget - sizeof(uint32_t)) % budget;
+		rewind_ring_read(data, pos, &entry_size, sizeof(uint32_t));
+		pos = (pos + budget - entry_size) % budget;
+		rewind_ring_read(data, pos, data->core->rewind.delta, entry_size);
+		rewind_delta_apply(data->core->rewind.delta, entry_size,
+				data->core->rewind.state, data->core->rewind.size);
+		data->core->rewind.head = (pos + budget - sizeof(uint32_t)) % budget;
+		data->core->rewind.used -= entry_size + 2 * sizeof(uint32_t);
+		data->core->rewind.entries --;
+	}
+	
+	if (!data->core->retro_unserialize(data->core->rewind.state, data->core->rewind.size)) {
+		LOG(RETRO_LOG_WARN, "Failed to load state, rewind disabled");
+		rt_rewind_setup(data, 0, 0);
+		return;
+	}
+	bool discard_audio = data->private->discard_audio;
+	data->private->discard_audio = true;
+	data->core->retro_run();
+	data->private->discard_audio = discard_audio;
+	// Frame was generated from restored state, but that's not what core
+	// should continue from once rewinding stops
+	data->core->retro_unserialize(data->core->rewind.state, data->core->rewind.size);
+}
+
+
 void rt_core_step(LibraryData* data) {
 	current = data;
 #if RT_DEBUG_FPS
 	data->private->fps.ticks ++;
 #endif
-	if (data->private->gl.fbo == 0) {
+	data->core->input_polled = false;
+	uint64_t trace = rt_trace_begin(data);
+	bool hw_render = (data->private->hw_render_state == HW_RENDER_READY);
+	if (hw_render)
+		rt_gpu_timer_begin(data, GPU_PASS_CORE);
+	if (data->core->rewind.rewinding && data->core->rewind.has_state) {
+		// Until first snapshot is taken, game runs normally
+		rt_rewind_step(data);
+		if (hw_render)
+			rt_gpu_timer_end(data, GPU_PASS_CORE);
+		rt_trace_end(data, "rewind", trace);
+		rt_audio_flush(data);
+		return;
+	} else if ((data->core->run_ahead.frames > 0) && !data->private->discard_video) {
+		rt_core_step_run_ahead(data);
+	} else if (data->private->gl.fbo == 0) {
 		current->core->retro_run();
 	} else {
 		// glBindFramebuffer(GL_FRAMEBUFFER, data->private->gl.fbo);
 		current->core->retro_run();
 		// glBindFramebuffer(GL_FRAMEBUFFER, 0);
 	}
+	if (hw_render)
+		rt_gpu_timer_end(data, GPU_PASS_CORE);
+	rt_trace_end(data, "retro_run", trace);
+	rt_audio_flush(data);
+	data->core->frames ++;
+	if ((data->core->rewind.budget > 0) && (data->core->frames % data->core->rewind.interval == 0))
+		rt_rewind_capture(data);
 }
 
 
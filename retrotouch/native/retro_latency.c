@@ -0,0 +1,56 @@
+#include <stdlib.h>
+#include <string.h>
+#include <retrotouch.h>
+
+/**
+ * Input latency. GUI stores time of last change together with input
+ * state. For every change, time until core first reads input and time
+ * until following buffer swap returns is added to histogram. If input
+ * changes again before previous change is presented, older change is
+ * measured only up to reading it.
+ */
+
+static void rt_latency_add(LatencyHistogram* h, uint64_t latency) {
+	uint64_t bucket = latency / RT_LATENCY_BUCKET_SIZE;
+	if (bucket >= RT_LATENCY_BUCKETS)
+		bucket = RT_LATENCY_BUCKETS - 1;
+	h->buckets[bucket] ++;
+	h->count ++;
+	h->sum += latency;
+	if (latency > h->max)
+		h->max = latency;
+}
+
+
+void rt_latency_input_polled(LibraryData* data, uint64_t time) {
+	if ((time == 0) || (time == data->private->latency.polled))
+		return;
+	data->private->latency.polled = time;
+	data->private->latency.unread = time;
+}
+
+
+void rt_latency_input_read(LibraryData* data) {
+	uint64_t changed = data->private->latency.unread;
+	if (changed == 0)
+		return;
+	uint64_t now = rt_get_time();
+	data->private->latency.unread = 0;
+	rt_latency_add(&data->private->latency.to_read, (now > changed) ? now - changed : 0);
+	__atomic_store_n(&data->private->latency.unpresented, changed, __ATOMIC_RELEASE);
+}
+
+
+void rt_latency_presented(LibraryData* data) {
+	uint64_t changed = __atomic_exchange_n(&data->private->latency.unpresented, 0, __ATOMIC_ACQ_REL);
+	if (changed == 0)
+		return;
+	uint64_t now = rt_get_time();
+	rt_latency_add(&data->private->latency.to_present, (now > changed) ? now - changed : 0);
+}
+
+
+void rt_latency_get_stats(LibraryData* data, LatencyHistogram* to_read, LatencyHistogram* to_present) {
+	*to_read = data->private->latency.to_read;
+	*to_present = data->private->latency.to_present;
+}
@@ -0,0 +1,108 @@
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <stdarg.h>
+#include <pthread.h>
+#include <retrotouch.h>
+
+/**
+ * Log records are stored in bounded lock-free ring that can be written
+ * from any thread (main, audio and video thread) and is read only by main
+ * thread. Every slot carries sequence number telling whether it's free
+ * for writing (seq == position) or holds record (seq == position + 1).
+ */
+
+
+void rt_log_init(LibraryData* data) {
+	for (uint64_t i=0; i<RT_LOG_RING_SIZE; i++)
+		data->private->log.slots[i].seq = i;
+	data->private->log.main_thread = pthread_self();
+}
+
+
+void rt_set_log_level(LibraryData* data, int level) {
+	data->private->log.level = level;
+}
+
+
+void rt_logv(LibraryData* data, const char* tag, enum retro_log_level level, const char *fmt, va_list va) {
+	struct LogSlot* slot;
+	uint64_t pos;
+	
+	if ((int)level < data->private->log.level)
+		// Filtered out before anything is formatted
+		return;
+	
+	pos = __atomic_load_n(&data->private->log.head, __ATOMIC_RELAXED);
+	while (1) {
+		slot = &data->private->log.slots[pos % RT_LOG_RING_SIZE];
+		int64_t diff = (int64_t)__atomic_load_n(&slot->seq, __ATOMIC_ACQUIRE) - (int64_t)pos;
+		if (diff == 0) {
+			if (__atomic_compare_exchange_n(&data->private->log.head, &pos, pos + 1,
+					true, __ATOMIC_RELAXED, __ATOMIC_RELAXED))
+				break;
+		} else if (diff < 0) {
+			// Ring is full
+			__atomic_add_fetch(&data->private->log.dropped, 1, __ATOMIC_RELAXED);
+			return;
+		} else {
+			pos = __atomic_load_n(&data->private->log.head, __ATOMIC_RELAXED);
+		}
+	}
+	
+	slot->record.time = rt_get_time();
+	slot->record.level = (int)level;
+	strncpy(slot->record.tag, tag, RT_LOG_TAG_SIZE - 1);
+	slot->record.tag[RT_LOG_TAG_SIZE - 1] = 0;
+	int len = vsnprintf(slot->record.message, RT_LOG_MESSAGE_SIZE, fmt, va);
+	if (len >= RT_LOG_MESSAGE_SIZE)
+		len = RT_LOG_MESSAGE_SIZE - 1;
+	// Strip \n that some cores tend to add
+	while ((len > 1) && (slot->record.message[len - 1] == '\n')) {
+		slot->record.message[len - 1] = 0;
+		len --;
+	}
+	__atomic_store_n(&slot->seq, pos + 1, __ATOMIC_RELEASE);
+	
+	if (!data->private->run_loop.running && pthread_equal(pthread_self(), data->private->log.main_thread)) {
+		// Outside of run loop, nothing else would deliver message
+		rt_log_drain(data);
+	}
+}
+
+
+void rt_log(LibraryData* data, const char* tag, enum retro_log_level level, const char *fmt, ...) {
+	va_list va;
+	va_start(va, fmt);
+	rt_logv(data, tag, level, fmt, va);
+	va_end(va);
+}
+
+
+int rt_log_pop(LibraryData* data, LogRecord* record) {
+	uint64_t pos = data->private->log.tail;
+	struct LogSlot* slot = &data->private->log.slots[pos % RT_LOG_RING_SIZE];
+	if (__atomic_load_n(&slot->seq, __ATOMIC_ACQUIRE) != pos + 1)
+		return 0;
+	*record = slot->record;
+	__atomic_store_n(&slot->seq, pos + RT_LOG_RING_SIZE, __ATOMIC_RELEASE);
+	data->private->log.tail = pos + 1;
+	return 1;
+}
+
+
+uint64_t rt_log_get_dropped(LibraryData* data) {
+	return __atomic_load_n(&data->private->log.dropped, __ATOMIC_RELAXED);
+}
+
+
+void rt_log_drain(LibraryData* data) {
+	uint64_t pos = data->private->log.tail;
+	struct LogSlot* slot = &data->private->log.slots[pos % RT_LOG_RING_SIZE];
+	data->private->log.last_drain = rt_get_time();
+	if ((__atomic_load_n(&slot->seq, __ATOMIC_ACQUIRE) == pos + 1)
+			|| (rt_log_get_dropped(data) != data->private->log.reported_dropped)) {
+		data->private->log.reported_dropped = rt_log_get_dropped(data);
+		data->cb_log_ready();
+	}
+}
@@ -2,23 +2,16 @@
 #include <stdio.h>
 #include <sys/shm.h>
 #include <string.h>
+#include <time.h>
+#include <errno.h>
+#include <poll.h>
+#include <sys/eventfd.h>
 #include <libretro.h>
 #include <retrotouch.h>
 
 #define LOG(...) rt_log(data, "RMain", __VA_ARGS__)
 
 
-void rt_log(LibraryData* data, const char* tag, enum retro_log_level level, const char *fmt, ...) {
-	char buffer[4096] = {0};
-	va_list va;
-	va_start(va, fmt);
-	vsnprintf(buffer, sizeof(buffer), fmt, va);
-	va_end(va);
-	
-	data->cb_log(tag, (int)level, buffer);
-}
-
-
 void rt_set_error(LibraryData* data, const char* message) {
 	strncpy(data->private->error, message, 1023);
 	data->private->error[1023] = 0;
@@ -39,7 +32,8 @@ int x_init(LibraryData* data) {
 	XWindowAttributes pwa;
 	Colormap cmap;
 	
-	// Open X connection
+	// Open X connection. Connection is shared with video thread, if enabled
+	XInitThreads();
 	Display* dpy = data->private->dpy = XOpenDisplay(NULL);
 	if (dpy == NULL) {
 		rt_set_error(data, "Failed to open display");
@@ -64,7 +58,9 @@ int x_init(LibraryData* data) {
 		vi->depth, InputOutput, vi->visual, CWColormap | CWEventMask, &wa);
 	if (data->parent != 0)
 		XReparentWindow(dpy, data->window, data->parent, 0, 0);
-	XMapWindow(dpy, data->window);
+	// Headless window is never mapped, but it's still possible to render into it
+	if (!data->headless)
+		XMapWindow(dpy, data->window);
 	XStoreName(dpy, data->window, "RetroTouch");
 	
 	data->private->gl.ctx = glXCreateContext(dpy, vi, NULL, GL_TRUE);
@@ -81,11 +77,19 @@ int rt_init(LibraryData* data) {
 		return 1; // OOM
 	
 	memset(data->private, 0, sizeof(PrivateData));
+	rt_log_init(data);
 	data->private->gl.screen_size[0] = data->private->window_width = data->private->internal_width = 640;
 	data->private->gl.screen_size[1] = data->private->window_height = data->private->internal_height = 480;
 	data->private->gl.colorspace = "COLORSPACE_RGB8888";
 	// TODO: Support RETRO_SERIALIZATION_QUIRK_FRONT_VARIABLE_SIZE
 	data->private->serialization_quirks = 0;
+	rt_pacer_configure(data, RT_PACER_SPIN_TIME, RT_PACER_RESYNC);
+	
+	data->private->run_loop.eventfd = eventfd(0, EFD_CLOEXEC | EFD_NONBLOCK);
+	if (data->private->run_loop.eventfd < 0) {
+		rt_set_error(data, "Failed to create eventfd");
+		return 1;
+	}
 	
 	if (0 != x_init(data)) return 1;
 	rt_make_current(data);
@@ -107,8 +111,8 @@ inline static void rt_step_xevent(LibraryData* data) {
 			XWindowAttributes wa;
 			XGetWindowAttributes(data->private->dpy, data->window, &wa);
 			rt_set_window_size(data, wa.width, wa.height);
-			rt_render(data);
-			glXSwapBuffers(data->private->dpy, data->window);
+			// Actual redraw is done by rt_step / rt_step_paused that follows
+			rt_damage(data);
 		} else if (xev.type == ConfigureNotify) {
 			rt_set_window_size(data, xev.xconfigure.width, xev.xconfigure.height);
 		}
@@ -116,17 +120,130 @@ inline static void rt_step_xevent(LibraryData* data) {
 }
 
 
+void rt_pacer_configure(LibraryData* data, int spin_time, int resync_threshold) {
+	data->private->pacer.spin_time = (uint64_t)(spin_time > 0 ? spin_time : 0) * 1000;
+	data->private->pacer.resync_threshold = (uint64_t)(resync_threshold > 0 ? resync_threshold : 0) * 1000;
+	LOG(RETRO_LOG_DEBUG, "Frame pacer: spin %ius, resync after %ius", spin_time, resync_threshold);
+}
+
+
+void rt_pacer_reset(LibraryData* data) {
+	data->private->pacer.deadline = 0;
+}
+
+
+static int compare_uint64(const void* a, const void* b) {
+	uint64_t x = *(const uint64_t*)a;
+	uint64_t y = *(const uint64_t*)b;
+	return (x > y) - (x < y);
+}
+
+
+void rt_pacer_get_stats(LibraryData* data, PacerStats* stats) {
+	static uint64_t sorted[RT_PACER_HISTORY];
+	size_t count = data->private->pacer.frames < RT_PACER_HISTORY
+			? data->private->pacer.frames : RT_PACER_HISTORY;
+	uint64_t sum = 0;
+	
+	stats->frames = data->private->pacer.frames;
+	stats->overruns = data->private->pacer.overruns;
+	stats->resyncs = data->private->pacer.resyncs;
+	stats->mean_error = stats->p99_error = 0;
+	if (count == 0)
+		return;
+	
+	memcpy(sorted, data->private->pacer.errors, sizeof(uint64_t) * count);
+	for (size_t i=0; i<count; i++)
+		sum += sorted[i];
+	qsort(sorted, count, sizeof(uint64_t), compare_uint64);
+	stats->mean_error = (double)sum / count / 1000.0;
+	stats->p99_error = (double)sorted[(count * 99) / 100] / 1000.0;
+}
+
+
+/**
+ * Waits until deadline of current frame and computes deadline for next one.
+ * Deadlines are absolute, so time overslept in one frame is not carried over
+ * to next one. When frame overruns its deadline, following frames are run
+ * without waiting until pacer catches up, unless it's too late for that.
+ */
+static void rt_pacer_wait(LibraryData* data) {
+	uint64_t target = (uint64_t)data->private->gl.target_frame_time * 1000;
+	uint64_t now = rt_get_time_ns();
+	uint64_t deadline = data->private->pacer.deadline;
+	uint64_t error;
+	
+	if (target == 0)
+		return;
+	if (deadline == 0) {
+		// First frame after start, pause or vsync change
+		data->private->pacer.deadline = now + target;
+		return;
+	}
+	uint64_t trace = rt_trace_begin(data);
+	
+	if (now >= deadline) {
+		error = now - deadline;
+		data->private->pacer.overruns ++;
+		if (error > data->private->pacer.resync_threshold) {
+			// Too late to catch up, start over from now
+			data->private->pacer.resyncs ++;
+			deadline = now;
+		}
+	} else {
+		if (deadline - now > data->private->pacer.spin_time) {
+			struct timespec ts;
+			uint64_t wake = deadline - data->private->pacer.spin_time;
+			ts.tv_sec = wake / 1000000000;
+			ts.tv_nsec = wake % 1000000000;
+			while (clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &ts, NULL) == EINTR);
+		}
+		while ((now = rt_get_time_ns()) < deadline);
+		error = now - deadline;
+	}
+	
+	data->private->pacer.errors[data->private->pacer.frames % RT_PACER_HISTORY] = error;
+	data->private->pacer.frames ++;
+	data->private->pacer.deadline = deadline + target;
+	rt_trace_end(data, "pacer_wait", trace);
+}
+
+
+void rt_set_fast_forward(LibraryData* data, int factor, int uncapped) {
+	if (factor < 1) factor = 1;
+	if (factor > RT_MAX_FAST_FORWARD) factor = RT_MAX_FAST_FORWARD;
+	data->private->gl.frame_skip = factor;
+	data->private->uncapped = uncapped;
+	// Audio is kept only for presented frame. Writing audio never blocks,
+	// anything what doesn't fit into audio buffer is dropped
+	rt_pacer_reset(data);
+	if ((factor == 1) && !uncapped)
+		LOG(RETRO_LOG_DEBUG, "Fast-forward disabled");
+	else
+		LOG(RETRO_LOG_DEBUG, "Fast-forward %ix%s", factor, uncapped ? ", uncapped" : "");
+}
+
+
 void rt_step_paused(LibraryData* data) {
+	rt_pacer_reset(data);
+	uint64_t trace = rt_trace_begin(data);
 	rt_step_xevent(data);
+	rt_trace_end(data, "xevent", trace);
+	if (data->private->video_thread.enabled) {
+		rt_video_thread_redraw(data);
+		return;
+	}
+	if (!rt_needs_redraw(data))
+		return;
 	rt_make_current(data);
-	rt_render(data);
-	glXSwapBuffers(data->private->dpy, data->window);
+	rt_present(data);
 }	
 
 
 void rt_step(LibraryData* data) {
-	useconds_t frame_start = (data->private->gl.vsync_enabled) ? 0 : rt_get_time();
+	uint64_t trace = rt_trace_begin(data);
 	rt_step_xevent(data);
+	rt_trace_end(data, "xevent", trace);
 	rt_make_current(data);
 	if (data->private->hw_render_state == HW_RENDER_NEEDS_RESET) {
 		data->private->hw_render_state = HW_RENDER_READY;
@@ -134,17 +251,102 @@ void rt_step(LibraryData* data) {
 		rt_compile_shaders(data);
 		LOG(RETRO_LOG_DEBUG, "HW rendering set up.");
 	}
-	for(unsigned int i=0; i<data->private->gl.frame_skip; i++)
+	uint64_t start = rt_get_time();
+	for(unsigned int i=0; i<data->private->gl.frame_skip; i++) {
+		data->private->discard_video = data->private->discard_audio =
+				(i + 1 < data->private->gl.frame_skip);
 		rt_core_step(data);
-	rt_render(data);
-	glXSwapBuffers(data->private->dpy, data->window);
+	}
+	data->private->discard_video = data->private->discard_audio = false;
+	rt_hud_add_time(data, HUD_CORE, rt_get_time() - start);
+	rt_hud_add_frames(data, data->private->gl.frame_skip, data->private->gl.frame_skip - 1);
+	if (data->private->video_thread.enabled) {
+		// Presenting is done by video thread, so emulation is paced by
+		// frame pacer even with vsync enabled
+		rt_video_thread_redraw(data);
+		rt_hud_end_frame(data);
+		if (data->private->uncapped)
+			rt_pacer_reset(data);
+		else
+			rt_pacer_wait(data);
+		return;
+	}
+	bool presented = rt_needs_redraw(data);
+	if (presented)
+		rt_present(data);
+	rt_hud_end_frame(data);
 	
-	if (frame_start) {
-		useconds_t frame_end = rt_get_time();
-		if (frame_end > frame_start) {
-			useconds_t frame_time = frame_end - frame_start;
-			if (frame_time < data->private->gl.target_frame_time)
-				usleep(data->private->gl.target_frame_time - frame_time);
+	if (data->private->uncapped) {
+		rt_pacer_reset(data);
+	} else {
+		if (data->private->gl.vsync_enabled && presented) {
+			// Swap already waited for vblank. Pacer only sets deadline
+			// from now, in case next frame will not be presented
+			rt_pacer_reset(data);
 		}
+		rt_pacer_wait(data);
 	}
 }
+
+
+void rt_set_paused(LibraryData* data, int paused) {
+	data->private->paused = (paused != 0);
+}
+
+
+void rt_run_loop_stop(LibraryData* data) {
+	uint64_t one = 1;
+	__atomic_store_n(&data->private->run_loop.quit, true, __ATOMIC_RELEASE);
+	if (write(data->private->run_loop.eventfd, &one, sizeof(one)) < 0)
+		LOG(RETRO_LOG_WARN, "Failed to wake up run loop");
+}
+
+
+int rt_run_loop(LibraryData* data, int rpc_fd) {
+	struct pollfd fds[2] = {
+		{ .fd = rpc_fd, .events = POLLIN },
+		{ .fd = data->private->run_loop.eventfd, .events = POLLIN },
+	};
+	uint64_t trash;
+	
+	data->private->run_loop.quit = false;
+	data->private->run_loop.running = true;
+	LOG(RETRO_LOG_DEBUG, "Run loop started");
+	while (!__atomic_load_n(&data->private->run_loop.quit, __ATOMIC_ACQUIRE)) {
+		// While paused, screen is refreshed 10 times per second. Otherwise,
+		// waiting is done by frame pacer or vsync in rt_step
+		int r = poll(fds, 2, data->private->paused ? 100 : 0);
+		if ((r < 0) && (errno != EINTR)) {
+			LOG(RETRO_LOG_ERROR, "poll failed: %s", strerror(errno));
+			data->private->run_loop.running = false;
+			rt_log_drain(data);
+			return 1;
+		}
+		if (r > 0) {
+			if (fds[1].revents & POLLIN) {
+				if (read(data->private->run_loop.eventfd, &trash, sizeof(trash)) < 0)
+					LOG(RETRO_LOG_WARN, "Failed to read eventfd");
+			}
+			if (fds[0].revents & (POLLIN | POLLHUP | POLLERR)) {
+				if (data->cb_rpc_ready() != 0)
+					break;
+			}
+		}
+		if (rt_trace_dump_requested(data))
+			rt_trace_dump(data);
+		if (__atomic_load_n(&data->private->run_loop.quit, __ATOMIC_ACQUIRE))
+			break;
+		if (data->private->paused)
+			rt_step_paused(data);
+		else
+			rt_step(data);
+		if (rt_get_time() > data->private->log.last_drain + RT_LOG_DRAIN_INTERVAL) {
+			rt_log_drain(data);
+			rt_audio_report_latency(data);
+		}
+	}
+	data->private->run_loop.running = false;
+	LOG(RETRO_LOG_DEBUG, "Run loop finished");
+	rt_log_drain(data);
+	return 0;
+}
@@ -1,7 +1,8 @@
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
-#include <sys/time.h>
+#include <inttypes.h>
+#include <time.h>
 #define GL_GLEXT_PROTOTYPES 1
 #include <GL/gl.h>
 #include <GL/glx.h>
@@ -111,6 +112,9 @@ void rt_compile_shaders(LibraryData* data) {
 		data->private->gl.prog_pads.u_scale_factor = glGetUniformLocation(data->private->gl.prog_pads.id, "scale_factor");
 	}
 	
+	if (data->private->gl.prog_hud.id == 0)
+		rt_hud_setup(data);
+	
 	// Load "main" shader
 	strcpy(shader_name, data->res_path);
 	strcat(shader_name, "/normal");
@@ -144,6 +148,7 @@ void rt_compile_shaders(LibraryData* data) {
 	glBindBuffer(GL_ARRAY_BUFFER, 0);
 	glBindVertexArray(0);
 	
+	rt_damage(data);
 	LOG(RETRO_LOG_DEBUG, "Shaders loaded & compiled");
 }
 
@@ -157,6 +162,8 @@ void rt_setup_texture(LibraryData* data) {
 			data->private->gl.pixel_format,
 			data->private->gl.pixel_type,
 			0);
+	data->private->gl.texture_width = data->private->internal_width;
+	data->private->gl.texture_height = data->private->internal_height;
 	glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
 	glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
 	glBindTexture(GL_TEXTURE_2D, 0);
@@ -181,14 +188,28 @@ void rt_setup_depth_buffer(LibraryData* data) {
 }
 
 
-useconds_t rt_get_time() {
-	static struct timeval t;
-	gettimeofday(&t, NULL);
-	return (t.tv_sec * (useconds_t)1000000) + (t.tv_usec);
+uint64_t rt_get_time_ns() {
+	struct timespec t;
+	clock_gettime(CLOCK_MONOTONIC, &t);
+	return (t.tv_sec * (uint64_t)1000000000) + t.tv_nsec;
+}
+
+
+uint64_t rt_get_time() {
+	return rt_get_time_ns() / 1000;
 }
 
 
 int rt_vsync_enable(LibraryData* data, int i) {
+	if (rt_video_thread_active(data)) {
+		// Swap interval is set on GL context, which is owned by video thread
+		data->private->gl.vsync_enabled = i;
+		pthread_mutex_lock(&data->private->video_thread.lock);
+		data->private->video_thread.vsync_changed = true;
+		pthread_cond_signal(&data->private->video_thread.cond);
+		pthread_mutex_unlock(&data->private->video_thread.lock);
+		return 0;
+	}
 	if (strstr(data->private->gl.extensions, "GLX_MESA_swap_control") != NULL) {
 		// Intel
 		typedef int (*glXSwapIntervalMESA_t)(int interval);
@@ -211,25 +232,306 @@ int rt_vsync_enable(LibraryData* data, int i) {
 
 
 void rt_retro_frame(LibraryData* data, const char* frame, unsigned width, unsigned height, size_t pitch) {
-	if (frame == NULL)
+	if (frame == NULL) {
+		if (!data->private->discard_video)
+			rt_hud_frame_duplicated(data);
 		return;
+	}
 #if RT_DEBUG_FPS
 	data->private->fps.generated ++;
 #endif
 	if (frame == RETRO_HW_FRAME_BUFFER_VALID) {
+		if (!data->private->discard_video)
+			rt_damage(data);
 		return;
 	}
+	if (data->private->discard_video)
+		return;
 	
-	data->private->gl.frame_size[0] = (GLfloat)(pitch / data->private->gl.bpp);
 	data->private->gl.pitch = pitch;
+	if (data->private->video_thread.enabled)
+		rt_video_thread_push(data, frame, width, height, pitch);
+	else
+		rt_upload_frame(data, frame, width, height, pitch);
+	data->private->frame = frame;
+}
+
+
+static void rt_pbo_destroy(LibraryData* data) {
+	for (int i=0; i<RT_PBO_COUNT; i++) {
+		if (data->private->gl.pbo.fences[i] != 0)
+			glDeleteSync(data->private->gl.pbo.fences[i]);
+		if (data->private->gl.pbo.mapped[i] != NULL) {
+			glBindBuffer(GL_PIXEL_UNPACK_BUFFER, data->private->gl.pbo.ids[i]);
+			glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER);
+		}
+		data->private->gl.pbo.fences[i] = 0;
+		data->private->gl.pbo.mapped[i] = NULL;
+	}
+	glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0);
+	if (data->private->gl.pbo.ids[0] != 0)
+		glDeleteBuffers(RT_PBO_COUNT, data->private->gl.pbo.ids);
+	memset(data->private->gl.pbo.ids, 0, sizeof(data->private->gl.pbo.ids));
+	data->private->gl.pbo.size = 0;
+}
+
+
+/** (Re)allocates pixel buffers. Called only when frame size changes */
+static void rt_pbo_setup(LibraryData* data, size_t size) {
+	typedef void (*glBufferStorage_t)(GLenum target, GLsizeiptr size, const void* data, GLbitfield flags);
+	static glBufferStorage_t glBufferStorage_ = NULL;
+	
+	if (data->private->gl.pbo.mode == PBO_UNKNOWN) {
+		const char* extensions = (const char*)glGetString(GL_EXTENSIONS);
+		data->private->gl.pbo.mode = PBO_STREAMING;
+		if ((extensions != NULL) && (strstr(extensions, "GL_ARB_buffer_storage") != NULL))
+			glBufferStorage_ = (glBufferStorage_t)glXGetProcAddress((const GLubyte*)"glBufferStorage");
+		if (glBufferStorage_ != NULL)
+			data->private->gl.pbo.mode = PBO_PERSISTENT;
+		LOG(RETRO_LOG_DEBUG, "Uploading frames using %s pixel buffers",
+			(data->private->gl.pbo.mode == PBO_PERSISTENT) ? "persistently mapped" : "streamed");
+	}
+	
+	rt_pbo_destroy(data);
+	if (data->private->gl.pbo.mode == PBO_DISABLED)
+		return;
+	glGenBuffers(RT_PBO_COUNT, data->private->gl.pbo.ids);
+	data->private->gl.pbo.size = size;
+	data->private->gl.pbo.next = 0;
+	if (data->private->gl.pbo.mode == PBO_PERSISTENT) {
+		GLbitfield flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT;
+		for (int i=0; i<RT_PBO_COUNT; i++) {
+			glBindBuffer(GL_PIXEL_UNPACK_BUFFER, data->private->gl.pbo.ids[i]);
+			glBufferStorage_(GL_PIXEL_UNPACK_BUFFER, size, NULL, flags);
+			data->private->gl.pbo.mapped[i] = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, size, flags);
+			if (data->private->gl.pbo.mapped[i] == NULL) {
+				LOG(RETRO_LOG_WARN, "Failed to map pixel buffer, falling back to streaming");
+				data->private->gl.pbo.mode = PBO_STREAMING;
+				rt_pbo_setup(data, size);
+				return;
+			}
+		}
+	} else {
+		for (int i=0; i<RT_PBO_COUNT; i++) {
+			glBindBuffer(GL_PIXEL_UNPACK_BUFFER, data->private->gl.pbo.ids[i]);
+			glBufferData(GL_PIXEL_UNPACK_BUFFER, size, NULL, GL_STREAM_DRAW);
+		}
+	}
+	glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0);
+}
+
+
+/**
+ * Copies frame into next pixel buffer and leaves that buffer bound.
+ * Returns pointer that should be passed to glTexSubImage2D, which is
+ * either offset in bound buffer or, if pixel buffers are not used, frame itself.
+ */
+static const char* rt_pbo_fill(LibraryData* data, const char* frame, size_t size) {
+	int i = data->private->gl.pbo.next;
+	void* target;
+	
+	if ((data->private->gl.pbo.mode == PBO_DISABLED) || (size > data->private->gl.pbo.size))
+		return frame;
+	
+	glBindBuffer(GL_PIXEL_UNPACK_BUFFER, data->private->gl.pbo.ids[i]);
+	if (data->private->gl.pbo.mode == PBO_PERSISTENT) {
+		if (data->private->gl.pbo.fences[i] != 0) {
+			// Wait until GPU is done with previous upload from same buffer.
+			// With RT_PBO_COUNT buffers, this should be already done.
+			glClientWaitSync(data->private->gl.pbo.fences[i], GL_SYNC_FLUSH_COMMANDS_BIT, 1000000000);
+			glDeleteSync(data->private->gl.pbo.fences[i]);
+			data->private->gl.pbo.fences[i] = 0;
+		}
+		memcpy(data->private->gl.pbo.mapped[i], frame, size);
+	} else {
+		// Orphaning buffer so driver doesn't have to wait for previous upload
+		glBufferData(GL_PIXEL_UNPACK_BUFFER, data->private->gl.pbo.size, NULL, GL_STREAM_DRAW);
+		target = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, size,
+				GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT);
+		if (target == NULL) {
+			LOG(RETRO_LOG_WARN, "Failed to map pixel buffer, pixel buffers disabled");
+			glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0);
+			data->private->gl.pbo.mode = PBO_DISABLED;
+			rt_pbo_destroy(data);
+			return frame;
+		}
+		memcpy(target, frame, size);
+		glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER);
+	}
+	return NULL;
+}
+
+
+void rt_upload_frame(LibraryData* data, const char* frame, unsigned width, unsigned height, size_t pitch) {
+	uint64_t start = rt_get_time();
+	size_t size = pitch * height;
 	glBindTexture(GL_TEXTURE_2D, data->private->gl.texture);
-	glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB,
-		pitch / data->private->gl.bpp, height, 0,
+	if ((width != data->private->gl.texture_width) || (height != data->private->gl.texture_height)
+			|| ((data->private->gl.pbo.mode != PBO_DISABLED) && (size > data->private->gl.pbo.size))) {
+		// Geometry changed, storage has to be reallocated
+		glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, width, height, 0,
+			data->private->gl.pixel_format,
+			data->private->gl.pixel_type,
+			NULL);
+		data->private->gl.texture_width = width;
+		data->private->gl.texture_height = height;
+		rt_pbo_setup(data, size);
+	}
+	data->private->gl.frame_size[0] = (GLfloat)width;
+	data->private->gl.frame_size[1] = (GLfloat)height;
+	rt_damage(data);
+	
+	// Padding at end of each row is skipped by setting row length
+	glPixelStorei(GL_UNPACK_ROW_LENGTH, pitch / data->private->gl.bpp);
+	glPixelStorei(GL_UNPACK_ALIGNMENT, (pitch % 4 == 0) ? 4 : ((pitch % 2 == 0) ? 2 : 1));
+	const char* source = rt_pbo_fill(data, frame, size);
+	glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, width, height,
 		data->private->gl.pixel_format,
 		data->private->gl.pixel_type,
-		frame);
+		source);
+	if (source != frame) {
+		int i = data->private->gl.pbo.next;
+		if (data->private->gl.pbo.mode == PBO_PERSISTENT)
+			data->private->gl.pbo.fences[i] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0);
+		data->private->gl.pbo.next = (i + 1) % RT_PBO_COUNT;
+		glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0);
+	}
+	glPixelStorei(GL_UNPACK_ROW_LENGTH, 0);
+	glPixelStorei(GL_UNPACK_ALIGNMENT, 4);
 	glBindTexture(GL_TEXTURE_2D, 0);
-	data->private->frame = frame;
+	uint64_t end = rt_get_time();
+	rt_hud_add_time(data, HUD_UPLOAD, end - start);
+	rt_trace_add(data, "upload", 0, 0, start, end - start);
+}
+
+
+void rt_damage(LibraryData* data) {
+	__atomic_store_n(&data->private->damage.dirty, true, __ATOMIC_RELEASE);
+}
+
+
+/** Compares pad images in shared memory with what was drawn last time */
+static bool rt_pads_changed(LibraryData* data) {
+	bool changed = false;
+	if (data->private->damage.scale_factor != data->shared_data->scale_factor) {
+		data->private->damage.scale_factor = data->shared_data->scale_factor;
+		changed = true;
+	}
+	if (data->private->damage.show_hud != (data->shared_data->show_hud != 0)) {
+		data->private->damage.show_hud = (data->shared_data->show_hud != 0);
+		changed = true;
+	}
+	for (size_t i=0; i<RT_MAX_IMAGES; i++) {
+		if ((data->private->damage.images[i].version != data->shared_data->images[i].version)
+				|| (data->private->damage.images[i].x != data->shared_data->images[i].x)
+				|| (data->private->damage.images[i].y != data->shared_data->images[i].y)
+				|| (data->private->damage.images[i].width != data->shared_data->images[i].width)
+				|| (data->private->damage.images[i].height != data->shared_data->images[i].height)
+				|| (data->private->damage.images[i].size != data->shared_data->images[i].size)) {
+			data->private->damage.images[i].version = data->shared_data->images[i].version;
+			data->private->damage.images[i].x = data->shared_data->images[i].x;
+			data->private->damage.images[i].y = data->shared_data->images[i].y;
+			data->private->damage.images[i].width = data->shared_data->images[i].width;
+			data->private->damage.images[i].height = data->shared_data->images[i].height;
+			data->private->damage.images[i].size = data->shared_data->images[i].size;
+			changed = true;
+		}
+	}
+	return changed;
+}
+
+
+bool rt_needs_redraw(LibraryData* data) {
+	// Both checks have to be done so pad snapshot is always updated
+	bool dirty = __atomic_exchange_n(&data->private->damage.dirty, false, __ATOMIC_ACQ_REL);
+	if (rt_pads_changed(data))
+		dirty = true;
+	if (dirty)
+		data->private->damage.presented ++;
+	else
+		data->private->damage.skipped ++;
+	return dirty;
+}
+
+
+void rt_render_get_stats(LibraryData* data, RenderStats* stats) {
+	stats->presented = data->private->damage.presented;
+	stats->skipped = data->private->damage.skipped;
+}
+
+
+/** Stores version of uploaded image, unless image was changed while uploading */
+static void rt_image_uploaded(LibraryData* data, size_t i, uint version) {
+	if (__atomic_load_n(&data->shared_data->images[i].version, __ATOMIC_ACQUIRE) != version) {
+		// GUI may have started writing next-but-one version into slot
+		// that was being read. 0 forces full upload
+		data->private->gl.images[i].version = 0;
+		rt_damage(data);
+	} else {
+		data->private->gl.images[i].version = version;
+	}
+}
+
+
+/**
+ * Uploads pad image from shared memory into its texture and leaves
+ * that texture bound. If only single version increment happened since
+ * last upload, only changed area is uploaded.
+ *
+ * Image is double-buffered and GUI writes only to slot that is not
+ * current, so no locking is needed. Slot being read can be overwritten
+ * only if GUI publishes new version during upload and then starts writing
+ * another one; in such case, whole image is uploaded again on next redraw.
+ */
+static void rt_update_image(LibraryData* data, size_t i) {
+	uint version = __atomic_load_n(&data->shared_data->images[i].version, __ATOMIC_ACQUIRE);
+	uint width = data->shared_data->images[i].width;
+	uint height = data->shared_data->images[i].height;
+	uint x = 0, y = 0, w = width, h = height;
+	char* img_data = ((char*)data->shared_data) + data->shared_data->images[i].offset
+			+ (version % 2) * data->shared_data->images[i].size;
+	
+	if ((data->private->gl.images[i].tex == 0)
+			|| (data->private->gl.images[i].width != width)
+			|| (data->private->gl.images[i].height != height)) {
+		// Storage is allocated only when image size changes
+		if (data->private->gl.images[i].tex == 0)
+			glGenTextures(1, &(data->private->gl.images[i].tex));
+		glBindTexture(GL_TEXTURE_2D, data->private->gl.images[i].tex);
+		glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height,
+			0, GL_RGBA, GL_UNSIGNED_BYTE, img_data);
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
+		data->private->gl.images[i].width = width;
+		data->private->gl.images[i].height = height;
+		rt_image_uploaded(data, i, version);
+		return;
+	}
+	
+	glBindTexture(GL_TEXTURE_2D, data->private->gl.images[i].tex);
+	if (version == data->private->gl.images[i].version + 1) {
+		x = data->shared_data->images[i].dirty_x;
+		y = data->shared_data->images[i].dirty_y;
+		w = data->shared_data->images[i].dirty_width;
+		h = data->shared_data->images[i].dirty_height;
+		if ((x + w > width) || (y + h > height)) {
+			// Invalid rectangle, upload everything
+			x = y = 0; w = width; h = height;
+		}
+	}
+	if ((w == 0) || (h == 0)) {
+		data->private->gl.images[i].version = version;
+		return;
+	}
+	
+	glPixelStorei(GL_UNPACK_ROW_LENGTH, width);
+	glPixelStorei(GL_UNPACK_SKIP_PIXELS, x);
+	glPixelStorei(GL_UNPACK_SKIP_ROWS, y);
+	glTexSubImage2D(GL_TEXTURE_2D, 0, x, y, w, h, GL_RGBA, GL_UNSIGNED_BYTE, img_data);
+	glPixelStorei(GL_UNPACK_ROW_LENGTH, 0);
+	glPixelStorei(GL_UNPACK_SKIP_PIXELS, 0);
+	glPixelStorei(GL_UNPACK_SKIP_ROWS, 0);
+	rt_image_uploaded(data, i, version);
 }
 
 
@@ -254,9 +556,12 @@ void rt_render(LibraryData* data) {
 	glUniform2fv(data->private->gl.prog_normal.u_frame_size, 1, data->private->gl.frame_size);
 	glUniform1f(data->private->gl.prog_normal.u_scale_factor, data->shared_data->scale_factor);
 	
+	rt_gpu_timer_begin(data, GPU_PASS_GAME);
 	glBindVertexArray(data->private->gl.vao);
 	glDrawArrays(GL_TRIANGLES, 0, 6);
+	rt_gpu_timer_end(data, GPU_PASS_GAME);
 	
+	rt_gpu_timer_begin(data, GPU_PASS_PADS);
 	glEnable(GL_BLEND);
 	glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA);
 	glUseProgram(data->private->gl.prog_pads.id);
@@ -266,21 +571,7 @@ void rt_render(LibraryData* data) {
 	for (size_t i=0; i<RT_MAX_IMAGES; i++) {
 		if (data->shared_data->images[i].size) {
 			if (data->shared_data->images[i].version != data->private->gl.images[i].version) {
-				if (data->private->gl.images[i].version != 0)
-					glDeleteTextures(1, &data->private->gl.images[i].tex);
-				glGenTextures(1, &(data->private->gl.images[i].tex));
-				glBindTexture(GL_TEXTURE_2D, data->private->gl.images[i].tex);
-				char* img_data = ((char*)data->shared_data) + data->shared_data->images[i].offset;
-				
-				glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA,
-					data->shared_data->images[i].width,
-					data->shared_data->images[i].height,
-					0, GL_RGBA, GL_UNSIGNED_BYTE,
-					img_data
-				);
-				glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
-				glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
-				data->private->gl.images[i].version = data->shared_data->images[i].version;
+				rt_update_image(data, i);
 			} else {
 				glBindTexture(GL_TEXTURE_2D, data->private->gl.images[i].tex);
 			}
@@ -295,19 +586,31 @@ void rt_render(LibraryData* data) {
 			glDrawArrays(GL_TRIANGLES, 0, 6);
 		}
 	}
+	rt_gpu_timer_end(data, GPU_PASS_PADS);
 	
 	glBindVertexArray(0);
 	glUseProgram(0);
+	if (data->shared_data->show_hud)
+		rt_hud_render(data);
 	
 #if RT_DEBUG_FPS
-	useconds_t now = rt_get_time() / 1000;
+	uint64_t now = rt_get_time() / 1000;
 	if ((data->private->fps.since == 0) || (now > data->private->fps.since + 1000)) {
 		if (data->private->fps.since > 0) {
-			useconds_t delta = now - data->private->fps.since;
-			useconds_t ticks = data->private->fps.ticks * 1000 / delta;
-			useconds_t drawn = data->private->fps.drawn * 1000 / delta;
-			useconds_t generated = data->private->fps.generated * 1000 / delta;
-			LOG(RETRO_LOG_DEBUG, "FPS: %u ticks %u drawn %u generated", ticks, drawn, generated);
+			PacerStats pacer;
+			AudioStats audio;
+			RenderStats render;
+			uint64_t delta = now - data->private->fps.since;
+			unsigned int ticks = data->private->fps.ticks * 1000 / delta;
+			unsigned int drawn = data->private->fps.drawn * 1000 / delta;
+			unsigned int generated = data->private->fps.generated * 1000 / delta;
+			rt_pacer_get_stats(data, &pacer);
+			rt_audio_get_stats(data, &audio);
+			rt_render_get_stats(data, &render);
+			LOG(RETRO_LOG_DEBUG, "FPS: %u ticks %u drawn %u generated, pacing error %.0fµs mean %.0fµs p99, "
+					"audio buffer %" PRIu64 "/%" PRIu64 ", %" PRIu64 " underruns, %" PRIu64 " presents skipped",
+					ticks, drawn, generated, pacer.mean_error, pacer.p99_error,
+					audio.fill, audio.capacity, audio.underruns, render.skipped);
 		}
 		data->private->fps.since = now;
 		data->private->fps.drawn = 1;
@@ -320,7 +623,23 @@ void rt_render(LibraryData* data) {
 }
 
 
+void rt_present(LibraryData* data) {
+	uint64_t start = rt_get_time();
+	rt_render(data);
+	uint64_t rendered = rt_get_time();
+	glXSwapBuffers(data->private->dpy, data->window);
+	uint64_t swapped = rt_get_time();
+	rt_latency_presented(data);
+	rt_hud_add_time(data, HUD_RENDER, rendered - start);
+	rt_hud_add_time(data, HUD_SWAP, swapped - rendered);
+	rt_trace_add(data, "render", 0, 0, start, rendered - start);
+	rt_trace_add(data, "swap", 0, 0, rendered, swapped - rendered);
+}
+
+
 void rt_make_current(LibraryData* data) {
+	if (rt_video_thread_active(data))
+		return;
 	glXMakeCurrent(data->private->dpy, data->window, data->private->gl.ctx);
 }
 
@@ -365,6 +684,7 @@ void rt_set_render_size(LibraryData* data, int width, int height) {
 		glGenFramebuffers(1, &data->private->gl.fbo);
 		setup_framebuffer(data);
 	}
+	rt_damage(data);
 	LOG(RETRO_LOG_DEBUG, "Internal size set to %ix%i", width, height);
 }
 
@@ -373,6 +693,7 @@ void rt_set_screen_size(LibraryData* data, int width, int height) {
 	// if ((data->private->gl.screen_size[0] != width) || (data->private->gl.screen_size[1] != height)) {
 	data->private->gl.screen_size[0] = width;
 	data->private->gl.screen_size[1] = height;
+	rt_damage(data);
 	LOG(RETRO_LOG_DEBUG, "Screen size set to %ix%i", width, height);
 	// }
 }
@@ -382,6 +703,7 @@ void rt_set_window_size(LibraryData* data, int width, int height) {
 	if ((data->private->gl.window_size[0] != width) || (data->private->gl.window_size[1] != height)) {
 		data->private->gl.window_size[0] = data->private->window_width = width;
 		data->private->gl.window_size[1] = data->private->window_height = height;
+		rt_damage(data);
 		LOG(RETRO_LOG_DEBUG, "Window size set to %ix%i", width, height);
 	}
 }
@@ -391,6 +713,7 @@ void rt_set_background_color(LibraryData* data, float r, float g, float b) {
 	data->private->gl.background_color[0] = r;
 	data->private->gl.background_color[1] = g;
 	data->private->gl.background_color[2] = b;
+	rt_damage(data);
 }
 
 
@@ -398,6 +721,7 @@ int rt_hw_render_setup(LibraryData* data) {
 	if (data->private->hw_render_state != HW_RENDER_DISABLED)
 		return 0;		// Already enabled or setting up
 	LOG(RETRO_LOG_DEBUG, "Setting up HW rendering...");
+	rt_set_threaded_video(data, 0);
 	rt_hw_render_reset(data);
 	return 0;
 }
@@ -0,0 +1,172 @@
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <errno.h>
+#include <inttypes.h>
+#include <signal.h>
+#include <unistd.h>
+#include <sys/syscall.h>
+#include <retrotouch.h>
+
+#define LOG(...) rt_log(data, "RTrace", __VA_ARGS__)
+
+/**
+ * Tracing. While enabled, start and duration of every phase of frame is
+ * stored into preallocated ring of events, overwriting oldest ones when
+ * ring is full. Ring is written to file in Chrome trace_event format when
+ * SIGUSR1 arrives or when runner exits. Python code adds its own events
+ * using same clock, so everything ends in single timeline.
+ */
+
+static volatile sig_atomic_t dump_requested = 0;
+static int wakeup_fd = -1;
+static __thread int thread_id = 0;
+
+
+static void rt_trace_signal(int sig) {
+	uint64_t one = 1;
+	dump_requested = 1;
+	// Wakes up rt_run_loop if it's waiting in poll
+	ssize_t trash = write(wakeup_fd, &one, sizeof(one));
+	(void)trash;
+}
+
+
+static int rt_trace_get_tid() {
+	if (thread_id == 0)
+		thread_id = (int)syscall(SYS_gettid);
+	return thread_id;
+}
+
+
+/**
+ * Tracing can be enabled only once. Other threads may be adding events
+ * at any time after that, so ring is never freed or replaced.
+ */
+int rt_trace_setup(LibraryData* data, const char* filename, size_t capacity) {
+	if (__atomic_load_n(&data->private->trace.events, __ATOMIC_ACQUIRE) != NULL) {
+		LOG(RETRO_LOG_ERROR, "Tracing is already enabled");
+		return 1;
+	}
+	if ((filename == NULL) || (capacity == 0)) {
+		LOG(RETRO_LOG_DEBUG, "Tracing disabled");
+		return 0;
+	}
+	
+	TraceEvent* events = malloc(sizeof(TraceEvent) * capacity);
+	char* filename_copy = strdup(filename);
+	if ((events == NULL) || (filename_copy == NULL)) {
+		free(events);
+		free(filename_copy);
+		LOG(RETRO_LOG_ERROR, "Failed to enable tracing: Failed to allocate memory");
+		return 1;
+	}
+	// Touched in advance, so page faults don't show in trace
+	memset(events, 0, sizeof(TraceEvent) * capacity);
+	data->private->trace.pid = getpid();
+	data->private->trace.capacity = capacity;
+	data->private->trace.filename = filename_copy;
+	// Published last, everything above has to be visible before events are
+	__atomic_store_n(&data->private->trace.events, events, __ATOMIC_RELEASE);
+	
+	struct sigaction sa;
+	memset(&sa, 0, sizeof(sa));
+	sa.sa_handler = rt_trace_signal;
+	sigemptyset(&sa.sa_mask);
+	sa.sa_flags = SA_RESTART;
+	wakeup_fd = data->private->run_loop.eventfd;
+	sigaction(SIGUSR1, &sa, NULL);
+	
+	LOG(RETRO_LOG_INFO, "Tracing enabled, send SIGUSR1 to %i to write trace to %s",
+			data->private->trace.pid, filename);
+	return 0;
+}
+
+
+uint64_t rt_trace_begin(LibraryData* data) {
+	if (__atomic_load_n(&data->private->trace.events, __ATOMIC_RELAXED) == NULL)
+		return 0;
+	return rt_get_time();
+}
+
+
+void rt_trace_end(LibraryData* data, const char* name, uint64_t start) {
+	if (start == 0)
+		return;
+	rt_trace_add(data, name, 0, 0, start, rt_get_time() - start);
+}
+
+
+void rt_trace_add(LibraryData* data, const char* name, int pid, int tid, uint64_t start, uint64_t duration) {
+	TraceEvent* events = __atomic_load_n(&data->private->trace.events, __ATOMIC_ACQUIRE);
+	if (events == NULL)
+		return;
+	uint64_t pos = __atomic_fetch_add(&data->private->trace.head, 1, __ATOMIC_RELAXED);
+	TraceEvent* event = &events[pos % data->private->trace.capacity];
+	event->start = start;
+	event->duration = duration;
+	event->pid = (pid == 0) ? data->private->trace.pid : pid;
+	event->tid = (tid == 0) ? rt_trace_get_tid() : tid;
+	strncpy(event->name, name, RT_TRACE_NAME_SIZE - 1);
+	event->name[RT_TRACE_NAME_SIZE - 1] = 0;
+}
+
+
+bool rt_trace_dump_requested(LibraryData* data) {
+	if (!dump_requested)
+		return false;
+	dump_requested = 0;
+	return true;
+}
+
+
+static void rt_trace_write_string(FILE* f, const char* s) {
+	fputc('"', f);
+	for (; *s != 0; s++) {
+		if ((*s == '"') || (*s == '\\'))
+			fprintf(f, "\\%c", *s);
+		else if ((unsigned char)*s < 0x20)
+			fprintf(f, "\\u%04x", (unsigned char)*s);
+		else
+			fputc(*s, f);
+	}
+	fputc('"', f);
+}
+
+
+int rt_trace_dump(LibraryData* data) {
+	TraceEvent* events = __atomic_load_n(&data->private->trace.events, __ATOMIC_ACQUIRE);
+	if (events == NULL)
+		return 1;
+	FILE* f = fopen(data->private->trace.filename, "w");
+	if (f == NULL) {
+		LOG(RETRO_LOG_ERROR, "Failed to write trace to %s: %s",
+				data->private->trace.filename, strerror(errno));
+		return 1;
+	}
+	
+	// Other threads keep adding events while this is running. Event that
+	// is overwritten while being written may end up garbled.
+	uint64_t head = __atomic_load_n(&data->private->trace.head, __ATOMIC_RELAXED);
+	uint64_t first = (head > data->private->trace.capacity) ? head - data->private->trace.capacity : 0;
+	fprintf(f, "{\"displayTimeUnit\": \"ms\", \"traceEvents\": [\n");
+	fprintf(f, "{\"name\": \"process_name\", \"ph\": \"M\", \"pid\": %i, \"args\": {\"name\": \"Runner\"}},\n",
+			data->private->trace.pid);
+	fprintf(f, "{\"name\": \"process_name\", \"ph\": \"M\", \"pid\": %i, \"args\": {\"name\": \"GUI\"}}",
+			(int)getppid());
+	for (uint64_t pos=first; pos<head; pos++) {
+		TraceEvent* event = &events[pos % data->private->trace.capacity];
+		fprintf(f, ",\n{\"name\": ");
+		rt_trace_write_string(f, event->name);
+		fprintf(f, ", \"ph\": \"X\", \"ts\": %" PRIu64 ", \"dur\": %" PRIu64 ", \"pid\": %i, \"tid\": %i}",
+				event->start, event->duration, event->pid, event->tid);
+	}
+	fprintf(f, "\n]}\n");
+	if (fclose(f) != 0) {
+		LOG(RETRO_LOG_ERROR, "Failed to write trace to %s: %s",
+				data->private->trace.filename, strerror(errno));
+		return 1;
+	}
+	LOG(RETRO_LOG_INFO, "Trace with %" PRIu64 " events written to %s", head - first, data->private->trace.filename);
+	return 0;
+}
@@ -0,0 +1,149 @@
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <pthread.h>
+#include <retrotouch.h>
+
+#define LOG(...) rt_log(data, "RVideo", __VA_ARGS__)
+
+
+bool rt_video_thread_active(LibraryData* data) {
+	return data->private->video_thread.enabled
+		&& !pthread_equal(pthread_self(), data->private->video_thread.thread);
+}
+
+
+static void* rt_video_thread_main(void* arg) {
+	LibraryData* data = (LibraryData*)arg;
+	glXMakeCurrent(data->private->dpy, data->window, data->private->gl.ctx);
+	
+	while (1) {
+		pthread_mutex_lock(&data->private->video_thread.lock);
+		while (!data->private->video_thread.fresh && !data->private->video_thread.redraw
+				&& !data->private->video_thread.vsync_changed && !data->private->video_thread.quit)
+			pthread_cond_wait(&data->private->video_thread.cond, &data->private->video_thread.lock);
+		if (data->private->video_thread.quit) {
+			pthread_mutex_unlock(&data->private->video_thread.lock);
+			break;
+		}
+		bool upload = data->private->video_thread.fresh;
+		bool vsync_changed = data->private->video_thread.vsync_changed;
+		if (upload) {
+			int display = data->private->video_thread.display;
+			data->private->video_thread.display = data->private->video_thread.ready;
+			data->private->video_thread.ready = display;
+			data->private->video_thread.fresh = false;
+		}
+		data->private->video_thread.redraw = false;
+		data->private->video_thread.vsync_changed = false;
+		pthread_mutex_unlock(&data->private->video_thread.lock);
+		
+		if (vsync_changed)
+			rt_vsync_enable(data, data->private->gl.vsync_enabled);
+		if (upload) {
+			int i = data->private->video_thread.display;
+			rt_upload_frame(data,
+				data->private->video_thread.slots[i].data,
+				data->private->video_thread.slots[i].width,
+				data->private->video_thread.slots[i].height,
+				data->private->video_thread.slots[i].pitch);
+		}
+		if (!rt_needs_redraw(data))
+			continue;
+		rt_present(data);
+	}
+	
+	glXMakeCurrent(data->private->dpy, None, NULL);
+	return NULL;
+}
+
+
+int rt_set_threaded_video(LibraryData* data, int enabled) {
+	if ((enabled != 0) == data->private->video_thread.enabled)
+		return 0;
+	
+	if (enabled) {
+		if (data->private->hw_render_state != HW_RENDER_DISABLED) {
+			LOG(RETRO_LOG_WARN, "Cannot enable threaded video: Not supported with HW rendering");
+			return 1;
+		}
+		pthread_mutex_init(&data->private->video_thread.lock, NULL);
+		pthread_cond_init(&data->private->video_thread.cond, NULL);
+		data->private->video_thread.write = 0;
+		data->private->video_thread.ready = 1;
+		data->private->video_thread.display = 2;
+		data->private->video_thread.fresh = false;
+		data->private->video_thread.quit = false;
+		data->private->video_thread.redraw = true;
+		data->private->video_thread.vsync_changed = true;
+		// Context can be current in only one thread at time
+		glXMakeCurrent(data->private->dpy, None, NULL);
+		data->private->video_thread.enabled = true;
+		if (0 != pthread_create(&data->private->video_thread.thread, NULL, rt_video_thread_main, data)) {
+			data->private->video_thread.enabled = false;
+			rt_make_current(data);
+			LOG(RETRO_LOG_ERROR, "Cannot enable threaded video: Failed to start thread");
+			return 2;
+		}
+		LOG(RETRO_LOG_DEBUG, "Threaded video enabled");
+	} else {
+		pthread_mutex_lock(&data->private->video_thread.lock);
+		data->private->video_thread.quit = true;
+		pthread_cond_signal(&data->private->video_thread.cond);
+		pthread_mutex_unlock(&data->private->video_thread.lock);
+		pthread_join(data->private->video_thread.thread, NULL);
+		data->private->video_thread.enabled = false;
+		pthread_cond_destroy(&data->private->video_thread.cond);
+		pthread_mutex_destroy(&data->private->video_thread.lock);
+		rt_make_current(data);
+		
+		// Last frame is still needed for rendering & screenshots
+		int i = data->private->video_thread.display;
+		if (data->private->video_thread.slots[i].data != NULL) {
+			rt_upload_frame(data,
+				data->private->video_thread.slots[i].data,
+				data->private->video_thread.slots[i].width,
+				data->private->video_thread.slots[i].height,
+				data->private->video_thread.slots[i].pitch);
+		}
+		LOG(RETRO_LOG_DEBUG, "Threaded video disabled");
+	}
+	return 0;
+}
+
+
+void rt_video_thread_push(LibraryData* data, const char* frame, unsigned width, unsigned height, size_t pitch) {
+	int i = data->private->video_thread.write;
+	size_t size = pitch * height;
+	if (data->private->video_thread.slots[i].allocated < size) {
+		// Happens only when geometry grows
+		char* new_data = realloc(data->private->video_thread.slots[i].data, size);
+		if (new_data == NULL) {
+			LOG(RETRO_LOG_ERROR, "Failed to queue frame: Failed to allocate memory");
+			return;
+		}
+		data->private->video_thread.slots[i].data = new_data;
+		data->private->video_thread.slots[i].allocated = size;
+	}
+	memcpy(data->private->video_thread.slots[i].data, frame, size);
+	data->private->video_thread.slots[i].width = width;
+	data->private->video_thread.slots[i].height = height;
+	data->private->video_thread.slots[i].pitch = pitch;
+	
+	pthread_mutex_lock(&data->private->video_thread.lock);
+	data->private->video_thread.write = data->private->video_thread.ready;
+	data->private->video_thread.ready = i;
+	if (data->private->video_thread.fresh)
+		data->private->video_thread.dropped ++;
+	data->private->video_thread.fresh = true;
+	pthread_cond_signal(&data->private->video_thread.cond);
+	pthread_mutex_unlock(&data->private->video_thread.lock);
+}
+
+
+void rt_video_thread_redraw(LibraryData* data) {
+	pthread_mutex_lock(&data->private->video_thread.lock);
+	data->private->video_thread.redraw = true;
+	pthread_cond_signal(&data->private->video_thread.cond);
+	pthread_mutex_unlock(&data->private->video_thread.lock);
+}
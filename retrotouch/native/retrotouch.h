@@ -6,14 +6,128 @@
 #include <GL/glx.h>
 #include <alsa/asoundlib.h>
 #include <libretro.h>
+#include <stdio.h>
 #include <unistd.h>
+#include <stdarg.h>
+#include <pthread.h>
 
 #define RT_MAX_PORTS		1
 #define RT_MAX_ANALOGS		2
 #define RT_MAX_IMAGES		4
 #define RT_DEBUG_FPS		1
 #define RT_AUDIO_ENABLED	1
+#define RT_VIDEO_QUEUE_SIZE	3			// Triple buffering
+#define RT_INPUT_RETRIES	1000		// How many times is torn input snapshot re-read
+#define RT_INPUT_QUEUE_SIZE	64			// Input events that can wait in shared memory
+#define RT_LOG_RING_SIZE	256			// Log records waiting to be read by Python
+#define RT_LOG_TAG_SIZE		16
+#define RT_LOG_MESSAGE_SIZE	512
+#define RT_LOG_DRAIN_INTERVAL	100000	// How often is Python asked to read log from run loop (µs)
+#define RT_HUD_HISTORY		120			// Frames shown in frame time graph of performance HUD
+#define RT_HUD_PIXEL_SIZE	2			// Size of one HUD pixel in (unscaled) window pixels
+#define RT_HUD_MAX_VERTICES	16384
+#define RT_TRACE_NAME_SIZE	32
+#define RT_GPU_QUERY_FRAMES	4			// Measurements of single pass that may be in flight at once
+#define RT_LATENCY_BUCKETS	64			// Buckets of input latency histogram
+#define RT_LATENCY_BUCKET_SIZE	2000	// Width of single histogram bucket (µs)
+#define RT_PBO_COUNT		3			// Pixel buffers used to upload frames
+#define RT_MAX_FAST_FORWARD	16
+#define RT_MAX_RUN_AHEAD	4
+#define RT_REWIND_BUDGET	(8 * 1024 * 1024)	// Default memory used for rewind history (bytes)
+#define RT_REWIND_INTERVAL	4		// Default number of frames between two rewind snapshots
+#define RT_AUDIO_RING_SIZE	16384		// Capacity (frames) of buffer between emulation and audio thread, power of two
+#define RT_AUDIO_PENDING	(48000 / 10)	// Frames collected during single retro_run before they are flushed
+#define RT_AUDIO_CHUNK		512			// Maximum frames written to audio device at once
+#define RT_AUDIO_MAX_SKEW	0.005		// Maximum adjustment of playback rate done by rate control
+#define RT_AUDIO_LATENCY	20000		// Initial audio device latency (µs)
+#define RT_AUDIO_MIN_LATENCY	10000
+#define RT_AUDIO_MAX_LATENCY	200000
+#define RT_AUDIO_UNDERRUNS	3			// Underruns per second that cause latency to be increased
+#define RT_AUDIO_STABLE_TIME	60		// Seconds without underrun after which latency is decreased
+#define RT_PACER_HISTORY	512			// Number of frames used to compute pacing statistics
+#define RT_PACER_SPIN_TIME	0			// Default spin-wait time (µs), 0 to disable
+#define RT_PACER_RESYNC		50000		// Default resync threshold (µs)
 struct CoreData;
+struct AudioBackend;
+
+
+typedef struct {
+	uint64_t time;				// When message was logged (µs, CLOCK_MONOTONIC)
+	int level;					// enum retro_log_level
+	char tag[RT_LOG_TAG_SIZE];
+	char message[RT_LOG_MESSAGE_SIZE];
+} LogRecord;
+
+
+struct LogSlot {
+	uint64_t seq;
+	LogRecord record;
+};
+
+typedef struct {
+	uint64_t start;				// µs, CLOCK_MONOTONIC
+	uint64_t duration;			// µs
+	int pid;
+	int tid;
+	char name[RT_TRACE_NAME_SIZE];
+} TraceEvent;
+
+enum GpuPass {
+	GPU_PASS_GAME,			// Drawing game screen
+	GPU_PASS_PADS,			// Uploading & drawing pad images
+	GPU_PASS_CORE,			// retro_run of HW-rendered core
+	GPU_PASSES
+};
+
+typedef struct {
+	uint64_t samples;			// Measurements in last second
+	uint64_t skipped;			// Passes not measured in last second because all queries were in flight
+	double min;					// µs
+	double mean;
+	double max;
+} GpuTimerStats;
+
+typedef struct {
+	uint64_t count;
+	uint64_t sum;				// µs
+	uint64_t max;				// µs
+	// Bucket i counts latencies from i * RT_LATENCY_BUCKET_SIZE up; last one counts everything above
+	uint64_t buckets[RT_LATENCY_BUCKETS];
+} LatencyHistogram;
+
+struct GpuPassTimer {
+	GLuint queries[RT_GPU_QUERY_FRAMES][2];	// Timestamps before & after pass
+	bool pending[RT_GPU_QUERY_FRAMES];		// Set while result was not read yet
+	int next;					// Pair used by next measurement
+	int oldest;					// Oldest pair that may be pending
+	bool active;				// Set between begin and end
+	uint64_t since;				// When current one-second window started (µs)
+	uint64_t samples;			// Collected in current window
+	uint64_t skipped;
+	double sum, min, max;
+	GpuTimerStats last;			// Last complete window
+	uint seq;					// Odd while 'last' is being written
+};
+
+enum HudPhase {
+	HUD_CORE,				// Running core
+	HUD_UPLOAD,				// Uploading frame to texture
+	HUD_RENDER,
+	HUD_SWAP,
+	HUD_PHASES
+};
+
+struct HudVertex {
+	GLfloat position[2];
+	GLfloat color[4];
+};
+
+enum PboMode {
+	PBO_UNKNOWN,			// Not decided yet
+	PBO_DISABLED,			// Frames are uploaded directly from core memory
+	PBO_STREAMING,			// Buffers are orphaned & mapped for every frame
+	PBO_PERSISTENT			// Buffers are mapped once (ARB_buffer_storage)
+};
 
 enum HwRenderState {
 	HW_RENDER_DISABLED,
@@ -32,6 +146,52 @@ typedef struct {
 	enum HwRenderState hw_render_state;
 	uint64_t serialization_quirks;
 	Display* dpy;
+	// Set while running frames that are not going to be presented (or heard).
+	// Video or audio generated by core during such frame is thrown away.
+	bool discard_video;
+	bool discard_audio;
+	// When set, frame pacer is not used at all and frames are generated as fast as possible
+	bool uncapped;
+	bool paused;
+	
+	struct {
+		int eventfd;				// Used to wake up rt_run_loop from other thread
+		bool quit;
+		bool running;
+	} run_loop;
+	
+	struct {
+		int level;					// Messages with lower level are not logged at all
+		pthread_t main_thread;
+		uint64_t head;				// Position of next record to write, shared by all threads
+		uint64_t tail;				// Position of next record to read, used only by main thread
+		uint64_t dropped;			// Records not logged because ring was full
+		uint64_t reported_dropped;
+		uint64_t last_drain;
+		struct LogSlot slots[RT_LOG_RING_SIZE];
+	} log;
+	
+	struct {
+		bool enabled;
+		bool probed;				// Set once support for timer queries was checked
+		struct GpuPassTimer passes[GPU_PASSES];
+	} gpu_timer;
+	
+	struct {
+		uint64_t polled;			// Time of last input change seen in shared memory
+		uint64_t unread;			// Time of change not read by core yet, 0 if there is none
+		uint64_t unpresented;		// Time of change read by core but not presented yet; Accessed atomically
+		LatencyHistogram to_read;	// From input change to core reading it
+		LatencyHistogram to_present;	// From input change to presenting first frame after core read it
+	} latency;
+	
+	struct {
+		TraceEvent* events;			// NULL while tracing is disabled. Set only once
+		size_t capacity;
+		uint64_t head;				// Events added so far, shared by all threads
+		char* filename;
+		int pid;
+	} trace;
 	
 	struct {
 		uint64_t since;
@@ -41,11 +201,121 @@ typedef struct {
 	} fps;
 	
 	struct {
-		int frequency;
+		// Set (atomically, as video thread reads it) when something visible
+		// changed since last present
+		bool dirty;
+		// Copy of pad images & scale as they were at last present
+		float scale_factor;
+		struct {
+			uint version;
+			int x, y;
+			uint width, height;
+			size_t size;
+		} images[RT_MAX_IMAGES];
+		bool show_hud;
+		uint64_t presented;
+		uint64_t skipped;
+	} damage;
+	
+	struct {
+		// Time spent in each phase of current frame (µs). Upload, render
+		// and swap are added by video thread while it's running
+		uint64_t current[HUD_PHASES];
+		uint64_t history[RT_HUD_HISTORY][HUD_PHASES];
+		size_t next;				// Position in history where next frame is stored
+		uint64_t since;				// When current one-second window started (µs)
+		uint64_t emulated;			// Counted in current window
+		uint64_t skipped;
+		uint64_t duplicated;
+		uint64_t dropped;			// Frames dropped by video thread before current window
+		double fps;					// Computed from last complete window
+		double skipped_rate;
+		double duplicated_rate;
+		GLuint vao;
+		GLuint vbo;
+		size_t vertex_count;
+		struct HudVertex vertices[RT_HUD_MAX_VERTICES];
+	} hud;
+	
+	struct {
+		int frequency;				// 0 while backend is not opened
+		const struct AudioBackend* backend;	// Default one is used while not set
+		bool active;				// Set while opened backend takes samples
+		char* filename;				// Used by 'wav' backend
 		snd_pcm_uframes_t buffer_size;
 		snd_pcm_t* device;
+		struct {
+			FILE* file;
+			int frequency;
+			uint32_t frames;		// Frames written so far
+		} wav;
+		struct {
+			int16_t* data;			// Interleaved stereo frames
+			size_t size;			// Capacity in frames, power of two
+			size_t head;			// Frames written so far; Modified only by emulation thread
+			size_t tail;			// Frames played so far; Modified only by audio thread
+		} ring;
+		pthread_t thread;
+		pthread_mutex_t lock;		// Guards sleeping of audio thread while ring buffer is empty
+		pthread_cond_t cond;
+		bool thread_running;
+		bool quit;
+		double position;			// Position of resampler between two input frames
+		int16_t last[2];			// Last input frame
+		double ratio;				// Last used resampling ratio
+		struct {
+			int16_t* data;			// Samples generated by core during current frame
+			size_t size;			// Capacity in frames
+			size_t used;
+		} pending;
+		uint64_t flushes;
+		uint64_t flushed;			// Total frames flushed
+		uint64_t last_flushed;		// Frames flushed after last retro_run
+		uint64_t max_flushed;
+		uint64_t underruns;
+		uint64_t overruns;			// Frames dropped because ring buffer was full
+		struct {
+			unsigned int latency;	// Currently used latency (µs)
+			uint64_t next_check;	// When underruns are counted next time (µs)
+			uint64_t underruns;		// Underruns counted at last check
+			unsigned int stable;	// Seconds since last underrun
+			bool changed;			// Set by audio thread when latency changes
+		} tuner;
 	} audio;
 	
+	struct {
+		uint64_t deadline;			// Absolute time when next frame should end (ns, CLOCK_MONOTONIC)
+		uint64_t spin_time;			// Last part of every wait is busy-waited (ns, 0 to disable)
+		uint64_t resync_threshold;	// When frame overruns deadline by more than this (ns),
+									// deadline is reset instead of catching up
+		uint64_t frames;
+		uint64_t overruns;
+		uint64_t resyncs;
+		uint64_t errors[RT_PACER_HISTORY];	// Recent pacing errors (ns)
+	} pacer;
+	
+	struct {
+		bool enabled;
+		pthread_t thread;
+		pthread_mutex_t lock;
+		pthread_cond_t cond;
+		struct {
+			char* data;
+			size_t allocated;
+			unsigned int width;
+			unsigned int height;
+			size_t pitch;
+		} slots[RT_VIDEO_QUEUE_SIZE];
+		int write;					// Slot being filled by emulation thread
+		int ready;					// Last complete frame
+		int display;				// Slot being uploaded & presented by video thread
+		bool fresh;					// Set when 'ready' holds frame not yet presented
+		bool redraw;				// Set when video thread should present even without new frame
+		bool vsync_changed;
+		bool quit;
+		uint64_t dropped;			// Frames replaced before being presented
+	} video_thread;
+	
 	struct {
 		struct {
 			GLuint id;
@@ -65,8 +335,22 @@ typedef struct {
 			GLint u_position;
 			GLfloat u_scale_factor;
 		} prog_pads;
+		struct {
+			GLuint id;
+			GLint u_window_size;
+		} prog_hud;
 		
 		GLuint texture;
+		unsigned int texture_width;		// Size texture storage was last allocated with
+		unsigned int texture_height;
+		struct {
+			enum PboMode mode;
+			GLuint ids[RT_PBO_COUNT];
+			void* mapped[RT_PBO_COUNT];	// Used only with PBO_PERSISTENT
+			GLsync fences[RT_PBO_COUNT];
+			size_t size;
+			int next;
+		} pbo;
 		GLuint depth;
 		GLuint fbo;
 		GLuint vao;
@@ -74,6 +358,7 @@ typedef struct {
 		
 		struct {
 			uint version;
+			uint width, height;		// Size texture storage was allocated with
 			GLuint tex;
 		} images[RT_MAX_IMAGES];
 		
@@ -103,13 +388,39 @@ struct InputState {
 	int16_t analogs[2 * RT_MAX_ANALOGS];
 	int16_t mouse[2];
 	uint mouse_buttons;
+	uint64_t time;				// When was input last changed (µs, CLOCK_MONOTONIC), 0 if unknown
+};
+
+
+enum InputEventType {
+	INPUT_EVENT_BUTTON,
+	INPUT_EVENT_MOUSE_BUTTON,
+};
+
+
+struct InputEvent {
+	uint64_t time;				// When event was queued (µs, CLOCK_MONOTONIC)
+	uint16_t type;				// InputEventType
+	uint16_t index;				// Button number
+	int32_t value;				// 1 for press, 0 for release
 };
 
 
 struct SharedData {
 	size_t size;
 	float scale_factor;
+	uint show_hud;				// Set to draw performance HUD over game
+	// Sequence counter of input_state; odd while GUI is writing it
+	uint input_seq;
 	struct InputState input_state;
+	// Button changes queued by GUI. 'head' is written only by GUI,
+	// 'tail' only by runner. Both are never wrapped to queue size
+	struct {
+		uint head;
+		uint tail;
+		uint dropped;			// Events not queued because queue was full
+		struct InputEvent events[RT_INPUT_QUEUE_SIZE];
+	} input_queue;
 	struct {
 		uint version;
 		int x, y;
@@ -117,19 +428,84 @@ struct SharedData {
 		uint height;
 		size_t offset;
 		size_t size;
+		// Area changed by last version increment
+		uint dirty_x, dirty_y;
+		uint dirty_width, dirty_height;
 	} images[RT_MAX_IMAGES];
 };
 
 
+typedef struct {
+	uint64_t frames;			// Frames paced so far
+	uint64_t overruns;			// Frames that finished after their deadline
+	uint64_t resyncs;			// Overruns too big to catch up with
+	double mean_error;			// Mean pacing error over recent frames (µs)
+	double p99_error;			// 99th percentile of pacing error over recent frames (µs)
+} PacerStats;
+
+
+typedef struct {
+	uint64_t events;			// Input events processed so far
+	uint64_t deferred;			// Frames when some events were left for next frame
+	uint64_t dropped;			// Events lost because queue was full
+	uint64_t age_last;			// Age of oldest event processed in last frame (µs)
+	uint64_t age_max;
+} InputStats;
+
+
+typedef struct {
+	uint64_t presented;			// Frames rendered & swapped
+	uint64_t skipped;			// Presents skipped because nothing changed
+} RenderStats;
+
+
+typedef struct {
+	uint64_t core;				// Time spent by each phase of frame (µs)
+	uint64_t upload;
+	uint64_t render;
+	uint64_t swap;
+} FrameTimes;
+
+
+typedef struct {
+	uint64_t captures;			// Snapshots taken so far
+	uint64_t entries;			// Snapshots currently held in history
+	uint64_t used;				// Bytes of history buffer in use
+	uint64_t budget;			// Size of history buffer
+	double capture_time_mean;	// Mean time needed to take snapshot (µs)
+	double capture_time_max;	// Longest time needed to take snapshot (µs)
+} RewindStats;
+
+
+typedef struct {
+	uint64_t capacity;			// Size of audio ring buffer (frames)
+	uint64_t fill;				// Frames currently waiting in ring buffer
+	uint64_t underruns;			// Times audio device ran out of data
+	uint64_t overruns;			// Frames dropped because ring buffer was full
+	uint64_t latency;			// Latency of audio device, as set by latency tuner (µs)
+	double ratio;				// Resampling ratio currently used by rate control
+	double frame_samples_mean;	// Mean number of frames generated by single retro_run
+	uint64_t frame_samples_last;
+	uint64_t frame_samples_max;
+} AudioStats;
+
+
 typedef struct {
 	const char* res_path;
 	const char* save_path;
 	int parent;
 	int window;
-	void (*cb_log) (const char* tag, int level, const char* message);
+	// Set to run without visible window and without audio device
+	int headless;
+	// Called on main thread when log records are waiting to be read by rt_log_pop
+	void (*cb_log_ready) (void);
 	void (*cb_render_size_changed) (int width, int height);
 	const char* (*cb_get_variable) (const char* key);
 	void (*cb_set_variable) (const char* key, const char* options);
+	void (*cb_audio_latency_changed) (int latency);
+	// Called by rt_run_loop when there is something to read on RPC fd.
+	// Returning non-zero value stops loop
+	int (*cb_rpc_ready) (void);
 	int variables_changed;
 	struct SharedData* shared_data;
 	PrivateData* private;
@@ -137,16 +513,90 @@ typedef struct {
 } LibraryData;
 
 
+void rt_log_init(LibraryData* data);
+// Sets minimal level of messages that are logged
+void rt_set_log_level(LibraryData* data, int level);
+// Formats message and stores it in log ring. Can be called from any thread
 void rt_log(LibraryData* data, const char* tag, enum retro_log_level level, const char *fmt, ...);
+void rt_logv(LibraryData* data, const char* tag, enum retro_log_level level, const char *fmt, va_list va);
+// Reads oldest record from log ring. Returns 0 if there is nothing to read
+int rt_log_pop(LibraryData* data, LogRecord* record);
+// Returns number of records dropped because log ring was full
+uint64_t rt_log_get_dropped(LibraryData* data);
+// Calls cb_log_ready if there is anything to read. Called only from main thread
+void rt_log_drain(LibraryData* data);
 void rt_set_error(LibraryData* data, const char* message);
-// Returns time in µs
-useconds_t rt_get_time();
+// Returns monotonic time in µs
+uint64_t rt_get_time();
+// Returns monotonic time in ns
+uint64_t rt_get_time_ns();
 
 int rt_init(LibraryData* data);
 int rt_init_gl(LibraryData* data);
 void rt_step_paused(LibraryData* data);
 void rt_step(LibraryData* data);
+// Selects between rt_step and rt_step_paused in rt_run_loop
+void rt_set_paused(LibraryData* data, int paused);
+// Steps game until rt_run_loop_stop is called or cb_rpc_ready asks to stop.
+// Returns 0 when stopped, non-zero on error
+int rt_run_loop(LibraryData* data, int rpc_fd);
+// Stops rt_run_loop. Can be called from any thread
+void rt_run_loop_stop(LibraryData* data);
+// Sets spin-wait time and resync threshold of frame pacer (both in µs)
+void rt_pacer_configure(LibraryData* data, int spin_time, int resync_threshold);
+// Drops pacer deadline, so next frame is paced from scratch
+void rt_pacer_reset(LibraryData* data);
+// Fills 'stats' with frame pacing statistics
+void rt_pacer_get_stats(LibraryData* data, PacerStats* stats);
+// Sets how many times is core stepped for each presented frame. If 'uncapped'
+// is set, frames are generated as fast as possible. factor=1 and uncapped=0
+// turns fast-forward off.
+void rt_set_fast_forward(LibraryData* data, int factor, int uncapped);
 void rt_render(LibraryData* data);
+// Renders and swaps buffers, measuring time spent by both for HUD
+void rt_present(LibraryData* data);
+// Marks window as needing redraw
+void rt_damage(LibraryData* data);
+// Returns true if anything visible changed since last call. Counts skipped
+// presents, so caller is expected to present only if this returns true.
+bool rt_needs_redraw(LibraryData* data);
+// Fills 'stats' with numbers of presented and skipped frames
+void rt_render_get_stats(LibraryData* data, RenderStats* stats);
+// Enables tracing into ring of 'capacity' events, written to 'filename' by
+// rt_trace_dump. capacity=0 leaves tracing disabled. Once enabled, tracing
+// can't be set up again. Returns 0 on success
+int rt_trace_setup(LibraryData* data, const char* filename, size_t capacity);
+// Returns start time to be passed to rt_trace_end, or 0 if tracing is disabled
+uint64_t rt_trace_begin(LibraryData* data);
+// Records event that started at 'start'. Can be called from any thread
+void rt_trace_end(LibraryData* data, const char* name, uint64_t start);
+// Records event measured elsewhere. pid and tid set to 0 mean current process & thread
+void rt_trace_add(LibraryData* data, const char* name, int pid, int tid, uint64_t start, uint64_t duration);
+// Returns true (once) if SIGUSR1 asked for trace to be written
+bool rt_trace_dump_requested(LibraryData* data);
+// Writes recorded events as Chrome trace JSON. Returns 0 on success
+int rt_trace_dump(LibraryData* data);
+// Enables or disables measuring of render passes on GPU
+void rt_gpu_timer_enable(LibraryData* data, int enabled);
+// Marks start and end of measured pass. Called only from thread that owns GL context
+void rt_gpu_timer_begin(LibraryData* data, enum GpuPass pass);
+void rt_gpu_timer_end(LibraryData* data, enum GpuPass pass);
+// Fills 'stats' (array of GPU_PASSES items) with results from last second
+void rt_gpu_timer_get_stats(LibraryData* data, GpuTimerStats* stats);
+// Adds time (µs) spent in given phase to current frame of HUD graph. Can be called from any thread
+void rt_hud_add_time(LibraryData* data, enum HudPhase phase, uint64_t time);
+// Counts frames run by core and frames that were not presented
+void rt_hud_add_frames(LibraryData* data, unsigned int emulated, unsigned int skipped);
+// Counts frame that core asked to be presented again
+void rt_hud_frame_duplicated(LibraryData* data);
+// Finishes current frame of HUD graph. Called once for every rt_step
+void rt_hud_end_frame(LibraryData* data);
+// Fills 'times' with phases of last frame finished by rt_step
+void rt_get_frame_times(LibraryData* data, FrameTimes* times);
+// Compiles HUD shaders. HUD is not drawn if this fails
+void rt_hud_setup(LibraryData* data);
+// Draws HUD over rendered frame
+void rt_hud_render(LibraryData* data);
 void rt_make_current(LibraryData* data);
 void rt_compile_shaders(LibraryData* data);
 void rt_setup_texture(LibraryData* data);
@@ -155,8 +605,24 @@ const char* rt_check_error(LibraryData* data);
 int rt_check_saving_supported(LibraryData* data);
 // Returns 0 on success. Can be called multiple times to reconfigure frequency
 int rt_audio_init(LibraryData* data, int frequency);
+// Selects 'alsa', 'null' or 'wav' backend. Filename is used only by 'wav'.
+// If audio is already running, it's reopened with new backend. Returns 0 on success
+int rt_audio_set_backend(LibraryData* data, const char* name, const char* filename);
+// Stops audio thread and closes backend, finishing WAV file if there is one
+void rt_audio_close(LibraryData* data);
+// Sets latency (µs) audio device starts with. Latency is then adjusted
+// automatically, based on number of underruns.
+void rt_audio_set_latency(LibraryData* data, int latency);
+// Calls cb_audio_latency_changed if tuner changed latency since last call.
+// Called by rt_run_loop, so callback runs between frames on main thread
+void rt_audio_report_latency(LibraryData* data);
+// Fills 'stats' with audio buffer statistics
+void rt_audio_get_stats(LibraryData* data, AudioStats* stats);
+// Both functions just collect samples, actual output is done by rt_audio_flush
 void rt_audio_sample(LibraryData* data, int16_t left, int16_t right);
 size_t rt_audio_sample_batch(LibraryData* data, const int16_t* audiodata, size_t frames);
+// Sends samples collected since last call to audio thread. Called after every retro_run
+void rt_audio_flush(LibraryData* data);
 
 // Callback called when core decides on desired internal render size
 void rt_set_render_size(LibraryData* data, int width, int height);
@@ -175,6 +641,19 @@ int rt_load_state(LibraryData* data, const char* filename);
 
 // Callback called when core has video frame ready
 void rt_retro_frame(LibraryData* data, const char* frame, unsigned width, unsigned height, size_t pitch);
+// Uploads frame generated by core into texture
+void rt_upload_frame(LibraryData* data, const char* frame, unsigned width, unsigned height, size_t pitch);
+
+// Starts or stops thread that uploads & presents frames. Only software-rendered
+// cores are supported. While thread is running, it owns GL context and
+// emulation thread must not touch it. Returns 0 on success
+int rt_set_threaded_video(LibraryData* data, int enabled);
+// Returns true if video thread is running and caller is not video thread itself
+bool rt_video_thread_active(LibraryData* data);
+// Copies frame into queue of frames to be presented by video thread
+void rt_video_thread_push(LibraryData* data, const char* frame, unsigned width, unsigned height, size_t pitch);
+// Asks video thread to present last frame again
+void rt_video_thread_redraw(LibraryData* data);
 // Callback called when core requests HW rendering. Returns 0 for success
 int rt_hw_render_setup(LibraryData* data);
 // Called from event after rt_hw_render_setup is called and gl contect
@@ -192,6 +671,25 @@ int rt_game_load(LibraryData* data, const char* filename);
 void rt_core_unload();
 // Returns 1 if game is loaded
 int rt_get_game_loaded(LibraryData* data);
+// Sets number of frames to run ahead (0 to disable). Returns 0 on success
+int rt_set_run_ahead(LibraryData* data, int frames);
+// Allocates rewind history of 'budget' bytes, with snapshot taken every
+// 'interval' frames. budget=0 disables rewind. Returns 0 on success
+int rt_rewind_setup(LibraryData* data, size_t budget, int interval);
+// While rewinding is set, every step moves game one snapshot back
+void rt_set_rewinding(LibraryData* data, int rewinding);
+// Fills 'stats' with rewind history statistics
+void rt_rewind_get_stats(LibraryData* data, RewindStats* stats);
+// Fills 'stats' with input queue statistics
+void rt_input_get_stats(LibraryData* data, InputStats* stats);
+// Called with timestamp of every input snapshot read from shared memory
+void rt_latency_input_polled(LibraryData* data, uint64_t time);
+// Called when core reads input. Does something only when there is unread change
+void rt_latency_input_read(LibraryData* data);
+// Called after frame was presented. Can be called from video thread
+void rt_latency_presented(LibraryData* data);
+// Fills both histograms with latencies measured since runner started
+void rt_latency_get_stats(LibraryData* data, LatencyHistogram* to_read, LatencyHistogram* to_present);
 // Steps game one time (call this 60 times per second to get 60 FPS)
 void rt_core_step(LibraryData* data);
 // Does everything what rt_core_step, with important exception of actually running game. Called while paused.
@@ -4,11 +4,37 @@ RetroTouch - shared_data structure
 
 Portion of memory shared by both processes.
 """
-import ctypes, tempfile, mmap
+from retrotouch.trace import traced, get_time
+from retrotouch.tools import find_library
+import ctypes, tempfile, mmap, fcntl, os
 
 RT_MAX_PORTS		= 1
 RT_MAX_ANALOGS		= 2
 RT_MAX_IMAGES		= 4
+RT_INPUT_QUEUE_SIZE	= 64
+
+INPUT_EVENT_BUTTON			= 0
+INPUT_EVENT_MOUSE_BUTTON	= 1
+
+# Size of shared memory. It's reserved in advance and never resized,
+# but memory is allocated only for pages that are actually used.
+RT_SHM_SIZE			= 32 * 1024 * 1024
+
+MFD_ALLOW_SEALING	= 0x0002
+F_ADD_SEALS			= 1033
+F_SEAL_SEAL			= 0x0001
+F_SEAL_SHRINK		= 0x0002
+F_SEAL_GROW			= 0x0004
+
+
+_libc = ctypes.CDLL(None, use_errno=True)
+# Python cannot order its stores, so input is published by small C helper
+_input = find_library("libshared_input")
+_input.rt_input_publish.argtypes = [ ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t ]
+_input.rt_input_publish.restype = None
+_input.rt_input_queue_push.argtypes = [ ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+		ctypes.c_uint, ctypes.c_void_p, ctypes.c_size_t ]
+_input.rt_input_queue_push.restype = ctypes.c_int
 
 
 class InputState(ctypes.Structure):
@@ -17,6 +43,25 @@ class InputState(ctypes.Structure):
 		("analogs", ctypes.c_int16 * (2 * RT_MAX_ANALOGS)),
 		("mouse", ctypes.c_int16 * 2),
 		("mouse_buttons", ctypes.c_uint),
+		("time", ctypes.c_uint64),
+	]
+
+
+class InputEvent(ctypes.Structure):
+	_fields_ = [
+		("time", ctypes.c_uint64),
+		("type", ctypes.c_uint16),
+		("index", ctypes.c_uint16),
+		("value", ctypes.c_int32),
+	]
+
+
+class _InputQueue(ctypes.Structure):
+	_fields_ = [
+		("head", ctypes.c_uint),
+		("tail", ctypes.c_uint),
+		("dropped", ctypes.c_uint),
+		("events", InputEvent * RT_INPUT_QUEUE_SIZE),
 	]
 
 
@@ -27,8 +72,16 @@ class _ImageData(ctypes.Structure):
 		("y", ctypes.c_int),
 		("width", ctypes.c_uint),
 		("height", ctypes.c_uint),
+		# Image is stored twice, in two slots of 'size' bytes starting at
+		# 'offset'. Slot (version % 2) holds current image. 'size' is size
+		# of largest image stored at index, current one may be smaller
 		("offset", ctypes.c_size_t),
 		("size", ctypes.c_size_t),
+		# Area changed by last version increment
+		("dirty_x", ctypes.c_uint),
+		("dirty_y", ctypes.c_uint),
+		("dirty_width", ctypes.c_uint),
+		("dirty_height", ctypes.c_uint),
 	]
 
 
@@ -36,51 +89,105 @@ class _SharedData(ctypes.Structure):
 	_fields_ = [
 		("size", ctypes.c_size_t),
 		("scale_factor", ctypes.c_float),
+		("show_hud", ctypes.c_uint),
+		("input_seq", ctypes.c_uint),
 		("input_state", InputState),
+		("input_queue", _InputQueue),
 		("image_data", _ImageData * 4)
 	]
 
 
 class SharedData:
 	
-	def __init__(self, filename=None, readwrite=True):
-		size = 5 * 102400 # ctypes.sizeof(_SharedData)
-		
-		# Prepare file
-		if filename is None:
-			tmp = tempfile.NamedTemporaryFile("w+b", prefix="retrotouch-", delete=False)
-			self.filename = tmp.name
-			f = tmp.file
+	def __init__(self, fd=None, readwrite=True):
+		"""
+		Creates new shared memory or, if 'fd' is set, maps one created
+		by other process and inherited from it.
+		"""
+		size = RT_SHM_SIZE
+		if fd is None:
+			fd = SharedData._create(size)
+			creating = True
 		else:
-			tmp = None
-			f = file(filename, "w+b")
-			self.filename = filename
-		f.seek(size + 1)
-		f.write(b'\x00')
-		f.seek(0)
+			creating = False
+		self.fd = fd
 		
 		# Prepare mmap
 		proto = mmap.PROT_WRITE | mmap.PROT_READ if readwrite else mmap.PROT_WRITE
-		self.mmap = mmap.mmap(f.fileno(), size, mmap.MAP_SHARED, proto)
+		self.mmap = mmap.mmap(fd, size, mmap.MAP_SHARED, proto)
 		
 		# Finish
 		self._data = _SharedData.from_buffer(self.mmap)
-		self._data.size = size
-		self.input_state = self._data.input_state
+		if creating:
+			self._data.size = size
+		# Input is modified here and then copied to shared memory by publish_input
+		self.input_state = InputState()
+		# Last image stored for each index as (bytes, rows) and (first, count)
+		# of rows that differ between current and other slot
+		self._images = [ None ] * RT_MAX_IMAGES
+		self._stale = [ None ] * RT_MAX_IMAGES
 	
-	def _resize(self, new_size):
-		""" Changes size of allocated mmap """
-		new_size = max(new_size, 5 * 102400) # ctypes.sizeof(_SharedData))
-		self.mmap.resize(new_size)
-		self._data = _SharedData.from_buffer(self.mmap)
-		self._data.size = new_size
-		self.input_state = self._data.input_state
-		self.mmap.flush()
+	def publish_input(self, stamp=True):
+		"""
+		Copies input_state to shared memory. Sequence counter is odd while
+		copying, so runner never reads half-written state.
+		With 'stamp' set, change is timestamped so runner can measure latency.
+		"""
+		if stamp:
+			self.input_state.time = get_time()
+		_input.rt_input_publish(
+			ctypes.addressof(self._data) + _SharedData.input_seq.offset,
+			ctypes.addressof(self._data.input_state),
+			ctypes.addressof(self.input_state), ctypes.sizeof(InputState))
+	
+	def push_input_event(self, type, index, value):
+		"""
+		Queues button change, so runner sees it even if it's reverted
+		before next frame. Should be followed by publish_input.
+		Head is moved by C helper only after event is stored.
+		"""
+		queue = self._data.input_queue
+		event = InputEvent(get_time(), type, index, 1 if value else 0)
+		base = ctypes.addressof(queue)
+		if 0 == _input.rt_input_queue_push(
+				base + _InputQueue.head.offset, base + _InputQueue.tail.offset,
+				base + _InputQueue.events.offset, RT_INPUT_QUEUE_SIZE,
+				ctypes.addressof(event), ctypes.sizeof(InputEvent)):
+			queue.dropped += 1
+	
+	@staticmethod
+	def _create(size):
+		"""
+		Creates anonymous file of given size and returns its descriptor.
+		memfd is used when available and its size is sealed.
+		Unlinked file in /dev/shm or in temp directory is used otherwise.
+		"""
+		try:
+			fd = _libc.memfd_create(b"retrotouch", MFD_ALLOW_SEALING)
+		except AttributeError:
+			# Too old libc
+			fd = -1
+		if fd >= 0:
+			os.ftruncate(fd, size)
+			try:
+				fcntl.fcntl(fd, F_ADD_SEALS, F_SEAL_SHRINK | F_SEAL_GROW | F_SEAL_SEAL)
+			except IOError:
+				pass
+			return fd
+		
+		directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+		fd, filename = tempfile.mkstemp(prefix="retrotouch-", dir=directory)
+		os.unlink(filename)
+		os.ftruncate(fd, size)
+		# mkstemp sets close-on-exec, but descriptor has to be inherited by runner
+		fcntl.fcntl(fd, fcntl.F_SETFD, 0)
+		return fd
 	
 	def clear_images(self):
-		for x in self.image_data:
+		for x in self._data.image_data:
 			x.offset = x.size = 0
-		self._resize(0)
+		self._images = [ None ] * RT_MAX_IMAGES
+		self._stale = [ None ] * RT_MAX_IMAGES
 	
 	def set_image_pos(self, index, x, y, width, height):
 		assert index < RT_MAX_IMAGES
@@ -89,35 +196,111 @@ class SharedData:
 		self._data.image_data[index].width = width
 		self._data.image_data[index].height = height
 	
+	@staticmethod
+	def _get_changed_rows(old, new, height):
+		"""
+		Compares two images and returns (first, count) of rows that differ.
+		Returns (0, 0) if there is no difference.
+		"""
+		stride = len(new) / height
+		same = lambda row : (old[row * stride : (row + 1) * stride]
+				== new[row * stride : (row + 1) * stride])
+		first, last = 0, height - 1
+		while first <= last and same(first):
+			first += 1
+		while last > first and same(last):
+			last -= 1
+		return first, last - first + 1
+	
+	def _allocate(self, size):
+		"""
+		Finds place for two slots of 'size' bytes, using first gap between
+		images that is large enough. Raises MemoryError if there is none.
+		"""
+		used = sorted([ (x.offset, x.offset + 2 * x.size)
+				for x in self._data.image_data if x.size > 0 ])
+		offset = ctypes.sizeof(_SharedData) + 16
+		for start, end in used:
+			if offset + 2 * size <= start:
+				break
+			offset = max(offset, end)
+		if offset + 2 * size > self._data.size:
+			raise MemoryError("Image doesn't fit into shared memory")
+		return offset
+	
+	@traced("set_image")
 	def set_image(self, index, size, bytes):
+		"""
+		Publishes new image. Image is written into slot that runner is not
+		reading from, but only rows that are not already up to date
+		there are written.
+		"""
 		assert index < RT_MAX_IMAGES
-		if self._data.image_data[index].size < size:
-			# Image size increased, it has to be moved to end of buffer
-			try:
-				offset = max([ x.offset + x.size for x in self._data.image_data if x.size > 0 ])
-			except ValueError:
-				# arg is an empty sequence
-				offset = ctypes.sizeof(_SharedData) + 16
-			self._resize(offset + size)
-			self._data.image_data[index].offset = offset
+		image = self._data.image_data[index]
+		height = image.height
+		if height == 0 or size % height != 0:
+			# Cannot be split to rows, handled as single row
+			height = 1
+		changed = 0, height
+		offset = image.offset
+		if image.size < size:
+			# Image grew over its largest allocation so far and has to be
+			# moved. Old slots stay untouched until runner sees new version
+			offset = self._allocate(size)
+			self._stale[index] = 0, height
+		elif self._images[index] is None or len(self._images[index][0]) != size or self._images[index][1] != height:
+			# Smaller images reuse allocation in place, 'size' stays stride
+			# of slots, so image can grow back without moving
+			self._stale[index] = 0, height
 		else:
-			offset = self._data.image_data[index].offset
-		self._data.image_data[index].size = size
-		self._data.image_data[index].version += 1
-		self.mmap[offset:offset+size] = bytes
-		self.mmap.flush()
+			changed = SharedData._get_changed_rows(self._images[index][0], bytes, height)
+			if changed[1] == 0:
+				return
+		
+		# Rows changed now and rows that other slot missed last time
+		first, end = changed[0], changed[0] + changed[1]
+		stale_first, stale_count = self._stale[index]
+		if stale_count > 0:
+			first, end = min(first, stale_first), max(end, stale_first + stale_count)
+		stride = size / height
+		slot = offset + ((image.version + 1) % 2) * (size if offset != image.offset else image.size)
+		self.mmap[slot + first * stride : slot + end * stride] = bytes[first * stride : end * stride]
+		if offset != image.offset:
+			# Published only after data is written
+			image.offset, image.size = offset, size
+		
+		self._images[index] = bytes, height
+		self._stale[index] = changed
+		image.dirty_x, image.dirty_width = 0, image.width
+		if height == image.height:
+			image.dirty_y, image.dirty_height = changed
+		else:
+			image.dirty_y, image.dirty_height = 0, image.height
+		image.version += 1
 	
 	def set_scale_factor(self, factor):
 		self._data.scale_factor = factor
 	
+	def set_hud_visible(self, visible):
+		""" Shows or hides performance HUD drawn by runner """
+		self._data.show_hud = 1 if visible else 0
+	
 	def close(self):
+		"""
+		Unmaps memory and closes descriptor. Safe to call repeatedly;
+		descriptor is closed only once, as its number may be reused.
+		"""
+		if self.fd < 0:
+			return
 		self.mmap.close()
 		try:
-			os.unlink(self.filename)
-		except: pass
+			os.close(self.fd)
+		except OSError: pass
+		self.fd = -1
 	
-	def get_filename(self):
-		return self.filename
+	def get_fd(self):
+		""" Returns file descriptor that should be inherited by runner """
+		return self.fd
 	
 	@staticmethod
 	def get_c_type():
@@ -0,0 +1,41 @@
+#include <stdint.h>
+#include <string.h>
+
+/**
+ * Helpers used by GUI to publish input into shared memory. Python has no
+ * way to order its stores, so publishing is done here, with same atomics
+ * runner reads input with. Built as small separate library, so GUI doesn't
+ * have to load libnative_runner.
+ */
+
+typedef unsigned int uint;
+
+
+/**
+ * Copies 'size' bytes of input state from 'source' to 'target'.
+ * Sequence counter 'seq' is odd while copying.
+ */
+void rt_input_publish(uint* seq, void* target, const void* source, size_t size) {
+	uint s = __atomic_load_n(seq, __ATOMIC_RELAXED);
+	__atomic_store_n(seq, s + 1, __ATOMIC_RELAXED);
+	// Odd counter has to be visible before any byte of state changes
+	__atomic_thread_fence(__ATOMIC_RELEASE);
+	memcpy(target, source, size);
+	__atomic_store_n(seq, s + 2, __ATOMIC_RELEASE);
+}
+
+
+/**
+ * Copies event of 'size' bytes into queue slot at 'head' and moves head
+ * only after that. Returns 0 if queue is full and nothing was queued.
+ */
+int rt_input_queue_push(uint* head, const uint* tail, void* events, uint capacity,
+			const void* event, size_t size) {
+	uint h = *head;
+	// Acquire, so slot is not overwritten while runner is still reading it
+	if (h - __atomic_load_n(tail, __ATOMIC_ACQUIRE) >= capacity)
+		return 0;
+	memcpy((char*)events + (h % capacity) * size, event, size);
+	__atomic_store_n(head, h + 1, __ATOMIC_RELEASE);
+	return 1;
+}
@@ -0,0 +1,364 @@
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <stdint.h>
+#include <stdarg.h>
+#include <GL/gl.h>
+#include <GL/glext.h>
+#include <libretro.h>
+
+/**
+ * Synthetic libretro core used to benchmark native runner without real
+ * cores and games. Every frame is generated from frame counter alone, so
+ * output is same on every run. Everything it does is configured by core
+ * options, e.g. by setting RT_CORE_CONFIG_OVERRIDE for runner:
+ *
+ *   stress_geometry      size of generated frame
+ *   stress_pixel_format  XRGB8888 or RGB565
+ *   stress_audio         audio_sample_batch or audio_sample callback
+ *   stress_state_size    size of serialized state
+ *   stress_hw_render     renders using RETRO_HW_CONTEXT_OPENGL
+ *
+ * Loaded game file is never read, so anything can be used as game.
+ */
+
+#define SAMPLE_RATE 48000
+#define FPS 60
+#define SAMPLES_PER_FRAME (SAMPLE_RATE / FPS)
+#define MAX_WIDTH 1920
+#define MAX_HEIGHT 1080
+
+typedef void (*glBindFramebuffer_t)(GLenum target, GLuint framebuffer);
+typedef void (*glClearColor_t)(GLfloat r, GLfloat g, GLfloat b, GLfloat a);
+typedef void (*glClear_t)(GLbitfield mask);
+typedef void (*glScissor_t)(GLint x, GLint y, GLsizei width, GLsizei height);
+typedef void (*glViewport_t)(GLint x, GLint y, GLsizei width, GLsizei height);
+typedef void (*glEnable_t)(GLenum cap);
+typedef void (*glDisable_t)(GLenum cap);
+
+static const struct retro_variable variables[] = {
+	{ "stress_geometry", "Frame size; 320x240|256x224|640x480|1280x720|1920x1080" },
+	{ "stress_pixel_format", "Pixel format; xrgb8888|rgb565" },
+	{ "stress_audio", "Audio callback; batch|single" },
+	{ "stress_state_size", "State size; 65536|0|1048576|16777216" },
+	{ "stress_hw_render", "Render using OpenGL; disabled|enabled" },
+	{ NULL, NULL },
+};
+
+static retro_environment_t environ_cb;
+static retro_video_refresh_t video_cb;
+static retro_audio_sample_t audio_cb;
+static retro_audio_sample_batch_t audio_batch_cb;
+static retro_input_poll_t input_poll_cb;
+static retro_input_state_t input_state_cb;
+static retro_log_printf_t log_cb;
+
+static struct {
+	unsigned width;
+	unsigned height;
+	enum retro_pixel_format format;
+	bool batch_audio;
+	size_t state_size;
+	bool hw_render;
+} config;
+
+static struct retro_hw_render_callback hw_render;
+static struct {
+	bool ready;
+	glBindFramebuffer_t glBindFramebuffer;
+	glClearColor_t glClearColor;
+	glClear_t glClear;
+	glScissor_t glScissor;
+	glViewport_t glViewport;
+	glEnable_t glEnable;
+	glDisable_t glDisable;
+} gl;
+
+static uint32_t frame;
+static uint16_t buttons;
+static uint8_t* state;
+static void* framebuffer;
+static int16_t audio[SAMPLES_PER_FRAME * 2];
+
+
+static void fallback_log(enum retro_log_level level, const char* fmt, ...) {
+	va_list va;
+	va_start(va, fmt);
+	vfprintf(stderr, fmt, va);
+	va_end(va);
+}
+
+
+static const char* get_variable(const char* key) {
+	struct retro_variable var = { key, NULL };
+	if (!environ_cb(RETRO_ENVIRONMENT_GET_VARIABLE, &var) || (var.value == NULL)) {
+		// First option is default
+		for (const struct retro_variable* v = variables; v->key != NULL; v++)
+			if (strcmp(v->key, key) == 0)
+				return strstr(v->value, "; ") + 2;
+	}
+	return var.value;
+}
+
+
+static void load_config() {
+	config.width = config.height = 0;
+	sscanf(get_variable("stress_geometry"), "%ux%u", &config.width, &config.height);
+	if ((config.width == 0) || (config.width > MAX_WIDTH) || (config.height == 0) || (config.height > MAX_HEIGHT)) {
+		config.width = 320;
+		config.height = 240;
+	}
+	config.format = (strncmp(get_variable("stress_pixel_format"), "rgb565", 6) == 0)
+			? RETRO_PIXEL_FORMAT_RGB565 : RETRO_PIXEL_FORMAT_XRGB8888;
+	config.batch_audio = (strncmp(get_variable("stress_audio"), "single", 6) != 0);
+	config.state_size = strtoul(get_variable("stress_state_size"), NULL, 10);
+	config.hw_render = (strncmp(get_variable("stress_hw_render"), "enabled", 7) == 0);
+}
+
+
+static void context_reset() {
+	#define GET_PROC(name) gl.name = (name ## _t)hw_render.get_proc_address(#name)
+	GET_PROC(glBindFramebuffer);
+	GET_PROC(glClearColor);
+	GET_PROC(glClear);
+	GET_PROC(glScissor);
+	GET_PROC(glViewport);
+	GET_PROC(glEnable);
+	GET_PROC(glDisable);
+	#undef GET_PROC
+	gl.ready = (gl.glBindFramebuffer && gl.glClearColor && gl.glClear
+			&& gl.glScissor && gl.glViewport && gl.glEnable && gl.glDisable);
+	if (!gl.ready)
+		log_cb(RETRO_LOG_ERROR, "Failed to get OpenGL functions");
+}
+
+
+static void context_destroy() {
+	gl.ready = false;
+}
+
+
+/** Draws moving pattern into software framebuffer */
+static void render_software() {
+	if (config.format == RETRO_PIXEL_FORMAT_XRGB8888) {
+		uint32_t* line = (uint32_t*)framebuffer;
+		for (unsigned y=0; y<config.height; y++) {
+			for (unsigned x=0; x<config.width; x++)
+				line[x] = (((x + frame) & 0xFF) << 16) | (((y + frame) & 0xFF) << 8) | ((x ^ y) & 0xFF);
+			line += config.width;
+		}
+		video_cb(framebuffer, config.width, config.height, config.width * 4);
+	} else {
+		uint16_t* line = (uint16_t*)framebuffer;
+		for (unsigned y=0; y<config.height; y++) {
+			for (unsigned x=0; x<config.width; x++)
+				line[x] = (((x + frame) & 0x1F) << 11) | (((y + frame) & 0x3F) << 5) | ((x ^ y) & 0x1F);
+			line += config.width;
+		}
+		video_cb(framebuffer, config.width, config.height, config.width * 2);
+	}
+}
+
+
+/** Draws moving stripes into framebuffer provided by frontend */
+static void render_hw() {
+	gl.glBindFramebuffer(GL_FRAMEBUFFER, (GLuint)hw_render.get_current_framebuffer());
+	gl.glViewport(0, 0, config.width, config.height);
+	gl.glClearColor((frame % 256) / 255.0f, 0.25f, 0.5f, 1.0f);
+	gl.glClear(GL_COLOR_BUFFER_BIT);
+	gl.glEnable(GL_SCISSOR_TEST);
+	for (unsigned i=0; i<16; i++) {
+		unsigned x = (i * config.width / 16 + frame) % config.width;
+		gl.glScissor(x, 0, config.width / 32, config.height);
+		gl.glClearColor(i / 16.0f, 1.0f - i / 16.0f, 0.0f, 1.0f);
+		gl.glClear(GL_COLOR_BUFFER_BIT);
+	}
+	gl.glDisable(GL_SCISSOR_TEST);
+	video_cb(RETRO_HW_FRAME_BUFFER_VALID, config.width, config.height, 0);
+}
+
+
+/** Generates square wave with period changing every second */
+static void render_audio() {
+	unsigned period = 40 + (frame / FPS) % 40;
+	for (unsigned i=0; i<SAMPLES_PER_FRAME; i++) {
+		unsigned t = frame * SAMPLES_PER_FRAME + i;
+		int16_t value = ((t % period) < period / 2) ? 4096 : -4096;
+		audio[i * 2] = audio[i * 2 + 1] = value;
+	}
+	if (config.batch_audio) {
+		audio_batch_cb(audio, SAMPLES_PER_FRAME);
+	} else {
+		for (unsigned i=0; i<SAMPLES_PER_FRAME; i++)
+			audio_cb(audio[i * 2], audio[i * 2 + 1]);
+	}
+}
+
+
+RETRO_API void retro_set_environment(retro_environment_t cb) {
+	struct retro_log_callback logging;
+	bool no_game = true;
+	environ_cb = cb;
+	log_cb = cb(RETRO_ENVIRONMENT_GET_LOG_INTERFACE, &logging) ? logging.log : fallback_log;
+	cb(RETRO_ENVIRONMENT_SET_VARIABLES, (void*)variables);
+	cb(RETRO_ENVIRONMENT_SET_SUPPORT_NO_GAME, &no_game);
+}
+
+
+RETRO_API void retro_set_video_refresh(retro_video_refresh_t cb) { video_cb = cb; }
+RETRO_API void retro_set_audio_sample(retro_audio_sample_t cb) { audio_cb = cb; }
+RETRO_API void retro_set_audio_sample_batch(retro_audio_sample_batch_t cb) { audio_batch_cb = cb; }
+RETRO_API void retro_set_input_poll(retro_input_poll_t cb) { input_poll_cb = cb; }
+RETRO_API void retro_set_input_state(retro_input_state_t cb) { input_state_cb = cb; }
+
+
+RETRO_API void retro_init(void) {
+	frame = 0;
+	buttons = 0;
+}
+
+
+RETRO_API void retro_deinit(void) { }
+
+
+RETRO_API unsigned retro_api_version(void) {
+	return RETRO_API_VERSION;
+}
+
+
+RETRO_API void retro_get_system_info(struct retro_system_info* info) {
+	memset(info, 0, sizeof(*info));
+	info->library_name = "Stress";
+	info->library_version = "1.0";
+	info->need_fullpath = true;
+	info->valid_extensions = "";
+}
+
+
+RETRO_API void retro_get_system_av_info(struct retro_system_av_info* info) {
+	memset(info, 0, sizeof(*info));
+	info->geometry.base_width = info->geometry.max_width = config.width;
+	info->geometry.base_height = info->geometry.max_height = config.height;
+	info->geometry.aspect_ratio = (float)config.width / (float)config.height;
+	info->timing.fps = FPS;
+	info->timing.sample_rate = SAMPLE_RATE;
+}
+
+
+RETRO_API void retro_set_controller_port_device(unsigned port, unsigned device) { }
+
+
+RETRO_API void retro_reset(void) {
+	frame = 0;
+}
+
+
+RETRO_API void retro_run(void) {
+	input_poll_cb();
+	buttons = 0;
+	for (unsigned i=0; i<=RETRO_DEVICE_ID_JOYPAD_R3; i++)
+		if (input_state_cb(0, RETRO_DEVICE_JOYPAD, 0, i))
+			buttons |= (1 << i);
+	
+	if (!config.hw_render)
+		render_software();
+	else if (gl.ready)
+		render_hw();
+	else
+		video_cb(NULL, config.width, config.height, 0);
+	render_audio();
+	
+	if (state != NULL)
+		// Touches part of state, as real core would
+		state[frame % config.state_size] = (uint8_t)frame;
+	frame ++;
+}
+
+
+RETRO_API bool retro_load_game(const struct retro_game_info* game) {
+	load_config();
+	if (!environ_cb(RETRO_ENVIRONMENT_SET_PIXEL_FORMAT, &config.format)) {
+		log_cb(RETRO_LOG_ERROR, "Pixel format not supported");
+		return false;
+	}
+	
+	if (config.hw_render) {
+		memset(&hw_render, 0, sizeof(hw_render));
+		hw_render.context_type = RETRO_HW_CONTEXT_OPENGL;
+		hw_render.context_reset = context_reset;
+		hw_render.context_destroy = context_destroy;
+		hw_render.bottom_left_origin = true;
+		if (!environ_cb(RETRO_ENVIRONMENT_SET_HW_RENDER, &hw_render)) {
+			log_cb(RETRO_LOG_ERROR, "HW rendering not supported");
+			return false;
+		}
+	}
+	
+	free(framebuffer);
+	framebuffer = malloc(MAX_WIDTH * MAX_HEIGHT * 4);
+	free(state);
+	state = NULL;
+	if (config.state_size > 0) {
+		state = malloc(config.state_size);
+		if (state != NULL)
+			memset(state, 0, config.state_size);
+	}
+	if ((framebuffer == NULL) || ((config.state_size > 0) && (state == NULL))) {
+		log_cb(RETRO_LOG_ERROR, "Failed to allocate memory");
+		return false;
+	}
+	
+	log_cb(RETRO_LOG_INFO, "Stress core: %ux%u, %s, %s audio, %lu bytes state%s\n",
+		config.width, config.height,
+		(config.format == RETRO_PIXEL_FORMAT_RGB565) ? "RGB565" : "XRGB8888",
+		config.batch_audio ? "batch" : "single",
+		config.state_size, config.hw_render ? ", HW rendering" : "");
+	return true;
+}
+
+
+RETRO_API bool retro_load_game_special(unsigned type, const struct retro_game_info* info, size_t num) {
+	return false;
+}
+
+
+RETRO_API void retro_unload_game(void) {
+	free(framebuffer);
+	free(state);
+	framebuffer = NULL;
+	state = NULL;
+}
+
+
+RETRO_API unsigned retro_get_region(void) {
+	return RETRO_REGION_NTSC;
+}
+
+
+RETRO_API size_t retro_serialize_size(void) {
+	return (state == NULL) ? 0 : sizeof(frame) + config.state_size;
+}
+
+
+RETRO_API bool retro_serialize(void* data, size_t size) {
+	if ((state == NULL) || (size < retro_serialize_size()))
+		return false;
+	memcpy(data, &frame, sizeof(frame));
+	memcpy((uint8_t*)data + sizeof(frame), state, config.state_size);
+	return true;
+}
+
+
+RETRO_API bool retro_unserialize(const void* data, size_t size) {
+	if ((state == NULL) || (size < retro_serialize_size()))
+		return false;
+	memcpy(&frame, data, sizeof(frame));
+	memcpy(state, (const uint8_t*)data + sizeof(frame), config.state_size);
+	return true;
+}
+
+
+RETRO_API void retro_cheat_reset(void) { }
+RETRO_API void retro_cheat_set(unsigned index, bool enabled, const char* code) { }
+RETRO_API void* retro_get_memory_data(unsigned id) { return NULL; }
+RETRO_API size_t retro_get_memory_size(unsigned id) { return 0; }
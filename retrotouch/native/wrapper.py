@@ -4,11 +4,13 @@ RetroTouch - Wrapper
 
 Wrapper around native c code
 """
-from gi.repository import Gtk, Gio, GdkX11
-from retrotouch.rpc import RPC, decode_call, decode_size
+from gi.repository import Gtk, Gio, GLib, GdkX11
+from retrotouch.rpc import RPC, READ_SIZE
 from retrotouch.native.shared_data import SharedData
+from retrotouch.native.shared_data import INPUT_EVENT_BUTTON, INPUT_EVENT_MOUSE_BUTTON
+from retrotouch import trace
 from collections import OrderedDict
-import os, sys, logging, subprocess
+import os, sys, json, time, logging, subprocess
 log = logging.getLogger("Wrapper")
 
 
@@ -27,6 +29,8 @@ class Wrapper(RPC):
 		self.retro_config = OrderedDict()
 		self.width, self.height = self.screen_size = self.render_size = 640, 480
 		self.pads = []
+		self._latency_callbacks = []
+		self._destroyed = False
 		
 		# Prepare GTK
 		self.parent.realize()
@@ -35,6 +39,7 @@ class Wrapper(RPC):
 		self.shared_data = SharedData()
 		self.shared_data.input_state.buttons = 0
 		self.shared_data.input_state.analogs = (0, 0, 0, 0)
+		self.shared_data.publish_input(False)
 		
 		mine_rfd, his_wfd = os.pipe()
 		his_rfd, mine_wfd = os.pipe()
@@ -49,7 +54,7 @@ class Wrapper(RPC):
 		env['RT_RUNNER_WRITE_FD'] = str(his_wfd)
 		env['RT_RUNNER_WINDOW_ID'] = str(self.parent.get_window().get_xid())
 		env['RT_BACKGROUND_COLOR'] = "%s %s %s" % (color.red, color.green, color.blue)
-		env['RT_RUNNER_SHM_FILENAME'] = self.shared_data.get_filename()
+		env['RT_RUNNER_SHM_FD'] = str(self.shared_data.get_fd())
 		# Start native_runner
 		if self.GDB:
 			self.proc = subprocess.Popen([ "gdb", sys.executable ],
@@ -73,42 +78,78 @@ class Wrapper(RPC):
 				self.core, self.game], env=env)
 		log.debug("Subprocess started")
 		os.close(his_rfd); os.close(his_wfd)
+		if trace.ENABLED:
+			GLib.timeout_add(1000, self._send_trace)
 	
 	def setup_fds(self, read_fd, write_fd):
-		def recieved_size(stream, res):
+		def recieved(stream, res):
 			try:
-				bts = stream.read_bytes_finish(res)
-				size = decode_size(bts.get_data())
+				bts = stream.read_bytes_finish(res).get_data()
+				if not bts:
+					raise EOFError()
+				# Everything what arrived is processed at once
+				self.feed(bts)
 			except Exception:
 				# Subprocess crashed or pipe got destroyed by other mean
 				if self.proc:
 					self.destroy()
 					self.app.on_core_crashed()
 				return
-			self._read.read_bytes_async(size, 0, self._cancel, recieved_call)
+			self._read.read_bytes_async(READ_SIZE, 0, self._cancel, recieved)
 		
-		def recieved_call(stream, res):
-			bts = stream.read_bytes_finish(res)
-			mname, args, kws = decode_call(bts.get_data())
-			self.call_locally(mname, args, kws)
-			self._read.read_bytes_async(4, 0, self._cancel, recieved_size)
-		
-		self._read = Gio.UnixInputStream.new(read_fd, True)
-		self._write = os.fdopen(write_fd, 'wb', 1)
+		RPC.setup_fds(self, read_fd, write_fd)
+		self._read = Gio.UnixInputStream.new(read_fd, False)
 		self._cancel = Gio.Cancellable()
-		self._buffer = b" " * 4
-		self._read.read_bytes_async(4, 0, self._cancel, recieved_size)
+		self._read.read_bytes_async(READ_SIZE, 0, self._cancel, recieved)
+	
+	def schedule_flush(self):
+		""" Calls made during single main loop iteration are sent together """
+		GLib.idle_add(self._flush_idle, priority=GLib.PRIORITY_HIGH_IDLE)
+	
+	def _flush_idle(self):
+		try:
+			self.flush()
+		except OSError:
+			# Subprocess crashed, handled when reading
+			pass
+		return False
 	
 	def __del__(self):
-		self._cancel.cancel()
-		self.close()
 		self.destroy()
 	
+	def _send_trace(self):
+		""" Sends spans measured in this process to runner, which writes trace """
+		if not self.proc:
+			return False
+		pid = os.getpid()
+		events = [ "%s %s %s %s" % (pid, start, duration, name)
+			for (name, start, duration) in trace.get_pending() ]
+		if events:
+			self.call('add_trace_events', events)
+		return True
+	
 	def destroy(self):
+		if self._destroyed:
+			return
+		self._destroyed = True
+		if self.proc and trace.ENABLED:
+			# Runner writes trace when it finds pipe closed. It's given
+			# a moment to do so before it's killed
+			self._send_trace()
+			try:
+				self.flush()
+			except OSError: pass
+			self.close()
+			for x in xrange(20):
+				if self.proc.poll() is not None:
+					break
+				time.sleep(0.05)
 		log.debug("Killing subprocess")
 		if self.proc:
 			self.proc.kill()
 			self.proc = None
+		self._cancel.cancel()
+		self.close()
 		self.shared_data.close()
 		self.window = None
 	
@@ -164,31 +205,71 @@ class Wrapper(RPC):
 		self.call('save_both', prefix, ext_state, ext_screenshot)
 	
 	def set_button(self, button, state):
+		self.shared_data.push_input_event(INPUT_EVENT_BUTTON, button, state)
 		if state:
 			self.shared_data.input_state.buttons |= 1 << button
 		else:
 			self.shared_data.input_state.buttons &= ~(1 << button)
+		self.shared_data.publish_input()
 	
 	def set_mouse(self, x, y):
 		self.shared_data.input_state.mouse[0] = x
 		self.shared_data.input_state.mouse[1] = y
+		self.shared_data.publish_input()
 	
 	def set_mouse_button(self, button, state):
+		self.shared_data.push_input_event(INPUT_EVENT_MOUSE_BUTTON, button, state)
 		if state:
 			self.shared_data.input_state.mouse_buttons |= 1 << button
 		else:
 			self.shared_data.input_state.mouse_buttons &= ~(1 << button)
+		self.shared_data.publish_input()
 	
 	def set_analog(self, index, x, y):
 		self.shared_data.input_state.analogs[index + 0] = x
 		self.shared_data.input_state.analogs[index + 1] = y
+		self.shared_data.publish_input()
 	
 	def set_paused(self, paused):
 		self.call('set_paused', paused)
 	
+	def set_hud_visible(self, visible):
+		self.shared_data.set_hud_visible(visible)
+	
 	def set_vsync(self, enabled):
 		self.call('set_vsync', enabled)
 	
+	def set_fast_forward(self, factor, uncapped=False):
+		"""
+		Sets fast-forward speed. factor=1 with uncapped=False means
+		normal speed.
+		"""
+		self.call('set_fast_forward', factor, uncapped)
+	
+	def set_run_ahead(self, frames):
+		""" Sets number of frames (0 to 4) to run ahead. 0 disables run-ahead """
+		self.call('set_run_ahead', frames)
+	
+	def set_rewinding(self, rewinding):
+		""" While rewinding is set, game runs backwards """
+		self.call('set_rewinding', rewinding)
+	
+	def get_input_latency(self, callback):
+		"""
+		Asks runner for input latency histograms. Callback is called later
+		with dict as returned by Native.get_input_latency.
+		"""
+		self._latency_callbacks.append(callback)
+		self.call('request_input_latency')
+	
+	def input_latency(self, data):
+		if self._latency_callbacks:
+			self._latency_callbacks.pop(0)(json.loads(data))
+	
+	def dump_input_latency(self, filename):
+		""" Makes runner write input latency histograms to JSON file """
+		self.call('dump_input_latency', filename)
+	
 	def load_core(self, *a):
 		pass
 	
@@ -10,16 +10,22 @@ from retrotouch.native.shared_data import SharedData
 from retrotouch.data import CORE_CONFIG_OVERRIDE, CORE_CONFIG_DEFAULTS
 from retrotouch.tools import load_core_config, save_core_config
 from retrotouch.tools import find_library
-from retrotouch.paths import get_share_path, get_data_path
-from retrotouch.rpc import RPC
-import sys, os, json, logging, ctypes
+from retrotouch.paths import get_share_path, get_data_path, get_core_paths
+from retrotouch.rpc import RPC, READ_SIZE
+from retrotouch import trace
+import sys, os, json, shutil, tempfile, logging, ctypes
 log = logging.getLogger("RRunner")
 
 
-cb_log_t = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p)
+cb_log_ready_t = ctypes.CFUNCTYPE(ctypes.c_void_p)
 cb_render_size_changed_t = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_int, ctypes.c_int)
 cb_get_variable_t = ctypes.CFUNCTYPE(ctypes.c_char_p, ctypes.c_char_p)
 cb_set_variable_t = ctypes.CFUNCTYPE(ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p)
+cb_audio_latency_changed_t = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_int)
+cb_rpc_ready_t = ctypes.CFUNCTYPE(ctypes.c_int)
+AUDIO_LATENCY_KEY = "retrotouch_audio_latency"
+BENCHMARK_WARMUP = 60		# Frames run before benchmark starts measuring
+BENCHMARK_SCREEN_SIZE = 600	# Same as size of window created without parent
 LOG_LEVELS = [
 	"debug",	# 0
 	"info",		# 1
@@ -34,10 +40,13 @@ class LibraryData(ctypes.Structure):
 		("save_path", ctypes.c_char_p),
 		("parent", ctypes.c_int),
 		("window", ctypes.c_int),
-		("cb_log",  cb_log_t),
+		("headless", ctypes.c_int),
+		("cb_log_ready",  cb_log_ready_t),
 		("cb_render_size_changed",  cb_render_size_changed_t),
 		("cb_get_variable", cb_get_variable_t),
 		("cb_set_variable", cb_set_variable_t),
+		("cb_audio_latency_changed", cb_audio_latency_changed_t),
+		("cb_rpc_ready", cb_rpc_ready_t),
 		("variables_changed", ctypes.c_int),
 		("shared_data", SharedData.get_c_type()),
 		("private", ctypes.c_void_p),
@@ -45,37 +54,183 @@ class LibraryData(ctypes.Structure):
 	]
 
 
+class PacerStats(ctypes.Structure):
+	_fields_ = [
+		("frames", ctypes.c_uint64),
+		("overruns", ctypes.c_uint64),
+		("resyncs", ctypes.c_uint64),
+		("mean_error", ctypes.c_double),
+		("p99_error", ctypes.c_double),
+	]
+
+
+class AudioStats(ctypes.Structure):
+	_fields_ = [
+		("capacity", ctypes.c_uint64),
+		("fill", ctypes.c_uint64),
+		("underruns", ctypes.c_uint64),
+		("overruns", ctypes.c_uint64),
+		("latency", ctypes.c_uint64),
+		("ratio", ctypes.c_double),
+		("frame_samples_mean", ctypes.c_double),
+		("frame_samples_last", ctypes.c_uint64),
+		("frame_samples_max", ctypes.c_uint64),
+	]
+
+
+class FrameTimes(ctypes.Structure):
+	_fields_ = [
+		("core", ctypes.c_uint64),
+		("upload", ctypes.c_uint64),
+		("render", ctypes.c_uint64),
+		("swap", ctypes.c_uint64),
+	]
+
+
+class InputStats(ctypes.Structure):
+	_fields_ = [
+		("events", ctypes.c_uint64),
+		("deferred", ctypes.c_uint64),
+		("dropped", ctypes.c_uint64),
+		("age_last", ctypes.c_uint64),
+		("age_max", ctypes.c_uint64),
+	]
+
+
+class RenderStats(ctypes.Structure):
+	_fields_ = [
+		("presented", ctypes.c_uint64),
+		("skipped", ctypes.c_uint64),
+	]
+
+
+class GpuTimerStats(ctypes.Structure):
+	_fields_ = [
+		("samples", ctypes.c_uint64),
+		("skipped", ctypes.c_uint64),
+		("min", ctypes.c_double),
+		("mean", ctypes.c_double),
+		("max", ctypes.c_double),
+	]
+
+
+# Same order as in enum GpuPass
+GPU_PASSES = [ "game", "pads", "core" ]
+
+LATENCY_BUCKETS = 64
+LATENCY_BUCKET_SIZE = 2000	# microseconds
+
+
+class LatencyHistogram(ctypes.Structure):
+	_fields_ = [
+		("count", ctypes.c_uint64),
+		("sum", ctypes.c_uint64),
+		("max", ctypes.c_uint64),
+		("buckets", ctypes.c_uint64 * LATENCY_BUCKETS),
+	]
+	
+	def to_dict(self):
+		"""
+		Percentiles are upper bounds of buckets they fall into, or max if
+		that is lower. Last bucket has no upper bound.
+		"""
+		rv = {
+			"count" : self.count,
+			"mean" : float(self.sum) / self.count if self.count else 0.0,
+			"max" : self.max,
+			"bucket_size" : LATENCY_BUCKET_SIZE,
+			"buckets" : list(self.buckets),
+		}
+		for percent in (50, 90, 99):
+			total = 0
+			for i, count in enumerate(self.buckets):
+				total += count
+				if total * 100 >= self.count * percent:
+					bound = (i + 1) * LATENCY_BUCKET_SIZE if i < LATENCY_BUCKETS - 1 else self.max
+					rv["p%s" % (percent,)] = min(self.max, bound)
+					break
+		return rv
+
+
+class RewindStats(ctypes.Structure):
+	_fields_ = [
+		("captures", ctypes.c_uint64),
+		("entries", ctypes.c_uint64),
+		("used", ctypes.c_uint64),
+		("budget", ctypes.c_uint64),
+		("capture_time_mean", ctypes.c_double),
+		("capture_time_max", ctypes.c_double),
+	]
+
+
+class LogRecord(ctypes.Structure):
+	_fields_ = [
+		("time", ctypes.c_uint64),
+		("level", ctypes.c_int),
+		("tag", ctypes.c_char * 16),
+		("message", ctypes.c_char * 512),
+	]
+
+
 class Native:
+	REWIND_BUDGET = 8 * 1024 * 1024
+	REWIND_INTERVAL = 4
+	TRACE_EVENTS = 65536
 	
-	def __init__(self, parent, shm_fname):
+	def __init__(self, parent, shm_fd, headless=False):
 		self._lib = find_library("libnative_runner")
 		self._lib.rt_init.restype = ctypes.c_int
 		self._lib.rt_check_saving_supported.restype = ctypes.c_int
 		self._lib.rt_check_error.restype = ctypes.c_char_p
 		self._lib.rt_core_load.restype = ctypes.c_int
 		self._lib.rt_get_game_loaded.restype = ctypes.c_int
+		self._lib.rt_log_pop.restype = ctypes.c_int
+		self._lib.rt_log_get_dropped.restype = ctypes.c_uint64
 		
 		self.paused = True
-		self.shared_data = SharedData(shm_fname, False)
+		self.rewind_enabled = False
+		self.shared_data = SharedData(shm_fd, False)
+		self._log_record = LogRecord()
+		self._log_dropped = 0
 		
 		self.__libdata = LibraryData()
 		self.__libdata.parent = parent
+		self.__libdata.headless = 1 if headless else 0
 		self.__libdata.res_path = ctypes.c_char_p(get_share_path().encode("utf-8"))
 		self.__libdata.save_path = ctypes.c_char_p(get_data_path().encode("utf-8"))
-		self.__libdata.cb_log = cb_log_t(self._cb_log)
+		self.__libdata.cb_log_ready = cb_log_ready_t(self._cb_log_ready)
 		self.__libdata.cb_render_size_changed = cb_render_size_changed_t(self.cb_render_size_changed)
 		self.__libdata.cb_get_variable = cb_get_variable_t(self.cb_get_variable)
 		self.__libdata.cb_set_variable = cb_set_variable_t(self.cb_set_variable)
+		self.__libdata.cb_audio_latency_changed = cb_audio_latency_changed_t(self.cb_audio_latency_changed)
+		self.__libdata.cb_rpc_ready = cb_rpc_ready_t(self.cb_rpc_ready)
 		self.__libdata.variables_changed = 0
 		self.__libdata.shared_data = self.shared_data.get_ptr()
 		self.__libdata.private = None
 		self._libdata = ctypes.byref(self.__libdata)
 		
 		assert 0 == self._lib.rt_init(self._libdata), "Failed to initialiaze native code"
+		self._lib.rt_set_log_level(self._libdata, ctypes.c_int(self._get_log_level()))
+		self._lib.rt_set_paused(self._libdata, ctypes.c_int(self.paused))
 		self.call("window_created", self.__libdata.window)
 	
-	def _cb_log(self, tag, level, message):
-		getattr(logging.getLogger(tag), LOG_LEVELS[min(level, len(LOG_LEVELS))])(message)
+	def _get_log_level(self):
+		""" Returns lowest native log level that would not be thrown away anyway """
+		level = logging.getLogger().getEffectiveLevel()
+		for index, name in enumerate(LOG_LEVELS):
+			if getattr(logging, name.upper()) >= level:
+				return index
+		return len(LOG_LEVELS) - 1
+	
+	def _cb_log_ready(self):
+		record = self._log_record
+		while self._lib.rt_log_pop(self._libdata, ctypes.byref(record)):
+			getattr(logging.getLogger(record.tag), LOG_LEVELS[min(record.level, len(LOG_LEVELS) - 1)])(
+				record.message.decode("utf-8", "replace"))
+		dropped = self._lib.rt_log_get_dropped(self._libdata)
+		if dropped != self._log_dropped:
+			log.warning("%s native log messages dropped, log buffer is full", dropped - self._log_dropped)
+			self._log_dropped = dropped
 	
 	def check_saving_supported(self):
 		return 1 == self._lib.rt_check_saving_supported(self._libdata)
@@ -86,15 +241,198 @@ class Native:
 	def step_paused(self):
 		self._lib.rt_step_paused(self._libdata)
 	
+	def set_pacer(self, spin_time, resync_threshold):
+		"""
+		Configures frame pacer. Both values are in microseconds.
+		spin_time is how long before deadline pacer stops sleeping and starts
+		busy-waiting (0 to disable), resync_threshold is how late frame can
+		be before pacer gives up on catching up.
+		"""
+		self._lib.rt_pacer_configure(self._libdata,
+			ctypes.c_int(spin_time), ctypes.c_int(resync_threshold))
+	
+	def get_pacer_stats(self):
+		""" Returns dict with frame pacing statistics. Errors are in microseconds """
+		stats = PacerStats()
+		self._lib.rt_pacer_get_stats(self._libdata, ctypes.byref(stats))
+		return { name : getattr(stats, name) for name, trash in PacerStats._fields_ }
+	
+	def get_render_stats(self):
+		"""
+		Returns dict with number of presented frames and number of presents
+		skipped because nothing on screen changed
+		"""
+		stats = RenderStats()
+		self._lib.rt_render_get_stats(self._libdata, ctypes.byref(stats))
+		return { name : getattr(stats, name) for name, trash in RenderStats._fields_ }
+	
+	def get_frame_times(self):
+		""" Returns dict with time (in microseconds) spent in each phase of last frame """
+		times = FrameTimes()
+		self._lib.rt_get_frame_times(self._libdata, ctypes.byref(times))
+		return { name : getattr(times, name) for name, trash in FrameTimes._fields_ }
+	
+	def setup_trace(self, filename, capacity=TRACE_EVENTS):
+		"""
+		Enables tracing. Trace is written into 'filename' by dump_trace or
+		when runner receives SIGUSR1. Spans measured by Python code in this
+		process are recorded into same trace.
+		"""
+		if 0 != self._lib.rt_trace_setup(self._libdata,
+				ctypes.c_char_p(filename.encode("utf-8")), ctypes.c_size_t(capacity)):
+			log.error("Failed to enable tracing")
+			return
+		trace.set_sink(self._trace_sink)
+	
+	def _trace_sink(self, name, start, duration, pid=0):
+		self._lib.rt_trace_add(self._libdata, ctypes.c_char_p(name.encode("utf-8")),
+			ctypes.c_int(pid), ctypes.c_int(pid),
+			ctypes.c_uint64(start), ctypes.c_uint64(duration))
+	
+	def add_trace_events(self, events):
+		""" Called by GUI with spans it measured, as 'pid start duration name' strings """
+		for event in events:
+			pid, start, duration, name = event.split(" ", 3)
+			self._trace_sink(name, int(start), int(duration), int(pid))
+	
+	def dump_trace(self):
+		self._lib.rt_trace_dump(self._libdata)
+	
 	def set_paused(self, paused):
 		if self.paused != paused:
 			self.paused = paused
+			self._lib.rt_set_paused(self._libdata, ctypes.c_int(paused))
 			self.call("paused_changed", paused)
 			if paused:
 				log.debug("Core paused")
 			else:
 				log.debug("Core resumed")
 	
+	def set_audio_backend(self, name, filename=None):
+		"""
+		Selects where audio goes. 'name' is 'alsa', 'null' (audio is thrown away)
+		or 'wav', which writes everything into 'filename'.
+		"""
+		if filename is not None:
+			filename = ctypes.c_char_p(filename.encode("utf-8"))
+		if 0 != self._lib.rt_audio_set_backend(self._libdata, ctypes.c_char_p(name.encode("utf-8")), filename):
+			log.warning("Failed to set audio backend '%s'", name)
+	
+	def close_audio(self):
+		""" Closes audio device or file. Should be called before exiting """
+		self._lib.rt_audio_close(self._libdata)
+	
+	def set_audio_latency(self, latency):
+		""" Sets latency (in microseconds) audio device starts with """
+		self._lib.rt_audio_set_latency(self._libdata, ctypes.c_int(latency))
+	
+	def get_audio_stats(self):
+		"""
+		Returns dict with audio buffer statistics. 'capacity' and 'fill'
+		are in frames, 'latency' is in microseconds, 'ratio' is resampling
+		ratio set by rate control and
+		'frame_samples_*' are numbers of frames generated by single retro_run.
+		"""
+		stats = AudioStats()
+		self._lib.rt_audio_get_stats(self._libdata, ctypes.byref(stats))
+		return { name : getattr(stats, name) for name, trash in AudioStats._fields_ }
+	
+	def set_threaded_video(self, enabled):
+		"""
+		Moves uploading & presenting frames to separate thread.
+		Not available for HW-rendered cores.
+		"""
+		if 0 != self._lib.rt_set_threaded_video(self._libdata, ctypes.c_int(enabled)):
+			log.warning("Failed to set threaded video")
+	
+	def set_gpu_timer(self, enabled):
+		""" Enables measuring time spent by GPU on each render pass """
+		self._lib.rt_gpu_timer_enable(self._libdata, ctypes.c_int(enabled))
+	
+	def get_gpu_timer_stats(self):
+		"""
+		Returns dict with min, mean and max time (in microseconds) spent by GPU on
+		each render pass during last second. 'core' pass is measured only
+		for HW-rendered cores.
+		"""
+		stats = (GpuTimerStats * len(GPU_PASSES))()
+		self._lib.rt_gpu_timer_get_stats(self._libdata, stats)
+		return {
+			pas : { name : getattr(stats[i], name) for name, trash in GpuTimerStats._fields_ }
+			for i, pas in enumerate(GPU_PASSES)
+		}
+	
+	def set_fast_forward(self, factor, uncapped=False):
+		"""
+		Runs core 'factor' times for every presented frame.
+		With uncapped set, frames are generated as fast as possible.
+		"""
+		self._lib.rt_set_fast_forward(self._libdata, ctypes.c_int(factor), ctypes.c_int(uncapped))
+	
+	def set_run_ahead(self, frames):
+		""" Sets number of frames to run ahead. 0 disables run-ahead """
+		if 0 != self._lib.rt_set_run_ahead(self._libdata, ctypes.c_int(frames)):
+			log.warning("Failed to enable run-ahead")
+	
+	def setup_rewind(self, budget=None, interval=None):
+		"""
+		Allocates 'budget' bytes for rewind history with snapshot taken
+		every 'interval' frames. budget=0 disables rewind.
+		Defaults are taken from RT_REWIND_BUDGET and RT_REWIND_INTERVAL.
+		"""
+		if budget is None:
+			budget = int(os.environ.get("RT_REWIND_BUDGET", Native.REWIND_BUDGET))
+		if interval is None:
+			interval = int(os.environ.get("RT_REWIND_INTERVAL", Native.REWIND_INTERVAL))
+		if 0 != self._lib.rt_rewind_setup(self._libdata, ctypes.c_size_t(budget), ctypes.c_int(interval)):
+			log.warning("Failed to enable rewind")
+			self.rewind_enabled = False
+		else:
+			self.rewind_enabled = budget > 0
+	
+	def set_rewinding(self, rewinding):
+		"""
+		Snapshots cost time on every frame, so history is kept only
+		if RT_REWIND is set or after rewinding was first requested.
+		"""
+		if rewinding and not self.rewind_enabled and self.check_saving_supported():
+			self.setup_rewind()
+		self._lib.rt_set_rewinding(self._libdata, ctypes.c_int(rewinding))
+	
+	def get_rewind_stats(self):
+		""" Returns dict with rewind history statistics. Times are in microseconds """
+		stats = RewindStats()
+		self._lib.rt_rewind_get_stats(self._libdata, ctypes.byref(stats))
+		return { name : getattr(stats, name) for name, trash in RewindStats._fields_ }
+	
+	def get_input_stats(self):
+		"""
+		Returns dict with input queue statistics. 'age_*' is age of oldest
+		event at time when it was processed, in microseconds.
+		"""
+		stats = InputStats()
+		self._lib.rt_input_get_stats(self._libdata, ctypes.byref(stats))
+		return { name : getattr(stats, name) for name, trash in InputStats._fields_ }
+	
+	def get_input_latency(self):
+		"""
+		Returns dict with histograms of latency (in microseconds) from input
+		change to core reading it ('read') and to presenting next frame
+		after that ('present'), measured since runner started.
+		"""
+		to_read, to_present = LatencyHistogram(), LatencyHistogram()
+		self._lib.rt_latency_get_stats(self._libdata, ctypes.byref(to_read), ctypes.byref(to_present))
+		return { "read" : to_read.to_dict(), "present" : to_present.to_dict() }
+	
+	def dump_input_latency(self, filename):
+		""" Writes input latency histograms as JSON """
+		try:
+			with open(filename, "w") as f:
+				json.dump(self.get_input_latency(), f, indent=4, sort_keys=True)
+			log.info("Input latency written to %s", filename)
+		except IOError, e:
+			log.error("Failed to write input latency: %s", e)
+	
 	def get_game_loaded(self):
 		return self._lib.rt_get_game_loaded(self._libdata) == 1
 	
@@ -138,20 +476,34 @@ class Native:
 		if 0 != self._lib.rt_save_screenshot(self._libdata, ctypes.c_char_p(screenshot.encode("utf-8"))):
 			log.warning("Failed to save screenshot (game saved with no problems)")
 		self.call("on_state_saved", state)
+	
+	def request_input_latency(self):
+		self.call("input_latency", json.dumps(self.get_input_latency()))
 
 
 class RetroRunner(Native, RPC):	
-	def __init__(self, read_fd, write_fd, shm_fname, parent, core, game):
+	def __init__(self, read_fd, write_fd, shm_fd, parent, core, game, headless=False):
+		self._dispatching = False
 		RPC.__init__(self, read_fd, write_fd)
-		Native.__init__(self, parent, shm_fname)
-		if shm_fname is None:
+		Native.__init__(self, parent, shm_fd, headless)
+		if shm_fd is None:
 			self.shared_data.get_ptr().contents.scale_factor = 1.0
+		self.core = core
 		self.config = load_core_config(core) or {}
 		self.env_config_override = {}
 		try:
 			self.env_config_override = json.loads(os.environ.get("RT_CORE_CONFIG_OVERRIDE"))
 		except: pass
+		if "RT_PACER_SPIN_TIME" in os.environ or "RT_PACER_RESYNC" in os.environ:
+			self.set_pacer(
+				int(os.environ.get("RT_PACER_SPIN_TIME", 0)),
+				int(os.environ.get("RT_PACER_RESYNC", 50000)))
 		self.load_core(core)
+		if "RT_AUDIO_BACKEND" in os.environ:
+			# Either backend name or 'wav:filename'
+			self.set_audio_backend(*os.environ["RT_AUDIO_BACKEND"].split(":", 1))
+		if AUDIO_LATENCY_KEY in self.config:
+			self.set_audio_latency(int(self.config[AUDIO_LATENCY_KEY]))
 		self.load_game(game)
 	
 	def config_changed(self, *a):
@@ -161,6 +513,11 @@ class RetroRunner(Native, RPC):
 	def cb_render_size_changed(self, width, height):
 		self.call("render_size_changed", width, height)
 	
+	def cb_audio_latency_changed(self, latency):
+		""" Latency found by tuner is remembered for next time """
+		self.config[AUDIO_LATENCY_KEY] = latency
+		save_core_config(self.core, self.config)
+	
 	def cb_get_variable(self, key):
 		key = key.decode("utf-8")
 		if key in self.env_config_override:
@@ -190,6 +547,28 @@ class RetroRunner(Native, RPC):
 			else:
 				self.config[key] = value
 	
+	def schedule_flush(self):
+		# Calls made while handling received messages are sent together
+		if not self._dispatching:
+			self.flush()
+	
+	def cb_rpc_ready(self):
+		""" Called by native run loop when there is something to read """
+		data = os.read(self._read_fd, READ_SIZE)
+		if not data:
+			log.debug("GUI closed connection")
+			return 1
+		self._dispatching = True
+		try:
+			self.feed(data)
+		except ValueError, e:
+			log.error("Invalid message from GUI: %s", e)
+			return 1
+		finally:
+			self._dispatching = False
+			self.flush()
+		return 0
+	
 	def initialize(self):
 		""" Calls step_paused few times allowing core to initialize """
 		for x in xrange(5):
@@ -197,23 +576,119 @@ class RetroRunner(Native, RPC):
 			self.step()
 	
 	def run(self):
-		while True:
-			if self.paused:
-				self.select(0.1)
-				self.step_paused()
-			else:
-				self.select()
-				self.step()
+		""" Runs native loop, returns when GUI closes connection """
+		if 0 != self._lib.rt_run_loop(self._libdata, ctypes.c_int(self._read_fd)):
+			log.error("Run loop failed")
+
+
+def _percentile(values, percent):
+	""" Returns given percentile of already sorted list """
+	return values[min(len(values) - 1, len(values) * percent / 100)]
+
+
+def _summary(values):
+	values = sorted(values)
+	return {
+		"mean" : float(sum(values)) / len(values),
+		"p50" : _percentile(values, 50),
+		"p90" : _percentile(values, 90),
+		"p99" : _percentile(values, 99),
+		"max" : values[-1],
+	}
+
+
+def _timed(fn, *a):
+	""" Calls fn and returns how long it took, in microseconds """
+	start = trace.get_time()
+	fn(*a)
+	return trace.get_time() - start
+
+
+def benchmark(core, game, frames, warmup=BENCHMARK_WARMUP):
+	"""
+	Runs 'frames' frames as fast as possible, without visible window and
+	with 'null' audio backend (unless RT_AUDIO_BACKEND says otherwise), then saves screenshot, saves and loads state.
+	Returns dict with fps and frame times (in microseconds).
+	
+	'core' may be either path to core or its name, e.g. 'snes9x'.
+	Use 'stress' to run synthetic core built together with native code.
+	"""
+	if not os.path.exists(core):
+		# Stress core is installed next to libnative_runner, in sys.path
+		for path in list(get_core_paths()) + sys.path:
+			path = os.path.join(path, "%s_libretro.so" % (core, ))
+			if os.path.exists(path):
+				core = path
+				break
+	devnull = open("/dev/null", "wb")
+	n = RetroRunner(-1, devnull.fileno(), None, 0, core, game, headless=True)
+	n.set_vsync(False)
+	n.set_paused(False)
+	n.set_fast_forward(1, True)
+	n.set_screen_size(BENCHMARK_SCREEN_SIZE, BENCHMARK_SCREEN_SIZE)
+	for x in xrange(warmup):
+		n.step()
+	
+	totals = []
+	phases = { name : [] for name, trash in FrameTimes._fields_ }
+	started = trace.get_time()
+	for x in xrange(frames):
+		start = trace.get_time()
+		n.step()
+		totals.append(trace.get_time() - start)
+		for name, value in n.get_frame_times().items():
+			phases[name].append(value)
+	elapsed = trace.get_time() - started
+	
+	io = {}
+	directory = tempfile.mkdtemp()
+	try:
+		io["screenshot"] = _timed(n.save_screenshot, os.path.join(directory, "benchmark.png"))
+		if n.check_saving_supported():
+			io["save_state"] = _timed(n.save_state, os.path.join(directory, "benchmark.state"))
+			io["load_state"] = _timed(n.load_state, os.path.join(directory, "benchmark.state"))
+	finally:
+		shutil.rmtree(directory)
+	n.close_audio()
+	devnull.close()
+	
+	return {
+		"core" : core,
+		"game" : game,
+		"frames" : frames,
+		"fps" : frames * 1000000.0 / elapsed,
+		"frame_time" : _summary(totals),
+		"phases" : { name : _summary(phases[name]) for name in phases },
+		"render" : n.get_render_stats(),
+		"io" : io,
+	}
 
 
 if __name__ == "__main__":
+	if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+		# Arguments are number of frames followed by one or more core & game pairs
+		try:
+			frames, pairs = int(sys.argv[2]), sys.argv[3:]
+			assert len(pairs) > 0 and len(pairs) % 2 == 0
+		except (IndexError, ValueError, AssertionError):
+			print >>sys.stderr, "Usage: %s --benchmark frames core game [core game ...]" % (sys.argv[0],)
+			sys.exit(1)
+		from retrotouch.tools import init_logging, set_logging_level
+		init_logging()
+		set_logging_level(False, False)
+		results = [ benchmark(pairs[i], pairs[i + 1], frames) for i in xrange(0, len(pairs), 2) ]
+		print json.dumps(results, indent=4, sort_keys=True)
+		sys.exit(0)
+	
 	try:
 		core, game = sys.argv[1:]
 		read_fd = long(os.environ.get("RT_RUNNER_READ_FD", "0"))
 		write_fd = long(os.environ.get("RT_RUNNER_WRITE_FD", -1))
 		window_id = long(os.environ.get("RT_RUNNER_WINDOW_ID", "0"))
 		r, g, b = [ float(x) for x in os.environ.get("RT_BACKGROUND_COLOR", "0 0 0").split(" ") ]
-		shm_fname = os.environ.get("RT_RUNNER_SHM_FILENAME", None)
+		shm_fd = os.environ.get("RT_RUNNER_SHM_FD", None)
+		if shm_fd is not None:
+			shm_fd = int(shm_fd)
 		if write_fd < 0:
 			_write = open("/dev/null", 'wb')
 			write_fd = _write.fileno()
@@ -226,7 +701,7 @@ if __name__ == "__main__":
 		print >>sys.stderr, "	RT_RUNNER_READ_FD"
 		print >>sys.stderr, "	RT_RUNNER_WRITE_FD"
 		print >>sys.stderr, "	RT_RUNNER_WINDOW_ID"
-		print >>sys.stderr, "	RT_RUNNER_SHM_FILENAME"
+		print >>sys.stderr, "	RT_RUNNER_SHM_FD"
 		print >>sys.stderr, "	RT_BACKGROUND_COLOR (r g b, space separated, floats)"
 		print >>sys.stderr, ""
 		print >>sys.stderr, e
@@ -236,13 +711,27 @@ if __name__ == "__main__":
 	init_logging()
 	set_logging_level(True, True)
 	
-	n = RetroRunner(read_fd, write_fd, shm_fname, window_id, core, game)
+	n = RetroRunner(read_fd, write_fd, shm_fd, window_id, core, game)
+	if trace.ENABLED:
+		n.setup_trace(os.environ["RT_TRACE"],
+			int(os.environ.get("RT_TRACE_EVENTS", Native.TRACE_EVENTS)))
 	n.set_background_color(float(r), float(g), float(b))
 	n.set_paused(False)
 	save_core_config(core, n.config)
 	
 	n.initialize()
+	if os.environ.get("RT_THREADED_VIDEO") == "1":
+		n.set_threaded_video(True)
+	if os.environ.get("RT_GPU_TIMER") == "1":
+		n.set_gpu_timer(True)
 	if n.check_saving_supported():
 		n.call("saving_supported")
+		if os.environ.get("RT_REWIND") == "1":
+			n.setup_rewind()
 	
 	n.run()
+	n.close_audio()
+	if "RT_INPUT_LATENCY" in os.environ:
+		n.dump_input_latency(os.environ["RT_INPUT_LATENCY"])
+	if trace.ENABLED:
+		n.dump_trace()
@@ -2,62 +2,366 @@
 """
 RetroTouch - RPC
 
-Handles talking between runner and GUI
+Handles talking between runner and GUI.
+
+Every message is 6-byte header (method id and payload size) followed by
+arguments. Numbers are packed first, as fixed-width little-endian values.
+All strings, including list items, then follow as single UTF-8 text where
+strings are separated by NUL and every list item is preceded by NUL, so
+strings cannot contain NUL. Only methods listed in METHODS can be called
+and nothing in message can execute code on receiving side.
 """
 from __future__ import unicode_literals
 
-import cPickle as pickle
-import os, struct, select, logging
+from retrotouch import trace
+import os, struct, select, errno, codecs, logging
 log = logging.getLogger("RPC")
 
 
+# Every method that can be called, with types of its arguments:
+#  i, I, Q, ? - as in 'struct' module
+#  s          - string
+#  L          - list of strings
+# Numbers have to come before strings and list can only be last.
+# New methods should be added only at end, as index is used as method id.
+METHODS = [
+	("ping",					""),
+	("set_screen_size",			"ii"),
+	("render_size_changed",		"ii"),
+	("paused_changed",			"?"),
+	("window_created",			"Q"),
+	("saving_supported",		""),
+	("add_variable",			"ssL"),
+	("on_state_saved",			"s"),
+	("save_state",				"s"),
+	("load_state",				"s"),
+	("config_changed",			""),
+	("save_screenshot",			"s"),
+	("save_both",				"sss"),
+	("set_paused",				"?"),
+	("set_vsync",				"?"),
+	("set_fast_forward",		"i?"),
+	("set_run_ahead",			"i"),
+	("set_rewinding",			"?"),
+	("add_trace_events",		"L"),
+	("request_input_latency",	""),
+	("input_latency",			"s"),
+	("dump_input_latency",		"s"),
+]
+METHOD_IDS = { name : index for (index, (name, trash)) in enumerate(METHODS) }
+
+HEADER = struct.Struct(b"<HI")
+READ_SIZE = 65536
+# Faster than unicode.encode, which looks codec up by name.
+# For same reason, unicode(bts, "utf-8") is used instead of bts.decode
+_utf8_encode = codecs.utf_8_encode
+
+
 class RPC:
 	
 	def __init__(self, read_fd, write_fd):
 		self.setup_fds(read_fd, write_fd)
 	
 	def setup_fds(self, read_fd, write_fd):
-		self._read = os.fdopen(read_fd, 'rb')
-		self._write = os.fdopen(write_fd, 'wb')
+		self._read_fd = read_fd
+		self._write_fd = write_fd
+		self._buffer = b""
+		self._pending = []
 	
 	def close(self):
-		self._read.close()
-		self._write.close()
+		""" Closes both pipes. Safe to call repeatedly """
+		for fd in (self._read_fd, self._write_fd):
+			if fd < 0:
+				continue
+			try:
+				os.close(fd)
+			except OSError: pass
+		self._read_fd = self._write_fd = -1
 	
 	def select(self, timeout=0):
+		"""
+		Waits up to 'timeout' seconds for messages and processes
+		everything that arrived. Returns False if other side closed pipe
+		or sent invalid message.
+		"""
 		while True:
-			r, w, x = select.select([self._read], [], [], timeout)
-			if len(r):
-				size = decode_size(self._read.read(4))
-				mname, args, kws = decode_call(self._read.read(size))
-				self.call_locally(mname, args, kws)
-			else:
-				break
-	
-	def call(self, mname, *args, **kws):
-		encoded = encode_call(mname, args, kws)
-		self._write.write(encode_size(len(encoded)) + encoded)
-		self._write.flush()
-	
-	def call_locally(self, mname, args, kws):
+			r, w, x = select.select([self._read_fd], [], [], timeout)
+			if not len(r):
+				return True
+			data = os.read(self._read_fd, READ_SIZE)
+			if not data:
+				return False
+			try:
+				self.feed(data)
+			except ValueError, e:
+				log.error("Invalid message received: %s", e)
+				return False
+			timeout = 0
+	
+	def feed(self, data):
+		"""
+		Decodes and calls all complete messages in received data.
+		Raises ValueError if data contains invalid message.
+		"""
+		self._buffer += data
 		try:
-			getattr(self, mname)(*args, **kws)
+			messages, self._buffer = decode_messages(self._buffer)
+		except ValueError:
+			# Nothing after invalid message can be decoded, so it's dropped
+			# instead of failing again on every read
+			self._buffer = b""
+			raise
+		for mname, args in messages:
+			self.call_locally(mname, args)
+	
+	def call(self, mname, *args):
+		"""
+		Queues call of method on other side. Queued calls are sent together
+		by 'flush'; 'schedule_flush' is called when first call is queued.
+		"""
+		self._pending.append(ENCODERS[mname](args))
+		if len(self._pending) == 1:
+			self.schedule_flush()
+	
+	def schedule_flush(self):
+		""" Overriden where main loop is available. By default, flushes right away """
+		self.flush()
+	
+	def flush(self):
+		""" Sends all queued calls using as few writes as possible """
+		if not self._pending:
+			return
+		data, self._pending = b"".join(self._pending), []
+		while data:
+			try:
+				written = os.write(self._write_fd, data)
+			except OSError, e:
+				if e.errno == errno.EINTR:
+					continue
+				raise
+			data = data[written:]
+	
+	def call_locally(self, mname, args):
+		try:
+			with trace.span(mname):
+				getattr(self, mname)(*args)
 		except Exception, e:
 			log.exception(e)
 
 
-def encode_size(size):
-	return struct.pack("@I", size)
+def _to_text(items):
+	""" Slow path of joining strings, used when there is non-ASCII byte string """
+	return "\0".join([ x.decode("utf-8") if type(x) is str else unicode(x) for x in items ])
 
 
-def decode_size(bts):
-	return struct.unpack("@I", bts)[0]
+def _compile(index, mname, types):
+	"""
+	Prepares encoder and decoder for single method, so nothing has to be
+	looked up based on argument types when message is sent or received.
+	Returns (encoder, decoder, fixed) where 'fixed' is Struct that decodes
+	all arguments. Both decoder and 'fixed' are None for methods that take
+	only strings, as those are decoded directly by decode_messages.
+	"""
+	nscalars = len(types) - len(types.lstrip("iIQ?"))
+	nstrings = types.count("s")
+	has_list = types.endswith("L")
+	count = len(types)
+	pack_header = HEADER.pack
+	if types[nscalars:] not in ("s" * nstrings, "s" * nstrings + "L"):
+		raise ValueError("Unsupported argument types of %s: %s" % (mname, types))
+	
+	def invalid(args):
+		if len(args) != count:
+			return TypeError("%s takes %s arguments (%s given)" % (mname, count, len(args)))
+		return ValueError("String contains NUL character")
+	
+	if nstrings == 0 and not has_list:
+		# Only fixed-width arguments, whole message is packed by single Struct
+		pack = struct.Struct(b"<HI" + types.encode("ascii")).pack
+		fixed = struct.Struct(b"<" + types.encode("ascii"))
+		size = fixed.size
+		
+		def encode(args):
+			if len(args) != count:
+				raise invalid(args)
+			return pack(index, size, *args)
+		
+		return encode, None, fixed
+	
+	if nscalars == 0 and not has_list:
+		# Only strings, most common case
+		def encode(args):
+			try:
+				text = "\0".join(args)
+			except (UnicodeDecodeError, TypeError):
+				text = _to_text(args)
+			# For single string, 'in' is cheaper than counting
+			if len(args) != count or (("\0" in text) if count == 1 else (text.count("\0") != count - 1)):
+				raise invalid(args)
+			payload = _utf8_encode(text)[0]
+			return pack_header(index, len(payload)) + payload
+		
+		return encode, None, None
+	
+	# Every list item is preceded by NUL, so number of items is known
+	# from text alone and list that is only argument can still be empty.
+	# 'first' is index of first list item in split text
+	first = max(nstrings, 1)
+	lead = nstrings == 0
+	
+	if nscalars == 0:
+		# Strings followed by list
+		def encode(args):
+			if len(args) != count:
+				raise invalid(args)
+			items = args[:-1] + tuple(args[-1])
+			try:
+				text = "\0".join(items)
+			except (UnicodeDecodeError, TypeError):
+				text = _to_text(items)
+			if items and text.count("\0") != len(items) - 1:
+				raise invalid(args)
+			if lead and items:
+				text = "\0" + text
+			payload = _utf8_encode(text)[0]
+			return pack_header(index, len(payload)) + payload
+		
+		def decode(bts, offset, end):
+			items = unicode(bts[offset:end], "utf-8").split("\0")
+			if len(items) < first or (lead and items[0]):
+				raise ValueError("Invalid %s message" % (mname,))
+			args = items[:nstrings]
+			args.append(items[first:])
+			return args
+		
+		return encode, decode, None
+	
+	# Numbers are packed together with header
+	pack_prefix = struct.Struct(b"<HI" + types[:nscalars].encode("ascii")).pack
+	prefix = struct.Struct(b"<" + types[:nscalars].encode("ascii"))
+	prefix_size = prefix.size
+	
+	def encode(args):
+		if len(args) != count:
+			raise invalid(args)
+		if has_list:
+			items = args[nscalars:-1] + tuple(args[-1])
+		else:
+			items = args[nscalars:]
+		try:
+			text = "\0".join(items)
+		except (UnicodeDecodeError, TypeError):
+			text = _to_text(items)
+		if items and text.count("\0") != len(items) - 1:
+			raise invalid(args)
+		if lead and items:
+			text = "\0" + text
+		payload = _utf8_encode(text)[0]
+		return pack_prefix(index, prefix_size + len(payload), *args[:nscalars]) + payload
+	
+	def decode(bts, offset, end):
+		if end - offset < prefix_size:
+			raise ValueError("Invalid size of %s message" % (mname,))
+		args = list(prefix.unpack_from(bts, offset))
+		items = unicode(bts[offset + prefix_size:end], "utf-8").split("\0")
+		if has_list:
+			if len(items) < first or (lead and items[0]):
+				raise ValueError("Invalid %s message" % (mname,))
+			args += items[:nstrings]
+			args.append(items[first:])
+		elif len(items) == nstrings:
+			args += items
+		else:
+			raise ValueError("Invalid %s message" % (mname,))
+		return args
+	
+	return encode, decode, None
+
+
+# DECODERS has (name, decoder, fixed, size) for every method, where 'size'
+# is size of arguments packed by 'fixed' or number of strings
+ENCODERS = {}
+DECODERS = []
+for (index, (mname, types)) in enumerate(METHODS):
+	encode, decode, fixed = _compile(index, mname, types)
+	ENCODERS[mname] = encode
+	DECODERS.append((mname, decode, fixed, fixed.size if fixed else len(types)))
+del index, mname, types, encode, decode, fixed
 
 
-def encode_call(mname, args, kws):
-	return pickle.dumps((mname, args, kws), -1)
+def encode_call(mname, args):
+	""" Returns encoded message. RPC.call uses ENCODERS directly, to save a call """
+	return ENCODERS[mname](args)
 
 
-def decode_call(bts):
-	mname, args, kws = pickle.loads(bts)
-	return mname, args, kws
+def decode_messages(bts):
+	"""
+	Decodes all complete messages in buffer.
+	Returns list of (method_name, args) and remaining, incomplete data.
+	Raises ValueError if buffer contains invalid message.
+	"""
+	messages, offset, length = [], 0, len(bts)
+	append, decoders = messages.append, DECODERS
+	unpack_header, header_size = HEADER.unpack_from, HEADER.size
+	while length - offset >= header_size:
+		index, size = unpack_header(bts, offset)
+		start = offset + header_size
+		end = start + size
+		if end > length:
+			break
+		try:
+			mname, decode, fixed, count = decoders[index]
+		except IndexError:
+			raise ValueError("Unknown method #%s" % (index,))
+		if decode is not None:
+			append((mname, decode(bts, start, end)))
+		elif fixed is None:
+			args = unicode(bts[start:end], "utf-8").split("\0")
+			if len(args) != count:
+				raise ValueError("Invalid %s message" % (mname,))
+			append((mname, args))
+		elif count == size:
+			append((mname, fixed.unpack_from(bts, start)))
+		else:
+			raise ValueError("Invalid size of %s message" % (mname,))
+		offset = end
+	if offset == length:
+		return messages, b""
+	return messages, bts[offset:]
+
+
+if __name__ == "__main__":
+	# Microbenchmark comparing this protocol with pickle-based one used before
+	import cPickle as pickle, timeit
+	
+	def pickle_roundtrip(calls):
+		for mname, args in calls:
+			encoded = pickle.dumps((mname, args, {}), -1)
+			encoded = struct.pack(b"@I", len(encoded)) + encoded
+			pickle.loads(encoded[4:])
+	
+	def binary_roundtrip(calls):
+		# Same as RPC.call and RPC.feed do
+		decode_messages(b"".join([ ENCODERS[mname](args) for mname, args in calls ]))
+	
+	CASES = [
+		("hot calls", [
+			("set_screen_size", (1280, 720)),
+			("render_size_changed", (320, 240)),
+			("paused_changed", (True,)),
+			("ping", ()),
+		]),
+		("strings", [
+			("save_state", ("/home/user/.local/share/retrotouch/game.sav",)),
+			("add_variable", ("core_region", "Region", [ "Auto", "NTSC", "PAL" ])),
+		]),
+	]
+	
+	for name, calls in CASES:
+		pickle_size = sum([ len(pickle.dumps((m, a, {}), -1)) + 4 for m, a in calls ])
+		binary_size = sum([ len(encode_call(m, a)) for m, a in calls ])
+		for label, fn, size in (("pickle", pickle_roundtrip, pickle_size),
+				("binary", binary_roundtrip, binary_size)):
+			t = min(timeit.repeat(lambda : fn(calls), number=10000, repeat=3))
+			print "%-10s %-7s %6.2fus per message, %4i bytes per batch" % (
+				name, label, t / 10000 / len(calls) * 1000000, size)
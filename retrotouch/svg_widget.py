@@ -8,6 +8,7 @@ Also supports clicking on areas defined in SVG image.
 from __future__ import unicode_literals
 
 from gi.repository import Gtk, Gdk, GObject, GdkPixbuf, Rsvg
+from retrotouch.trace import traced
 from xml.etree import ElementTree as ET
 from math import sin, cos, pi as PI
 from collections import OrderedDict
@@ -180,6 +181,7 @@ class SVGWidget(Gtk.EventBox):
 			return color.red_float, color.green_float, color.blue_float, 1
 		return 1, 0, 1, 1	# uggly purple
 	
+	@traced("hilight")
 	def hilight(self, buttons):
 		""" Hilights specified button, if same ID is found in svg """
 		cache_id = "|".join([ "%s:%s" % (x, buttons[x]) for x in buttons ])
@@ -0,0 +1,85 @@
+#!/usr/bin/env python2
+"""
+RetroTouch - Trace
+
+Measures spans of Python code for trace written by runner when RT_TRACE
+is set. Time is read from CLOCK_MONOTONIC, same as in native code, so
+spans from GUI, runner and native code end in single timeline.
+"""
+from __future__ import unicode_literals
+from collections import deque
+import ctypes, os
+
+CLOCK_MONOTONIC		= 1
+MAX_PENDING			= 4096
+
+ENABLED = bool(os.environ.get("RT_TRACE"))
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_pending = deque(maxlen=MAX_PENDING)
+_sink = None
+
+
+class _timespec(ctypes.Structure):
+	_fields_ = [
+		("tv_sec", ctypes.c_long),
+		("tv_nsec", ctypes.c_long),
+	]
+
+
+def get_time():
+	""" Returns monotonic time in microseconds, same as rt_get_time in runner """
+	ts = _timespec()
+	_libc.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+	return ts.tv_sec * 1000000 + ts.tv_nsec / 1000
+
+
+def set_sink(sink):
+	"""
+	Sets function called as sink(name, start, duration) for every finished
+	span. Without sink, spans are kept until get_pending is called.
+	"""
+	global _sink
+	_sink = sink
+
+
+def get_pending():
+	""" Returns and forgets spans collected so far, as (name, start, duration) tuples """
+	rv = list(_pending)
+	_pending.clear()
+	return rv
+
+
+class span(object):
+	""" Context manager measuring code inside its block """
+	__slots__ = ("name", "start")
+	
+	def __init__(self, name):
+		self.name = name
+	
+	def __enter__(self):
+		if ENABLED:
+			self.start = get_time()
+		return self
+	
+	def __exit__(self, *a):
+		if ENABLED:
+			duration = get_time() - self.start
+			if _sink:
+				_sink(self.name, self.start, duration)
+			else:
+				_pending.append((self.name, self.start, duration))
+
+
+def traced(name):
+	""" Decorator measuring every call of decorated function """
+	def decorator(fn):
+		if not ENABLED:
+			return fn
+		def wrapper(*a, **b):
+			with span(name):
+				return fn(*a, **b)
+		wrapper.__name__ = fn.__name__
+		wrapper.__doc__ = fn.__doc__
+		return wrapper
+	return decorator
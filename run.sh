@@ -13,6 +13,8 @@ export CORE_SEARCH_PATH="$(pwd)/cores"
 # Build libs
 python2 setup.py build || exit 1
 [ -h libnative_runner.so ] || ln -s build/lib.linux-x86_64-2.7/libnative_runner.so .
+[ -h libshared_input.so ] || ln -s build/lib.linux-x86_64-2.7/libshared_input.so .
+[ -h stress_libretro.so ] || ln -s build/lib.linux-x86_64-2.7/stress_libretro.so .
 
 # Execute
 if [ x"$1" == x"-d" ] ; then
@@ -48,10 +48,16 @@ if __name__ == "__main__":
 						'retrotouch/native/retro_audio.c',
 						'retrotouch/native/retro_render.c',
 						'retrotouch/native/retro_internal.c',
+						'retrotouch/native/retro_video_thread.c',
+						'retrotouch/native/retro_log.c',
+						'retrotouch/native/retro_hud.c',
+						'retrotouch/native/retro_trace.c',
+						'retrotouch/native/retro_gpu_timer.c',
+						'retrotouch/native/retro_latency.c',
 						'retrotouch/native/gltools.c',
 					],
 					extra_compile_args = [ '-g', '-O0', '-std=gnu99' ],
-					libraries = [ 'GL', 'asound', 'png', 'X11' ],
+					libraries = [ 'GL', 'asound', 'png', 'X11', 'pthread' ],
 					include_dirs = [
 						"retrotouch/native",
 						"/usr/include/",
@@ -64,5 +70,16 @@ if __name__ == "__main__":
 						"/usr/include/gdk-pixbuf-2.0/",
 					],
 				),
+				# Used by GUI to publish input into shared memory with proper memory ordering
+				Extension('libshared_input',
+					sources = [ 'retrotouch/native/shared_input.c' ],
+					extra_compile_args = [ '-g', '-O2', '-std=gnu99' ],
+				),
+				# Synthetic core used by 'native_runner --benchmark FRAMES stress GAME'
+				Extension('stress_libretro',
+					sources = [ 'retrotouch/native/stress_core.c' ],
+					extra_compile_args = [ '-g', '-O2', '-std=gnu99' ],
+					include_dirs = [ "retrotouch/native" ],
+				),
 			]
 	)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python2
+"""
+Runs synthetic stress core through native runner.
+
+Requires libnative_runner.so and stress_libretro.so built by run.sh and an
+X display; skipped otherwise.
+
+All tests share single runner, so every test has to put back whatever it
+changes on it. Tests can then run in any order or alone.
+"""
+import sys, os, json, wave, shutil, tempfile
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if ROOT not in sys.path:
+	sys.path.insert(0, ROOT)
+
+if "DISPLAY" not in os.environ:
+	pytest.skip("No display available", allow_module_level=True)
+
+from retrotouch.native_runner import RetroRunner
+from retrotouch.tools import find_library
+try:
+	find_library("libnative_runner")
+except OSError:
+	pytest.skip("libnative_runner is not built", allow_module_level=True)
+
+SAMPLES_PER_FRAME = 48000 / 60
+CONFIG = {
+	"stress_geometry" : "320x240",
+	"stress_audio" : "batch",
+	"stress_state_size" : "65536",
+}
+
+
+def find_stress_core():
+	for path in sys.path:
+		path = os.path.join(path, "stress_libretro.so")
+		if os.path.exists(path):
+			return path
+	pytest.skip("stress_libretro is not built")
+
+
+@pytest.fixture(scope="module")
+def directory():
+	directory = tempfile.mkdtemp()
+	yield directory
+	shutil.rmtree(directory)
+
+
+@pytest.fixture(scope="module")
+def runner(directory):
+	""" Single runner is shared, as core can be loaded only once per process """
+	core = find_stress_core()
+	os.environ["RT_CORE_CONFIG_OVERRIDE"] = json.dumps(CONFIG)
+	devnull = open("/dev/null", "wb")
+	try:
+		n = RetroRunner(-1, devnull.fileno(), None, 0, core,
+				os.path.join(directory, "game.bin"), headless=True)
+	finally:
+		del os.environ["RT_CORE_CONFIG_OVERRIDE"]
+	n.set_vsync(False)
+	n.set_paused(False)
+	n.set_fast_forward(1, True)
+	n.set_screen_size(320, 240)
+	yield n
+	n.close_audio()
+	devnull.close()
+
+
+def test_frames(runner):
+	for x in xrange(30):
+		runner.step()
+	times = runner.get_frame_times()
+	assert times["core"] > 0
+	assert all(value >= 0 for value in times.values())
+	assert runner.get_render_stats()["presented"] > 0
+
+
+def test_audio(runner, directory):
+	filename = os.path.join(directory, "audio.wav")
+	runner.set_audio_backend("wav", filename)
+	try:
+		for x in xrange(60):
+			runner.step()
+		stats = runner.get_audio_stats()
+		assert stats["frame_samples_last"] == SAMPLES_PER_FRAME
+	finally:
+		runner.close_audio()
+		# Back to default backend, so other tests don't write into file
+		runner.set_audio_backend("null")
+	
+	w = wave.open(filename, "rb")
+	try:
+		assert w.getnchannels() == 2
+		assert w.getsampwidth() == 2
+		assert w.getframerate() == 48000
+		assert w.getnframes() == 60 * SAMPLES_PER_FRAME
+		assert w.readframes(SAMPLES_PER_FRAME).strip(b"\0")
+	finally:
+		w.close()
+
+
+def test_save_load(runner, directory):
+	state = os.path.join(directory, "game.state")
+	before = os.path.join(directory, "before.png")
+	after = os.path.join(directory, "after.png")
+	assert runner.check_saving_supported()
+	
+	runner.step()
+	runner.save_state(state)
+	assert os.path.getsize(state) >= int(CONFIG["stress_state_size"])
+	runner.step()
+	runner.save_screenshot(before)
+	for x in xrange(10):
+		runner.step()
+	runner.load_state(state)
+	runner.step()
+	runner.save_screenshot(after)
+	# Frames depend only on frame counter stored in state
+	assert open(before, "rb").read() == open(after, "rb").read()
+
+
+def test_screenshot(runner, directory):
+	filename = os.path.join(directory, "screenshot.png")
+	runner.step()
+	runner.save_screenshot(filename)
+	assert open(filename, "rb").read(8) == b"\x89PNG\r\n\x1a\n"